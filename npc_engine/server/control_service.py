@@ -1,5 +1,6 @@
 """Module that implements control service."""
 from multiprocessing import Process
+from typing import Any, Dict, List, Tuple, Union
 import asyncio
 import json
 import zmq
@@ -7,6 +8,7 @@ import zmq.asyncio
 
 from npc_engine import services
 from npc_engine.server.metadata_manager import MetadataManager
+from npc_engine.server.utils import BINARY_FRAME
 from jsonrpc import JSONRPCResponseManager, Dispatcher
 from loguru import logger
 
@@ -22,13 +24,26 @@ class ServiceState:
     ERROR = "error"
 
 
+#: Order in which replica states take precedence when reporting service state.
+STATE_PRIORITY = [
+    ServiceState.RUNNING,
+    ServiceState.STARTING,
+    ServiceState.AWAITING,
+    ServiceState.TIMEOUT,
+    ServiceState.ERROR,
+    ServiceState.STOPPED,
+]
+
+
 def set_logger(logger_):
     """Set the logger for the service."""
     global logger
     logger = logger_
 
 
-def service_process(metadata: MetadataManager, service_id: str, logger) -> None:
+def service_process(
+    metadata: MetadataManager, service_id: str, logger, replica: int = 0
+) -> None:
     """Service subprocess function.
 
     Starts the service and runs it's loop.
@@ -38,7 +53,7 @@ def service_process(metadata: MetadataManager, service_id: str, logger) -> None:
     service = services.BaseService.create(
         context,
         metadata.services[service_id].path,
-        metadata.services[service_id].uri,
+        metadata.get_replica_uri(service_id, replica),
         service_id,
     )
     service.loop()
@@ -73,14 +88,13 @@ class ControlService:
             }
         )
         self.zmq_context = zmq_context
+        self.request_counter = 0
         self.services = {
             service_id: {
-                "process": None,
-                "socket": None,
-                "state": ServiceState.STOPPED,
-                "in_queue": None,
-                "out_queue": None,
-                "dispatch_coroutine": None,
+                "replicas": [
+                    self._create_replica()
+                    for _ in range(self.metadata.services[service_id].replicas)
+                ],
             }
             for service_id in self.metadata.services.keys()
         }
@@ -88,13 +102,35 @@ class ControlService:
     def __del__(self):
         """Stop all services."""
         if hasattr(self, "services"):
-            for service_id, service in self.services.items():
-                if service["state"] == ServiceState.RUNNING:
+            for service_id in self.services:
+                if self._get_state(service_id) == ServiceState.RUNNING:
                     try:
                         self.stop_service(service_id)
                     except Exception:
                         pass
 
+    @staticmethod
+    def _create_replica() -> Dict[str, Any]:
+        return {
+            "process": None,
+            "socket": None,
+            "state": ServiceState.STOPPED,
+            "pending": {},
+            "in_flight": None,
+            "dispatch_coroutine": None,
+        }
+
+    def _get_state(self, service_id: str) -> str:
+        """Get the state of the service aggregated over it's replicas.
+
+        Service is considered running if at least one replica is running.
+        """
+        states = [replica["state"] for replica in self.services[service_id]["replicas"]]
+        for state in STATE_PRIORITY:
+            if state in states:
+                return state
+        return ServiceState.ERROR
+
     async def handle_request(self, address: str, request: str) -> str:
         """Parse request string and route request to correct service.
 
@@ -105,6 +141,28 @@ class ControlService:
         Returns:
             str: jsonRPC response
         """
+        response, _ = await self.route_request(address, request)
+        return response
+
+    async def handle_binary_request(
+        self, address: str, request: str
+    ) -> Tuple[str, List[zmq.Frame]]:
+        """Route request to correct service asking for binary side channel in the reply.
+
+        Args:
+            address (str): address of the service (either model name or class name)
+            request (str): jsonRPC string
+
+        Returns:
+            str: jsonRPC response with numpy arrays replaced by binary placeholders
+            list(zmq.Frame): raw buffers referenced by placeholders
+        """
+        return await self.route_request(address, request, binary=True)
+
+    async def route_request(
+        self, address: str, request: str, binary: bool = False
+    ) -> Tuple[str, List[zmq.Frame]]:
+        """Parse request string and route request to correct service."""
         request_dict = json.loads(request)
         service_id = self.metadata.resolve_service(address, request_dict["method"])
         self.check_service(service_id)
@@ -113,123 +171,248 @@ class ControlService:
         else:
             logger.info(f"Request from {address} ({service_id})\n Request: {request}")
         if service_id == "control":
-            return JSONRPCResponseManager.handle(request, self.control_dispatcher).json
+            return (
+                JSONRPCResponseManager.handle(request, self.control_dispatcher).json,
+                [],
+            )
         else:
-            if self.services[service_id]["state"] != ServiceState.RUNNING:
+            if self._get_state(service_id) != ServiceState.RUNNING:
                 raise ValueError(f"Service {service_id} is not running")
             else:
-                self.services[service_id]["in_queue"].put_nowait(request)
-                try:
-                    result = await self.services[service_id]["out_queue"].get()
-                except asyncio.CancelledError:
-                    result = ""
-                return result
+                return await self.dispatch_request(service_id, request, binary)
+
+    def select_replica(self, service_id: str) -> int:
+        """Select the least loaded running replica of the service.
+
+        Args:
+            service_id (str): id of the running service
+
+        Returns:
+            int: index of the replica
+        """
+        replicas = self.services[service_id]["replicas"]
+        running = [
+            idx
+            for idx, replica in enumerate(replicas)
+            if replica["state"] == ServiceState.RUNNING
+        ]
+        if len(running) == 0:
+            raise ValueError(f"Service {service_id} is not running")
+        return min(running, key=lambda idx: len(replicas[idx]["pending"]))
+
+    async def dispatch_request(
+        self, service_id: str, request: str, binary: bool = False
+    ) -> Tuple[str, List[zmq.Frame]]:
+        """Send request to the service and wait for the correlated reply.
+
+        Requests are tagged with a unique id frame so that replies
+        can be matched to callers regardless of their order.
+        Number of simultaneous requests per replica is limited by
+        service's `max_in_flight` config value.
+
+        Args:
+            service_id (str): id of the running service
+            request (str): jsonRPC string
+            binary (bool): ask service to send numpy arrays as raw frames
+
+        Returns:
+            str: jsonRPC response
+            list(zmq.Frame): binary frames of the reply
+        """
+        replica_idx = self.select_replica(service_id)
+        replica = self.services[service_id]["replicas"][replica_idx]
+        self.request_counter += 1
+        request_id = str(self.request_counter).encode("utf-8")
+        future = asyncio.get_event_loop().create_future()
+        try:
+            replica["pending"][request_id] = future
+            async with replica["in_flight"]:
+                logger.info(
+                    f"Dispatching message {request} to {service_id} (replica {replica_idx})"
+                )
+                if not future.done():
+                    frames = [b"", request_id, request.encode("utf-8")]
+                    if binary:
+                        frames.append(BINARY_FRAME)
+                    await replica["socket"].send_multipart(frames)
+                result = await future
+        except asyncio.CancelledError:
+            result = "", []
+        finally:
+            replica["pending"].pop(request_id, None)
+        return result
 
     def check_service(self, service_id):
-        """Check if the service process is running."""
-        if (
-            service_id != "control"
-            and (
-                self.services[service_id]["state"] == ServiceState.RUNNING
-                or self.services[service_id]["state"] == ServiceState.STARTING
-                or self.services[service_id]["state"] == ServiceState.AWAITING
+        """Check if the service processes are running.
+
+        Replicas with dead processes are marked as errored.
+        Raises an error if the whole service is not functional anymore.
+        """
+        if service_id == "control":
+            return
+        failed = False
+        for replica_idx, replica in enumerate(self.services[service_id]["replicas"]):
+            if (
+                replica["state"] == ServiceState.RUNNING
+                or replica["state"] == ServiceState.STARTING
+                or replica["state"] == ServiceState.AWAITING
+            ) and not replica["process"].is_alive():
+                self.fail_replica(service_id, replica_idx)
+                failed = True
+        if failed:
+            if self._get_state(service_id) == ServiceState.ERROR:
+                raise ValueError(
+                    f"Error in service {service_id}. Process is not alive."
+                )
+            logger.error(
+                f"Error in service {service_id}. Replica process is not alive."
             )
-            and not self.services[service_id]["process"].is_alive()
-        ):
-            self.services[service_id]["state"] = ServiceState.ERROR
-            raise ValueError(f"Error in service {service_id}. Process is not alive.")
 
-    def get_service_status(self, service_id):
-        """Get the status of the service."""
+    def get_service_status(
+        self, service_id: str, per_replica: bool = False
+    ) -> Union[str, List[str]]:
+        """Get the status of the service.
+
+        Args:
+            service_id: id of the service
+            per_replica: return list with status of each replica
+
+        Returns:
+            Service status or list of replica statuses
+        """
         service_id = self.metadata.resolve_service(service_id, None)
         self.check_service(service_id)
-        return self.services[service_id]["state"]
+        if per_replica:
+            return [
+                replica["state"] for replica in self.services[service_id]["replicas"]
+            ]
+        return self._get_state(service_id)
 
     def start_service(self, service_id):
-        """Start the service."""
+        """Start the service.
+
+        If the service is already running, only its errored replicas are restarted.
+        """
         service_id = self.metadata.resolve_service(service_id, None)
-        self.check_service(service_id)
-        if (
-            self.services[service_id]["state"] == ServiceState.RUNNING
-            or self.services[service_id]["state"] == ServiceState.STARTING
-        ):
-            raise ValueError(f"Service {service_id} is already running")
+        try:
+            self.check_service(service_id)
+        except ValueError:
+            pass
+        replicas = self.services[service_id]["replicas"]
+        state = self._get_state(service_id)
+        if state == ServiceState.RUNNING or state == ServiceState.STARTING:
+            to_start = [
+                replica_idx
+                for replica_idx, replica in enumerate(replicas)
+                if replica["state"] == ServiceState.ERROR
+            ]
+            if len(to_start) == 0:
+                raise ValueError(f"Service {service_id} is already running")
+        else:
+            to_start = range(len(replicas))
+
+        for replica_idx in to_start:
+            self.start_replica(service_id, replica_idx)
 
+    def start_replica(self, service_id: str, replica_idx: int):
+        """Start the service replica process and connect to it."""
+        replica = self.services[service_id]["replicas"][replica_idx]
         process = Process(
             target=service_process,
-            args=(self.metadata, service_id, logger),
+            args=(self.metadata, service_id, logger, replica_idx),
             daemon=True,
         )
         process.start()
-        self.services[service_id]["process"] = process
-        self.services[service_id]["state"] = ServiceState.STARTING
-        self.services[service_id]["socket"] = self.zmq_context.socket(zmq.REQ)
-        self.services[service_id]["socket"].setsockopt(zmq.LINGER, 0)
-        self.services[service_id]["socket"].setsockopt(zmq.RCVTIMEO, 10000)
-        self.services[service_id]["socket"].connect(
-            self.metadata.services[service_id].uri
+        replica["process"] = process
+        replica["state"] = ServiceState.STARTING
+        replica["socket"] = self.zmq_context.socket(zmq.DEALER)
+        replica["socket"].setsockopt(zmq.LINGER, 0)
+        replica["socket"].setsockopt(zmq.RCVTIMEO, 10000)
+        replica["socket"].connect(
+            self.metadata.get_replica_uri(service_id, replica_idx)
+        )
+        replica["pending"] = {}
+        replica["in_flight"] = asyncio.Semaphore(
+            self.metadata.services[service_id].max_in_flight
         )
-        self.services[service_id]["in_queue"] = asyncio.Queue()
-        self.services[service_id]["out_queue"] = asyncio.Queue()
         loop = asyncio.get_event_loop()
         loop.create_task(
-            self.confirm_state_coroutine(service_id),
-            name=f"confirm_state_coroutine_{service_id}",
+            self.confirm_state_coroutine(service_id, replica_idx),
+            name=f"confirm_state_coroutine_{service_id}_{replica_idx}",
         )
 
-    async def confirm_state_coroutine(self, service_id):
-        """Confirm the state of the service."""
+    async def confirm_state_coroutine(self, service_id, replica_idx=0):
+        """Confirm the state of the service replica."""
         request = json.dumps({"jsonrpc": "2.0", "method": "status", "id": 1})
-        socket = self.services[service_id]["socket"]
-        logger.info(f"Confirming state of {service_id}")
+        replica = self.services[service_id]["replicas"][replica_idx]
+        socket = replica["socket"]
+        logger.info(f"Confirming state of {service_id} (replica {replica_idx})")
         try:
-            await socket.send_string(request)
+            await socket.send_multipart([b"", b"status", request.encode("utf-8")])
         except zmq.Again:
-            self.services[service_id]["state"] = ServiceState.STARTING
+            replica["state"] = ServiceState.STARTING
             logger.warning(f"{service_id} is not responding.")
             await asyncio.sleep(1)
-            await self.confirm_state_coroutine(service_id)
+            await self.confirm_state_coroutine(service_id, replica_idx)
             return
 
-        logger.info(f"Waiting for state of {service_id}")
+        logger.info(f"Waiting for state of {service_id} (replica {replica_idx})")
         response = None
         while response is None:
             try:
-                response = await socket.recv_string()
+                _, request_id, response = await socket.recv_multipart()
             except zmq.Again:
-                self.services[service_id]["state"] = ServiceState.STARTING
+                replica["state"] = ServiceState.STARTING
                 logger.warning(f"{service_id} is not responding.")
                 await asyncio.sleep(1)
                 continue
+            if request_id != b"status":
+                response = None
 
         resp_dict = json.loads(response)
         if resp_dict["result"] == ServiceState.RUNNING:
-            logger.info(f"{service_id} is running")
-            self.services[service_id]["state"] = ServiceState.RUNNING
-            self.services[service_id]["dispatch_coroutine"] = asyncio.create_task(
-                self.message_dispatch_coroutine(service_id),
-                name=f"confirm_state_coroutine_{service_id}",
+            logger.info(f"{service_id} (replica {replica_idx}) is running")
+            replica["state"] = ServiceState.RUNNING
+            replica["dispatch_coroutine"] = asyncio.create_task(
+                self.message_dispatch_coroutine(service_id, replica_idx),
+                name=f"message_dispatch_coroutine_{service_id}_{replica_idx}",
             )
         elif resp_dict["result"] == ServiceState.STARTING:
             logger.info(f"Service {service_id} responds but still starting")
             await asyncio.sleep(1)
-            await self.confirm_state_coroutine(service_id)
+            await self.confirm_state_coroutine(service_id, replica_idx)
         else:
             logger.warning(
                 f"Service {service_id} failed to start and returned incorrect state."
             )
-            self.services[service_id]["state"] = ServiceState.ERROR
+            replica["state"] = ServiceState.ERROR
 
-    async def message_dispatch_coroutine(self, service_id: str):
-        """Dispatch messages from the service."""
+    async def message_dispatch_coroutine(self, service_id: str, replica_idx: int = 0):
+        """Dispatch replies from the service replica to the waiting callers."""
+        replica = self.services[service_id]["replicas"][replica_idx]
         try:
-            while self.services[service_id]["state"] == ServiceState.RUNNING:
-                request = await self.services[service_id]["in_queue"].get()
-                logger.info(f"Dispatching message {request} to {service_id}")
-                await self.services[service_id]["socket"].send_string(request)
-                response = await self.services[service_id]["socket"].recv_string()
+            while replica["state"] == ServiceState.RUNNING:
+                try:
+                    _, request_id, response, *buffers = await replica[
+                        "socket"
+                    ].recv_multipart(copy=False)
+                except zmq.Again:
+                    if not replica["process"].is_alive():
+                        logger.error(
+                            f"Error in service {service_id}. Replica process is not alive."
+                        )
+                        self.fail_replica(service_id, replica_idx)
+                    continue
+                request_id = request_id.bytes
+                response = response.bytes.decode("utf-8")
                 logger.info(f"Received response {response} from {service_id}")
-                self.services[service_id]["out_queue"].put_nowait(response)
+                future = replica["pending"].get(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((response, buffers))
+                else:
+                    logger.warning(
+                        f"Dropping response {request_id} from {service_id}: caller is gone"
+                    )
         except RuntimeError as e:
             if e.args[0] == "Event loop is closed":
                 logger.info(f"{service_id} is shutting down")
@@ -242,15 +425,47 @@ class ControlService:
         """Stop the service."""
         service_id = self.metadata.resolve_service(service_id, None)
         self.check_service(service_id)
-        if self.services[service_id]["state"] != ServiceState.RUNNING:
+        if self._get_state(service_id) != ServiceState.RUNNING:
             raise ValueError(f"Service {service_id} is not running")
-        self.services[service_id]["socket"].close()
-        self.services[service_id]["socket"] = None
-        self.services[service_id]["process"].terminate()
-        self.services[service_id]["process"] = None
-        self.services[service_id]["state"] = ServiceState.STOPPED
-        self.services[service_id]["dispatch_coroutine"].cancel()
-        self.services[service_id]["dispatch_coroutine"] = None
+        for replica_idx in range(len(self.services[service_id]["replicas"])):
+            self.stop_replica(service_id, replica_idx)
+
+    def stop_replica(self, service_id: str, replica_idx: int):
+        """Stop the service replica and fail requests waiting for it."""
+        replica = self.services[service_id]["replicas"][replica_idx]
+        if replica["socket"] is not None:
+            replica["socket"].close()
+            replica["socket"] = None
+        if replica["process"] is not None:
+            replica["process"].terminate()
+            replica["process"] = None
+        replica["state"] = ServiceState.STOPPED
+        self._fail_pending(replica, f"Service {service_id} was stopped")
+
+    def fail_replica(self, service_id: str, replica_idx: int):
+        """Mark the replica as errored and fail requests waiting for it."""
+        replica = self.services[service_id]["replicas"][replica_idx]
+        replica["state"] = ServiceState.ERROR
+        self._fail_pending(
+            replica, f"Service {service_id} replica {replica_idx} process died"
+        )
+        if replica["socket"] is not None:
+            replica["socket"].close()
+            replica["socket"] = None
+
+    @staticmethod
+    def _fail_pending(replica: Dict[str, Any], message: str):
+        """Stop replica's dispatch coroutine and fail requests waiting for replies."""
+        dispatch_coroutine = replica["dispatch_coroutine"]
+        replica["dispatch_coroutine"] = None
+        if dispatch_coroutine is not None and dispatch_coroutine is not (
+            asyncio.current_task()
+        ):
+            dispatch_coroutine.cancel()
+        for future in replica["pending"].values():
+            if not future.done():
+                future.set_exception(ValueError(message))
+        replica["pending"] = {}
 
     def restart_service(self, service_id):
         """Restart the service."""
@@ -12,7 +12,17 @@ from npc_engine.server.utils import build_ipc_uri
 
 ServiceDescriptor = namedtuple(
     "ServiceDescriptor",
-    ["id", "type", "path", "uri", "api_name", "api_methods", "dependencies"],
+    [
+        "id",
+        "type",
+        "path",
+        "uri",
+        "api_name",
+        "api_methods",
+        "dependencies",
+        "max_in_flight",
+        "replicas",
+    ],
 )
 
 
@@ -46,6 +56,10 @@ class MetadataManager:
 
         return service_id
 
+    def get_replica_uri(self, service_id: str, replica: int = 0) -> str:
+        """Build uri of the service replica."""
+        return f"{self.services[service_id].uri}_{replica}"
+
     def get_services_metadata(self):
         """List the models in the folder."""
         return [self.get_metadata(service) for service in self.services]
@@ -121,6 +135,8 @@ class MetadataManager:
                     api_name=cls.get_api_name(),
                     api_methods=cls.API_METHODS,
                     dependencies=[],
+                    max_in_flight=config_dict.get("max_in_flight", 4),
+                    replicas=config_dict.get("replicas", 1),
                 )
 
         return svcs
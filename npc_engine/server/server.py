@@ -12,9 +12,15 @@ import traceback as tb
 
 from npc_engine.server.control_service import ControlService
 from npc_engine.server.metadata_manager import MetadataManager
-from aiohttp import web
+from typing import List
+from aiohttp import web, MultipartWriter
+from aiohttp.hdrs import CONTENT_TYPE
 
-from npc_engine.server.utils import build_ipc_uri
+from npc_engine.server.utils import (
+    BINARY_CONTENT_TYPE,
+    BINARY_FRAME,
+    build_ipc_uri,
+)
 
 
 class BaseServer(ABC):
@@ -52,13 +58,18 @@ class BaseServer(ABC):
         pass
 
     async def msg_loop(self, socket: zmq.asyncio.Socket):
-        """Asynchoriniously handle a request and reply."""
+        """Asynchoriniously handle a request and reply.
+
+        Requests with an extra `binary` frame get numpy arrays
+        from the result as additional raw frames of the reply.
+        """
         while True:
-            address = await socket.recv()
-            _ = await socket.recv()
-            message = await socket.recv_string()
+            address, _, message, *flags = await socket.recv_multipart()
+            message = message.decode("utf-8")
             logger.trace(f"Received request to {address}: {message}")
-            asyncio.create_task(self.handle_reply(socket, address, message))
+            asyncio.create_task(
+                self.handle_reply(socket, address, message, BINARY_FRAME in flags)
+            )
 
     async def interrupt_loop(self):
         """Handle interrupts loop."""
@@ -71,7 +82,9 @@ class BaseServer(ABC):
         for service in self.service_manager.services:
             self.service_manager.start_service(service)
 
-    async def handle_reply(self, socket, address: str, message: str):
+    async def handle_reply(
+        self, socket, address: str, message: str, binary: bool = False
+    ):
         """Handle message and reply."""
         logging.info("Handling reply")
         start = time.time()
@@ -79,8 +92,15 @@ class BaseServer(ABC):
             address_str = address.decode("utf-8")
         except UnicodeDecodeError:
             address_str = address.hex()
+        buffers = []
         try:
-            response = await self.service_manager.handle_request(address_str, message)
+            if binary:
+                handler = self.service_manager.handle_binary_request
+                response, buffers = await handler(address_str, message)
+            else:
+                response = await self.service_manager.handle_request(
+                    address_str, message
+                )
         except Exception as e:
             response = {
                 "code": -32000,
@@ -96,9 +116,9 @@ class BaseServer(ABC):
         logger.info("Message reply: %s" % (response))
 
         #  Send reply back to client
-        await socket.send(address, zmq.SNDMORE)
-        await socket.send_string("", zmq.SNDMORE)
-        await socket.send_string(response)
+        await socket.send_multipart(
+            [address, b"", response.encode("utf-8"), *buffers], copy=False
+        )
 
 
 class ZMQServer(BaseServer):
@@ -183,12 +203,23 @@ class HTTPServer(BaseServer):
         web.run_app(self.app, host=self.metadata.host, port=int(self.metadata.port))
 
     async def handle_request(self, request):
-        """Handle request."""
+        """Handle request.
+
+        If request accepts `multipart/mixed` content type, numpy arrays from the result
+        are sent as additional `application/octet-stream` parts of the response.
+        """
+        buffers = None
         try:
             address = request.match_info.get("name", "xxxxxxxxxxxx")
             message = await request.text()
             logger.trace(f"Received request to {address}: {message}")
-            response = await self.service_manager.handle_request(address, message)
+            if BINARY_CONTENT_TYPE in request.headers.get("Accept", ""):
+                (
+                    response,
+                    buffers,
+                ) = await self.service_manager.handle_binary_request(address, message)
+            else:
+                response = await self.service_manager.handle_request(address, message)
         except Exception as e:
             response = {
                 "code": -32000,
@@ -198,4 +229,22 @@ class HTTPServer(BaseServer):
                 else None,
             }
             response = json.dumps(response)
+        if buffers is not None:
+            return await self.multipart_response(request, response, buffers)
         return web.json_response(text=response)
+
+    async def multipart_response(
+        self, request, response: str, buffers: List[zmq.Frame]
+    ) -> web.StreamResponse:
+        """Stream json response followed by binary parts."""
+        with MultipartWriter("mixed") as writer:
+            writer.append(response, {CONTENT_TYPE: "application/json"})
+            for buffer in buffers:
+                writer.append(buffer.buffer, {CONTENT_TYPE: "application/octet-stream"})
+        stream = web.StreamResponse(
+            headers={CONTENT_TYPE: writer.headers[CONTENT_TYPE]}
+        )
+        await stream.prepare(request)
+        await writer.write(stream)
+        await stream.write_eof()
+        return stream
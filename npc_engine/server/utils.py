@@ -1,10 +1,18 @@
 """Utility functions for RPC communication."""
-from typing import Any, Dict, Callable
+from typing import Any, Dict, Callable, List, Tuple
+import json
 import os
 import subprocess
 
+import numpy as np
 from platformdirs import user_cache_dir
 
+#: Extra request frame (or HTTP Accept type) that asks for binary side channel in the reply.
+BINARY_FRAME = b"binary"
+BINARY_CONTENT_TYPE = "multipart/mixed"
+#: Key of the placeholder that replaces numpy arrays in binary replies.
+BINARY_KEY = "__binary__"
+
 
 def schema_to_json(
     s: Dict[str, Any], fill_value: Callable[[str], Any] = lambda _: ""
@@ -44,3 +52,68 @@ def start_test_server(port: str, models_path: str):  # pragma: no cover
 def build_ipc_uri(service_id: str) -> str:
     """Build ipc uri for the given service."""
     return f"ipc://{os.path.join(user_cache_dir('npc-engine'), service_id)}"
+
+
+def encode_response(
+    response: Dict[str, Any], binary: bool = False
+) -> Tuple[str, List[memoryview]]:
+    """Serialize json rpc response converting numpy arrays in the result.
+
+    If binary is False arrays are converted to lists.
+    Otherwise they are replaced with placeholders
+    `{"__binary__": index, "dtype": dtype, "shape": shape}`
+    and their little-endian buffers are returned separately without copying
+    (unless the array is not contiguous or not little-endian).
+
+    Args:
+        response: Json rpc response dict.
+        binary: Whether to move arrays to binary buffers.
+
+    Returns:
+        Json string and list of buffers.
+    """
+    buffers = []
+
+    def encode(value):
+        if isinstance(value, np.ndarray):
+            if not binary:
+                return value.tolist()
+            value = np.ascontiguousarray(value, dtype=value.dtype.newbyteorder("<"))
+            buffers.append(memoryview(value).cast("B"))
+            return {
+                BINARY_KEY: len(buffers) - 1,
+                "dtype": value.dtype.str,
+                "shape": list(value.shape),
+            }
+        elif isinstance(value, dict):
+            return {k: encode(v) for k, v in value.items()}
+        elif isinstance(value, (list, tuple)):
+            return [encode(v) for v in value]
+        elif isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    return json.dumps(encode(response)), buffers
+
+
+def decode_binary(value: Any, buffers: List[Any]) -> Any:
+    """Replace binary placeholders in the decoded json with numpy arrays.
+
+    Arrays are read-only views of the buffers.
+
+    Args:
+        value: Decoded json rpc result.
+        buffers: Buffers received with the reply.
+
+    Returns:
+        Result with numpy arrays.
+    """
+    if isinstance(value, dict):
+        if BINARY_KEY in value:
+            return np.frombuffer(
+                buffers[value[BINARY_KEY]], dtype=np.dtype(value["dtype"])
+            ).reshape(value["shape"])
+        return {k: decode_binary(v, buffers) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [decode_binary(v, buffers) for v in value]
+    return value
@@ -1,6 +1,6 @@
 """Control interface client implementation."""
 import zmq
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Union
 from npc_engine.service_clients.service_client import ServiceClient
 
 
@@ -31,13 +31,20 @@ class ControlClient(ServiceClient):
         }
         self.send_request(request)
 
-    def get_service_status(self, service_id) -> str:
-        """Send a get service status request to the server."""
+    def get_service_status(
+        self, service_id, per_replica: bool = False
+    ) -> Union[str, List[str]]:
+        """Send a get service status request to the server.
+
+        Args:
+            service_id: Id of the service.
+            per_replica: Return list of statuses for each replica of the service.
+        """
         request = {
             "jsonrpc": "2.0",
             "method": "get_service_status",
             "id": 0,
-            "params": [service_id],
+            "params": [service_id, per_replica],
         }
         return self.send_request(request)
 
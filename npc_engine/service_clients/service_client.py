@@ -1,12 +1,13 @@
 """Module that implements ZMQ base client communication over JSON-RPC 2.0 (https://www.jsonrpc.org/specification)."""
 from typing import Any, Dict
+import json
 import zmq
 import zmq.asyncio
 from abc import ABC, abstractclassmethod
 
 from loguru import logger
 
-from npc_engine.server.utils import build_ipc_uri
+from npc_engine.server.utils import BINARY_FRAME, build_ipc_uri, decode_binary
 
 
 class ServiceClient(ABC):
@@ -33,20 +34,32 @@ class ServiceClient(ABC):
         self.socket.connect(build_ipc_uri("self"))
         logger.info("Connected to server")
 
-    def send_request(self, request: Dict[str, Any]) -> Any:
+    def send_request(self, request: Dict[str, Any], binary: bool = False) -> Any:
         """Send request to the server and return the response.
 
         Args:
             request: The request to send to the server.
+            binary: Receive numpy arrays from the result as raw buffers
+                instead of json lists.
 
         Returns:
             The result from the server.
         """
         logger.trace(f"Sending request: {request}")
-        self.socket.send_json(request)
-        response = self.socket.recv_json()
+        if binary:
+            self.socket.send_multipart(
+                [json.dumps(request).encode("utf-8"), BINARY_FRAME]
+            )
+            response, *buffers = self.socket.recv_multipart(copy=False)
+            response = json.loads(response.bytes)
+            buffers = [buffer.buffer for buffer in buffers]
+        else:
+            self.socket.send_json(request)
+            response = self.socket.recv_json()
         logger.trace(f"Received response: {response}")
         if "result" in response:
+            if binary:
+                return decode_binary(response["result"], buffers)
             return response["result"]
         elif "code" in response:
             raise RuntimeError(f"code: {response['code']}. {response['message']}")
@@ -1,5 +1,5 @@
 """Huggingface semantic similarity interface client implementation."""
-from typing import List
+from typing import Any, Dict, List
 import zmq
 from npc_engine.service_clients.service_client import ServiceClient
 
@@ -27,6 +27,58 @@ class SimilarityClient(ServiceClient):
         reply = self.send_request(request)
         return reply
 
+    def add_corpus(self, name: str, lines: List[str]) -> int:
+        """Register a named corpus of sentences on the server.
+
+        Args:
+            name: Name of the corpus.
+            lines: A list of sentences.
+        """
+        request = {
+            "jsonrpc": "2.0",
+            "method": "add_corpus",
+            "id": 0,
+            "params": [name, lines],
+        }
+        reply = self.send_request(request)
+        return reply
+
+    def extend_corpus(self, name: str, lines: List[str]) -> int:
+        """Add sentences to a named corpus on the server.
+
+        Args:
+            name: Name of the corpus.
+            lines: A list of sentences.
+        """
+        request = {
+            "jsonrpc": "2.0",
+            "method": "extend_corpus",
+            "id": 0,
+            "params": [name, lines],
+        }
+        reply = self.send_request(request)
+        return reply
+
+    def search_corpus(
+        self, name: str, query: str, top_k: int = 5, threshold: float = None
+    ) -> Dict[str, List[Any]]:
+        """Find sentences of a named corpus that are the most similar to the query.
+
+        Args:
+            name: Name of the corpus.
+            query: A string to compute similarity with the corpus.
+            top_k: Maximum number of sentences to return. All if None.
+            threshold: If not none only sentences with similarity above it are returned.
+        """
+        request = {
+            "jsonrpc": "2.0",
+            "method": "search_corpus",
+            "id": 0,
+            "params": [name, query, top_k, threshold],
+        }
+        reply = self.send_request(request)
+        return reply
+
     @classmethod
     def get_api_name(cls) -> str:
         """Return the name of the API."""
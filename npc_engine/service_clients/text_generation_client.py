@@ -11,21 +11,59 @@ class TextGenerationClient(ServiceClient):
         """Connect to the server on the port."""
         super().__init__(zmq_context, service_id)
 
-    def generate_reply(self, context: Dict[str, Any]) -> str:
+    def generate_reply(self, context: Dict[str, Any], **kwargs) -> str:
         """Send a chatbot request to the server.
 
         Args:
             context: A dictionary containing the chatbot request.
+            **kwargs: Generation parameters, e.g. `temperature`, `topk`,
+                `max_new_tokens`, `stop` and `deadline_ms`.
         """
         request = {
             "jsonrpc": "2.0",
             "method": "generate_reply",
             "id": 0,
-            "params": [context],
+            "params": {"context": context, **kwargs},
         }
         reply = self.send_request(request)
         return reply
 
+    def generate_reply_start(self, context: Dict[str, Any], **kwargs) -> str:
+        """Start streaming generation of the reply.
+
+        Args:
+            context: A dictionary containing the chatbot request.
+            **kwargs: Generation parameters, e.g. `temperature`, `topk`,
+                `max_new_tokens`, `stop` and `deadline_ms`.
+
+        Returns:
+            Id of the stream to poll with `generate_reply_get_results`.
+        """
+        request = {
+            "jsonrpc": "2.0",
+            "method": "generate_reply_start",
+            "id": 0,
+            "params": {"context": context, **kwargs},
+        }
+        return self.send_request(request)
+
+    def generate_reply_get_results(self, stream_id: str) -> Dict[str, Any]:
+        """Retrieve the next piece of the streamed reply.
+
+        Args:
+            stream_id: Id returned by `generate_reply_start`.
+
+        Returns:
+            Dict with `text` delta and `finished` flag.
+        """
+        request = {
+            "jsonrpc": "2.0",
+            "method": "generate_reply_get_results",
+            "id": 0,
+            "params": [stream_id],
+        }
+        return self.send_request(request)
+
     def get_prompt_template(self) -> str:
         """Send a chatbot request to the server."""
         request = {
@@ -56,6 +94,16 @@ class TextGenerationClient(ServiceClient):
         }
         return self.send_request(request)
 
+    def get_metrics(self) -> Dict[str, Any]:
+        """Get runtime metrics of the model, e.g. cache hit rates."""
+        request = {
+            "jsonrpc": "2.0",
+            "method": "get_metrics",
+            "id": 0,
+            "params": [],
+        }
+        return self.send_request(request)
+
     @classmethod
     def get_api_name(cls) -> str:
         """Return the name of the API."""
@@ -1,25 +1,49 @@
 """Module with Model base class."""
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, List
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+import inspect
+import json
 import os
+import time
 import zmq
 import onnxruntime as rt
 from loguru import logger
 from jsonrpc import JSONRPCResponseManager, Dispatcher
+from jsonrpc.exceptions import JSONRPCServerError
+from jsonrpc.jsonrpc2 import JSONRPC20Response
 from pathlib import Path
 from npc_engine.service_clients.control_client import ControlClient
+from npc_engine.server.utils import BINARY_FRAME, encode_response
 from npc_engine.services.factory_mixin import FactoryMixin
 
 
+class ScheduledJob(NamedTuple):
+    """Job id of a request scheduled for iterative execution."""
+
+    job_id: Any
+    request_id: Any
+
+
 class BaseService(FactoryMixin, ABC):
     """Abstract base class for managed services."""
 
+    #: Mapping from API methods to their batched implementations.
+    #: Batched implementation accepts a list of bound arguments dicts and returns a list of results.
+    BATCHED_METHODS: Dict[str, str] = {}
+
+    #: Mapping from API methods to implementations that schedule them for iterative execution.
+    #: Scheduling implementation accepts the same arguments and returns a job id.
+    #: Scheduled jobs are advanced with `step_scheduled` between receiving requests.
+    SCHEDULED_METHODS: Dict[str, str] = {}
+
     def __init__(
         self,
         service_id: str,
         context: zmq.Context,
         uri: str,
         providers: List[str] = None,
+        max_batch_size: int = 1,
+        batch_window_ms: float = 0,
         *args,
         **kwargs,
     ):
@@ -29,10 +53,13 @@ class BaseService(FactoryMixin, ABC):
             context (zmq.Context): ZMQ context
             uri (str): URI to serve requests to
             dependency_clients (list(ServiceClient)): List of dependency clients
+            max_batch_size: Maximum number of requests to collect into one batch.
+                Batching is disabled if it's 1.
+            batch_window_ms: Time to wait for more requests after receiving the first one.
         """
         super(BaseService, self).__init__()
         self.zmq_context = context
-        self.socket = context.socket(zmq.REP)
+        self.socket = context.socket(zmq.ROUTER)
         self.socket.setsockopt(zmq.LINGER, 0)
         logger.info(f"Service {service_id} binding to {uri}")
         if uri.startswith("ipc://"):
@@ -41,6 +68,10 @@ class BaseService(FactoryMixin, ABC):
         self.socket.bind(uri)
         self.service_id = service_id
         self.control_client = None
+        self.max_batch_size = max_batch_size
+        self.batch_window_ms = batch_window_ms
+        self.scheduled_methods = dict(type(self).SCHEDULED_METHODS)
+        self.scheduled_requests = {}
         self._set_and_validate_providers(providers)
 
     @classmethod
@@ -67,19 +98,38 @@ class BaseService(FactoryMixin, ABC):
         return ControlClient.get_api_client(api_name)(self.zmq_context, name)
 
     def loop(self):
-        """Run service main loop that accepts json rpc."""
+        """Run service main loop that accepts json rpc.
+
+        Requests arrive as `[address, "", request_id, request]` frames
+        and replies are sent back with the same envelope so that
+        control service can correlate them.
+        If request has an extra `binary` frame, numpy arrays from the result
+        are sent as additional raw frames after the reply.
+        """
         try:
             dispatcher = Dispatcher()
             dispatcher.update(self.build_api_dict())
             dispatcher.update({"status": self.status})
             while True:
-                logger.info(f"{self.service_id} waiting for request")
-                request = self.socket.recv_string()
-                logger.info(f"{self.service_id} received request {request}")
-                response = JSONRPCResponseManager.handle(request, dispatcher)
-                logger.info(f"{self.service_id} sending response {response.json}")
-                self.socket.send_string(response.json)
-                logger.info(f"{self.service_id} response sent")
+                if len(self.scheduled_requests) == 0:
+                    logger.info(f"{self.service_id} waiting for request")
+                messages = self.receive_messages(
+                    block=len(self.scheduled_requests) == 0
+                )
+                requests = [message[3].decode("utf-8") for message in messages]
+                if len(requests) > 0:
+                    logger.info(f"{self.service_id} received requests {requests}")
+                responses = self.handle_requests(requests, dispatcher)
+                for message, response in zip(messages, responses):
+                    if isinstance(response, ScheduledJob):
+                        self.scheduled_requests[response.job_id] = (
+                            message,
+                            response.request_id,
+                        )
+                    else:
+                        self.send_response(message, response)
+                if len(self.scheduled_requests) > 0:
+                    self.handle_scheduled()
         except Exception as e:
             logger.exception(e)
             raise e
@@ -87,6 +137,188 @@ class BaseService(FactoryMixin, ABC):
             self.socket.close()
             self.zmq_context.destroy()
 
+    def send_response(self, message: List[bytes], response: Dict[str, Any]):
+        """Send json rpc response to the request message.
+
+        Args:
+            message: Request frames `[address, "", request_id, request, *flags]`
+            response: json rpc response dict
+        """
+        address, _, request_id = message[:3]
+        response, buffers = encode_response(response, BINARY_FRAME in message[4:])
+        logger.info(f"{self.service_id} sending response {response}")
+        self.socket.send_multipart(
+            [address, b"", request_id, response.encode("utf-8"), *buffers],
+            copy=False,
+        )
+        logger.info(f"{self.service_id} response sent")
+
+    def handle_scheduled(self):
+        """Advance scheduled jobs by one iteration and reply to the finished ones."""
+        try:
+            finished = self.step_scheduled()
+        except Exception as e:
+            logger.exception(e)
+            finished = [(job_id, e) for job_id in self.scheduled_requests]
+        for job_id, result in finished:
+            message, request_id = self.scheduled_requests.pop(job_id)
+            if isinstance(result, Exception):
+                error = JSONRPCServerError(
+                    data={
+                        "type": type(result).__name__,
+                        "args": result.args,
+                        "message": str(result),
+                    }
+                )
+                response = JSONRPC20Response(_id=request_id, error=error._data).data
+            else:
+                response = JSONRPC20Response(_id=request_id, result=result).data
+            self.send_response(message, response)
+
+    def step_scheduled(self) -> List[Tuple[Any, Any]]:
+        """Advance scheduled jobs by one iteration.
+
+        To be implemented by services that define `SCHEDULED_METHODS`.
+
+        Returns:
+            List of (job id, result) for jobs that finished.
+            Result can be an exception if the job failed.
+        """
+        return []
+
+    def receive_messages(self, block: bool = True) -> List[List[bytes]]:
+        """Receive next request and collect more if batching is enabled.
+
+        Args:
+            block: Wait for the first request. If False only already queued requests are received.
+
+        Returns:
+            List of `[address, "", request_id, request]` frames
+        """
+        if not block and not self.socket.poll(0):
+            return []
+        messages = [self.socket.recv_multipart()]
+        deadline = time.monotonic() + self.batch_window_ms / 1000
+        while len(messages) < self.max_batch_size:
+            timeout = max(deadline - time.monotonic(), 0)
+            if not self.socket.poll(int(timeout * 1000)):
+                break
+            messages.append(self.socket.recv_multipart())
+        return messages
+
+    def handle_requests(
+        self, requests: List[str], dispatcher: Dispatcher
+    ) -> List[Dict[str, Any]]:
+        """Handle json rpc requests batching the ones that support it.
+
+        Requests to the same method from `BATCHED_METHODS`
+        are handled with a single call to it's batched implementation.
+        Other requests are handled one by one.
+
+        Args:
+            requests: json rpc request strings
+            dispatcher: dispatcher with the API methods
+
+        Returns:
+            json rpc response dicts in the order of requests
+            or `ScheduledJob` for requests scheduled for iterative execution
+        """
+        responses = [None] * len(requests)
+        batches = {}
+        for idx, request in enumerate(requests):
+            scheduled = self._schedule(request)
+            if scheduled is not None:
+                responses[idx] = scheduled
+                continue
+            parsed = self._parse_batchable(request)
+            if parsed is not None:
+                method, request_id, arguments = parsed
+                batches.setdefault(method, []).append((idx, request_id, arguments))
+            else:
+                responses[idx] = JSONRPCResponseManager.handle(request, dispatcher).data
+        for method, batch in batches.items():
+            if len(batch) > 1:
+                results = self._run_batch(method, batch)
+            else:
+                results = None
+            if results is None:
+                for idx, _, _ in batch:
+                    responses[idx] = JSONRPCResponseManager.handle(
+                        requests[idx], dispatcher
+                    ).data
+            else:
+                for (idx, request_id, _), result in zip(batch, results):
+                    responses[idx] = JSONRPC20Response(
+                        _id=request_id, result=result
+                    ).data
+        return responses
+
+    def _schedule(self, request: str) -> Optional["ScheduledJob"]:
+        """Schedule request if it's method supports iterative execution."""
+        parsed = self._parse_request(request, self.scheduled_methods, True)
+        if parsed is None:
+            return None
+        method, request_id, arguments = parsed
+        try:
+            job_id = getattr(self, self.scheduled_methods[method])(**arguments)
+        except Exception as e:
+            logger.warning(f"Scheduling {method} failed, handling it directly: {e}")
+            return None
+        return ScheduledJob(job_id, request_id)
+
+    def _parse_batchable(
+        self, request: str
+    ) -> Optional[Tuple[str, Any, Dict[str, Any]]]:
+        """Parse request into (method, id, arguments) if it can be batched."""
+        return self._parse_request(request, type(self).BATCHED_METHODS)
+
+    def _parse_request(
+        self, request: str, methods: Dict[str, str], bind_implementation=False
+    ) -> Optional[Tuple[str, Any, Dict[str, Any]]]:
+        """Parse request into (method, id, arguments) if it's method is in methods.
+
+        Arguments are bound to the signature of the API method
+        or of it's implementation from methods if `bind_implementation` is set.
+        """
+        try:
+            request_dict = json.loads(request)
+            method = request_dict["method"]
+            if method not in methods or "id" not in request_dict:
+                return None
+            params = request_dict.get("params", [])
+            signature = inspect.signature(
+                getattr(self, methods[method] if bind_implementation else method)
+            )
+            if isinstance(params, dict):
+                bound = signature.bind(**params)
+            else:
+                bound = signature.bind(*params)
+        except (ValueError, KeyError, TypeError):
+            return None
+        bound.apply_defaults()
+        return method, request_dict["id"], dict(bound.arguments)
+
+    def _run_batch(
+        self, method: str, batch: List[Tuple[int, Any, Dict[str, Any]]]
+    ) -> Optional[List[Any]]:
+        """Run batched implementation of the method.
+
+        Returns:
+            List of results or None if batched call failed.
+        """
+        batched_method = getattr(self, type(self).BATCHED_METHODS[method])
+        try:
+            results = batched_method([arguments for _, _, arguments in batch])
+        except Exception as e:
+            logger.warning(
+                f"Batched {method} call failed, handling requests one by one: {e}"
+            )
+            return None
+        logger.info(
+            f"{self.service_id} handled {len(batch)} {method} requests in a batch"
+        )
+        return results
+
     def status(self):
         """Return status of the service.
 
@@ -1,5 +1,5 @@
 """Module that implements sequence classification API."""
-from typing import List
+from typing import Any, Dict, List
 
 from abc import abstractmethod
 from npc_engine.services.base_service import BaseService
@@ -11,6 +11,7 @@ class SequenceClassifierAPI(BaseService):
     """Abstract base class for text classification models."""
 
     API_METHODS: List[str] = ["classify"]
+    BATCHED_METHODS: Dict[str, str] = {"classify": "classify_batch"}
 
     def __init__(self, cache_size=0, *args, **kwargs) -> None:
         """Empty initialization method for API to be similar to other model base classes."""
@@ -38,6 +39,31 @@ class SequenceClassifierAPI(BaseService):
         )
         return scores.tolist()
 
+    def classify_batch(self, requests: List[Dict[str, Any]]) -> List[List[List[float]]]:
+        """Classify texts from several requests in a single batch.
+
+        Args:
+            requests: List of `classify` arguments dicts with `texts` key.
+
+        Returns:
+            List of scores for each request.
+        """
+        texts = [
+            row if isinstance(row, str) else tuple(row)
+            for request in requests
+            for row in request["texts"]
+        ]
+        scores = self.cache.cache_compute(
+            texts, lambda values: self.compute_scores_batch(values)
+        )
+        results = []
+        start = 0
+        for request in requests:
+            end = start + len(request["texts"])
+            results.append(scores[start:end].tolist())
+            start = end
+        return results
+
     @abstractmethod
     def compute_scores_batch(self, texts: List[str]) -> np.ndarray:
         """Compute scores for a list of texts.
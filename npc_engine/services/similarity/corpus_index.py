@@ -0,0 +1,298 @@
+"""Search indices for named similarity corpora."""
+from typing import Callable, Dict, Tuple
+import os
+
+import numpy as np
+
+
+ScoreFunction = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+
+class ExactCorpusIndex:
+    """Brute force search over a contiguous embedding matrix.
+
+    Every embedding is scored against the query so results are exact.
+    """
+
+    kind = "exact"
+
+    def __init__(self, score_fn: ScoreFunction):
+        """Create empty index.
+
+        Args:
+            score_fn: Function that computes similarities of a query embedding
+                of shape (1, embedding_size) to embeddings of shape (n, embedding_size).
+        """
+        self.score_fn = score_fn
+        self.embeddings = None
+
+    def __len__(self) -> int:
+        """Return number of indexed embeddings."""
+        return 0 if self.embeddings is None else len(self.embeddings)
+
+    def add(self, embeddings: np.ndarray):
+        """Add embeddings to the end of the index.
+
+        Args:
+            embeddings: Embeddings of shape (batch_size, embedding_size)
+        """
+        if self.embeddings is None:
+            self.embeddings = np.ascontiguousarray(embeddings)
+        else:
+            self.embeddings = np.ascontiguousarray(
+                np.concatenate([self.embeddings, embeddings])
+            )
+
+    def search(
+        self, query: np.ndarray, top_k: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the most similar embeddings.
+
+        Args:
+            query: Query embedding of shape (1, embedding_size)
+            top_k: Maximum number of results. All if None.
+
+        Returns:
+            (Indices of the embeddings, their similarities) sorted from the most similar.
+        """
+        if len(self) == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0])
+        return self._top_k(np.arange(len(self)), self.embeddings, query, top_k)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """Return arrays to save the index with."""
+        return {"embeddings": self.embeddings}
+
+    def load_state(self, state: Dict[str, np.ndarray]):
+        """Restore the index from the saved arrays."""
+        self.embeddings = state.get("embeddings")
+
+    def save(self, path: str, **metadata: str):
+        """Save the index to `.npz` file.
+
+        File is written to a temporary path first and then moved into place
+        so that other processes never read a partially written index.
+
+        Args:
+            path: Path to the file.
+            **metadata: Strings to save with the index.
+        """
+        state = {k: v for k, v in self.state().items() if v is not None}
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, kind=self.kind, **metadata, **state)
+        os.replace(tmp_path, path)
+
+    def _top_k(
+        self,
+        indices: np.ndarray,
+        embeddings: np.ndarray,
+        query: np.ndarray,
+        top_k: int = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        scores = np.asarray(self.score_fn(query, embeddings)).reshape(-1)
+        if top_k is not None and top_k < len(scores):
+            selected = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            selected = np.arange(len(scores))
+        selected = selected[np.argsort(-scores[selected], kind="stable")]
+        return indices[selected], scores[selected]
+
+
+class IVFCorpusIndex(ExactCorpusIndex):
+    """Approximate inverted file index with flat lists.
+
+    Embeddings are clustered with k-means and only the lists
+    of `nprobe` centroids most similar to the query are searched.
+    More probed lists give higher recall and slower search.
+    Index is searched exactly until it has `min_size` embeddings
+    and is retrained when it grows `retrain_factor` times since the last training.
+    New embeddings are added to the lists of their nearest centroids.
+    """
+
+    kind = "ivf"
+
+    def __init__(
+        self,
+        score_fn: ScoreFunction,
+        nlist: int = None,
+        nprobe: int = 8,
+        min_size: int = 10000,
+        retrain_factor: float = 4,
+        seed: int = 0,
+    ):
+        """Create empty index.
+
+        Args:
+            score_fn: Function that computes similarities of a query embedding
+                of shape (1, embedding_size) to embeddings of shape (n, embedding_size).
+            nlist: Number of k-means clusters. 4 * sqrt(size) if None.
+            nprobe: Number of clusters searched for each query.
+            min_size: Minimum number of embeddings to build clusters for.
+            retrain_factor: Growth of the index after which clusters are rebuilt.
+            seed: Random seed for k-means initialization.
+        """
+        super().__init__(score_fn)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_size = min_size
+        self.retrain_factor = retrain_factor
+        self.seed = seed
+        self.centroids = None
+        self.assignments = None
+        self.order = None
+        self.offsets = None
+        self.trained_size = 0
+
+    def add(self, embeddings: np.ndarray):
+        """Add embeddings to the end of the index assigning them to clusters.
+
+        Args:
+            embeddings: Embeddings of shape (batch_size, embedding_size)
+        """
+        super().add(embeddings)
+        if len(self) >= max(self.min_size, self.trained_size * self.retrain_factor, 1):
+            self.train()
+        elif self.centroids is not None:
+            self.assignments = np.concatenate(
+                [self.assignments, self._assign(embeddings)]
+            )
+            self._build_lists()
+
+    def train(self, iterations: int = 10, sample_per_list: int = 32):
+        """Cluster indexed embeddings with k-means and rebuild the lists.
+
+        Args:
+            iterations: Number of k-means iterations.
+            sample_per_list: Number of embeddings per cluster to train on.
+        """
+        rng = np.random.RandomState(self.seed)
+        nlist = self.nlist or int(4 * np.sqrt(len(self)))
+        nlist = max(1, min(nlist, len(self)))
+        sample = self.embeddings
+        if len(sample) > nlist * sample_per_list:
+            sample = sample[rng.choice(len(sample), nlist * sample_per_list, False)]
+        sample = sample.astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            self.centroids = centroids
+            assignments = self._assign(sample)
+            counts = np.bincount(assignments, minlength=nlist)
+            nonempty = counts > 0
+            order = np.argsort(assignments, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            centroids = centroids.copy()
+            centroids[nonempty] = sums / counts[nonempty, None]
+        self.centroids = centroids
+        self.assignments = self._assign(self.embeddings)
+        self.trained_size = len(self)
+        self._build_lists()
+
+    def search(
+        self, query: np.ndarray, top_k: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the most similar embeddings in the probed clusters.
+
+        Args:
+            query: Query embedding of shape (1, embedding_size)
+            top_k: Maximum number of results. All probed if None.
+
+        Returns:
+            (Indices of the embeddings, their similarities) sorted from the most similar.
+        """
+        if self.centroids is None or self.nprobe >= len(self.centroids):
+            return super().search(query, top_k)
+        centroid_scores = np.asarray(self.score_fn(query, self.centroids)).reshape(-1)
+        probed = np.argpartition(-centroid_scores, self.nprobe - 1)[: self.nprobe]
+        candidates = np.concatenate(
+            [self.order[self.offsets[c] : self.offsets[c + 1]] for c in probed]
+        )
+        return self._top_k(candidates, self.embeddings[candidates], query, top_k)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """Return arrays to save the index with."""
+        return {
+            "embeddings": self.embeddings,
+            "centroids": self.centroids,
+            "assignments": self.assignments,
+            "trained_size": np.asarray(self.trained_size),
+        }
+
+    def load_state(self, state: Dict[str, np.ndarray]):
+        """Restore the index from the saved arrays."""
+        self.embeddings = state.get("embeddings")
+        if "centroids" in state:
+            self.centroids = state["centroids"]
+            self.assignments = state["assignments"]
+            self.trained_size = int(state["trained_size"])
+            self._build_lists()
+        elif len(self) >= max(self.min_size, 1):
+            self.train()
+
+    def _assign(self, embeddings: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+        """Find the nearest centroid of each embedding by euclidean distance."""
+        centroid_norms = (self.centroids**2).sum(axis=1)
+        assignments = np.empty([len(embeddings)], dtype=np.int64)
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = embeddings[start : start + chunk_size]
+            distances = centroid_norms - 2 * chunk @ self.centroids.T
+            assignments[start : start + chunk_size] = distances.argmin(axis=1)
+        return assignments
+
+    def _build_lists(self):
+        self.order = np.argsort(self.assignments, kind="stable")
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+
+def create_corpus_index(
+    kind: str, score_fn: ScoreFunction, **params
+) -> ExactCorpusIndex:
+    """Create empty corpus index.
+
+    Args:
+        kind: `exact` or `ivf`.
+        score_fn: Function that computes similarities of a query embedding
+            of shape (1, embedding_size) to embeddings of shape (n, embedding_size).
+        **params: Parameters of the approximate index.
+
+    Returns:
+        Corpus index.
+    """
+    if kind == ExactCorpusIndex.kind:
+        return ExactCorpusIndex(score_fn)
+    if kind == IVFCorpusIndex.kind:
+        return IVFCorpusIndex(score_fn, **params)
+    raise ValueError(f"Unknown corpus index {kind}")
+
+
+def load_corpus_index(
+    path: str, kind: str, score_fn: ScoreFunction, **params
+) -> Tuple[ExactCorpusIndex, Dict[str, str]]:
+    """Load corpus index saved with `save`.
+
+    Only embeddings are reused if the index was saved with a different kind.
+
+    Args:
+        path: Path to the `.npz` file.
+        kind: `exact` or `ivf`.
+        score_fn: Function that computes similarities of a query embedding
+            of shape (1, embedding_size) to embeddings of shape (n, embedding_size).
+        **params: Parameters of the approximate index.
+
+    Returns:
+        (Corpus index, metadata it was saved with)
+    """
+    with np.load(path) as data:
+        state = {name: data[name] for name in data.files}
+    metadata = {
+        name: str(state.pop(name))
+        for name, value in list(state.items())
+        if value.ndim == 0 and value.dtype.kind == "U"
+    }
+    if metadata.pop("kind", None) != kind:
+        state = {"embeddings": state.get("embeddings")}
+    index = create_corpus_index(kind, score_fn, **params)
+    index.load_state(state)
+    return index, metadata
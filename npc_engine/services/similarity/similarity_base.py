@@ -1,22 +1,83 @@
 """Module that implements semantic similarity model API."""
-from typing import List
+from typing import Any, Dict, List
+import glob
+import hashlib
+import os
 
 from abc import abstractmethod
+from loguru import logger
 from npc_engine.services.base_service import BaseService
+from npc_engine.services.similarity.corpus_index import (
+    ExactCorpusIndex,
+    create_corpus_index,
+    load_corpus_index,
+)
 from npc_engine.services.utils.lru_cache import NumpyLRUCache
+from npc_engine.services.utils.persistent_cache import (
+    PersistentNumpyCache,
+    file_fingerprint,
+    file_lock,
+)
 import numpy as np
 
 
 class SimilarityAPI(BaseService):
     """Abstract base class for text similarity models."""
 
-    API_METHODS: List[str] = ["compare", "cache"]
+    API_METHODS: List[str] = [
+        "compare",
+        "cache",
+        "add_corpus",
+        "extend_corpus",
+        "search_corpus",
+    ]
+    BATCHED_METHODS: Dict[str, str] = {"compare": "compare_batch"}
+    CORPORA_LOCK_FILE = "corpora.lock"
 
-    def __init__(self, cache_size=0, *args, **kwargs) -> None:
-        """Empty initialization method for API to be similar to other model base classes."""
+    def __init__(
+        self,
+        cache_size=0,
+        persistent_cache=False,
+        corpus_index: str = "exact",
+        ann_nlist: int = None,
+        ann_nprobe: int = 8,
+        ann_min_size: int = 10000,
+        persistent_corpora: bool = False,
+        *args,
+        **kwargs,
+    ) -> None:
+        """Initialize embedding caches.
+
+        Args:
+            cache_size: Number of embeddings to keep in memory.
+            persistent_cache: Store computed embeddings on disk next to the model
+                so that they are not recomputed after restart.
+                Opened by the implementation with `open_persistent_cache`.
+            corpus_index: Index to search named corpora with.
+                `exact` scores every sentence,
+                `ivf` searches only clusters of sentences most similar to the query.
+            ann_nlist: Number of clusters of `ivf` index. 4 * sqrt(corpus size) if None.
+            ann_nprobe: Number of clusters `ivf` index searches.
+                More clusters give better recall and slower search.
+            ann_min_size: Corpora smaller than this are searched exactly by `ivf` index.
+            persistent_corpora: Save named corpora with their indices next to the model
+                and load them on restart.
+        """
         super().__init__(*args, **kwargs)
         self.initialized = True
         self.lru_cache = NumpyLRUCache(cache_size)
+        self.use_persistent_cache = persistent_cache
+        self.persistent_cache = None
+        self.corpus_index = corpus_index
+        self.ann_params = (
+            dict(nlist=ann_nlist, nprobe=ann_nprobe, min_size=ann_min_size)
+            if corpus_index != ExactCorpusIndex.kind
+            else {}
+        )
+        self.persistent_corpora = persistent_corpora
+        self.corpora_path = None
+        self.model_fingerprint = None
+        self.corpora: Dict[str, ExactCorpusIndex] = {}
 
     @classmethod
     def get_api_name(cls) -> str:
@@ -30,25 +91,266 @@ class SimilarityAPI(BaseService):
             query: A sentence to compare.
             context: A list of sentences to compare to. This will be cached if caching is enabled
 
+        Query and context are cached together and their missing embeddings
+        are computed in a single batch. Only context is stored in the on-disk cache.
+
         Returns:
             List of similarities
         """
-        embedding_a = self.compute_embedding(query)
-        embedding_b = self.lru_cache.cache_compute(
-            context, lambda values: self.compute_embedding_batch(values)
+        embeddings = self.lru_cache.cache_compute(
+            [query] + context, lambda values: self.embed_missing(values, context)
         )
-        similarities = self.metric(embedding_a, embedding_b)
+        similarities = self.metric(embeddings[:1], embeddings[1:])
         return similarities.tolist()
 
+    def compare_batch(self, requests: List[Dict[str, Any]]) -> List[List[float]]:
+        """Compare queries to their contexts in a single batch.
+
+        Args:
+            requests: List of `compare` arguments dicts with `query` and `context` keys.
+
+        Returns:
+            List of similarities for each request
+        """
+        queries = [request["query"] for request in requests]
+        lines = [line for request in requests for line in request["context"]]
+        embeddings = self.lru_cache.cache_compute(
+            queries + lines, lambda values: self.embed_missing(values, lines)
+        )
+        embedding_a, embedding_b = (
+            embeddings[: len(queries)],
+            embeddings[len(queries) :],
+        )
+        results = []
+        start = 0
+        for idx, request in enumerate(requests):
+            end = start + len(request["context"])
+            similarities = self.metric(
+                embedding_a[idx : idx + 1], embedding_b[start:end]
+            )
+            results.append(similarities.tolist())
+            start = end
+        return results
+
     def cache(self, context: List[str]):
         """Cache embeddings of given sequences.
 
         Args:
             context: A list of sentences to cache.
         """
-        self.lru_cache.cache_compute(
-            context, lambda values: self.compute_embedding_batch(values)
+        self.lru_cache.cache_compute(context, lambda values: self.embed_lines(values))
+
+    def add_corpus(self, name: str, lines: List[str]) -> int:
+        """Register a named corpus of sentences to search with `search_corpus`.
+
+        Corpus with the same name is replaced.
+        Embeddings of the corpus bypass in-memory cache so that big corpora don't evict it.
+
+        Args:
+            name: Name of the corpus.
+            lines: A list of sentences.
+
+        Returns:
+            Number of sentences in the corpus.
+        """
+        self.corpora[name] = create_corpus_index(
+            self.corpus_index, self.corpus_scores, **self.ann_params
+        )
+        return self.extend_corpus(name, lines)
+
+    def extend_corpus(self, name: str, lines: List[str]) -> int:
+        """Add sentences to the end of a named corpus creating it if it doesn't exist.
+
+        Args:
+            name: Name of the corpus.
+            lines: A list of sentences.
+
+        Returns:
+            Number of sentences in the corpus.
+        """
+        if name not in self.corpora:
+            return self.add_corpus(name, lines)
+        if len(lines) > 0:
+            self.corpora[name].add(self.prepare_corpus(self.embed_lines(lines)))
+        self.save_corpus(name)
+        return len(self.corpora[name])
+
+    def search_corpus(
+        self, name: str, query: str, top_k: int = 5, threshold: float = None
+    ) -> Dict[str, List[Any]]:
+        """Find sentences of a named corpus that are the most similar to the query.
+
+        Args:
+            name: Name of the corpus.
+            query: A sentence to compare.
+            top_k: Maximum number of sentences to return. All if None.
+            threshold: If not none only sentences with similarity above it are returned.
+
+        Scores are similarities for every metric, higher is more similar.
+        For `dot` metric it's the dot product itself
+        and for `cosine` metric it's the cosine similarity.
+
+        Returns:
+            Dict with `indices` of the sentences in the corpus
+            and their `scores` sorted from the most similar.
+        """
+        if name not in self.corpora:
+            raise ValueError(f"Corpus {name} is not registered")
+        corpus = self.corpora[name]
+        if len(corpus) == 0:
+            return {"indices": [], "scores": []}
+        query_embedding = self.prepare_corpus(
+            self.lru_cache.cache_compute(
+                [query], lambda values: self.compute_embedding_batch(values)
+            )
+        )
+        indices, scores = corpus.search(query_embedding, top_k)
+        if threshold is not None:
+            indices, scores = indices[scores > threshold], scores[scores > threshold]
+        return {"indices": indices.tolist(), "scores": scores.tolist()}
+
+    def save_corpus(self, name: str):
+        """Save named corpus with its index if persistent corpora are enabled.
+
+        Args:
+            name: Name of the corpus.
+        """
+        if self.corpora_path is None:
+            return
+        file_name = hashlib.sha1(name.encode("utf-8")).hexdigest() + ".npz"
+        with file_lock(os.path.join(self.corpora_path, self.CORPORA_LOCK_FILE)):
+            self.corpora[name].save(
+                os.path.join(self.corpora_path, file_name),
+                name=name,
+                fingerprint=self.model_fingerprint,
+            )
+
+    def load_corpora(self, path: str):
+        """Load named corpora saved for the current model.
+
+        Args:
+            path: Directory to save and load corpora in.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.corpora_path = path
+        with file_lock(os.path.join(path, self.CORPORA_LOCK_FILE)):
+            for file_path in glob.glob(os.path.join(path, "*.npz")):
+                index, metadata = load_corpus_index(
+                    file_path, self.corpus_index, self.corpus_scores, **self.ann_params
+                )
+                if metadata.get("fingerprint") != self.model_fingerprint:
+                    logger.info(
+                        f"Removed corpus {metadata.get('name')} of another model"
+                    )
+                    os.remove(file_path)
+                    continue
+                self.corpora[metadata["name"]] = index
+        logger.info(f"Loaded {len(self.corpora)} corpora")
+
+    def prepare_corpus(self, embeddings: np.ndarray) -> np.ndarray:
+        """Convert embeddings to the form they are searched in.
+
+        Models can override it e.g. to normalize embeddings for cosine similarity.
+
+        Args:
+            embeddings: Embeddings of shape (batch_size, embedding_size)
+
+        Returns:
+            Contiguous embeddings of shape (batch_size, embedding_size)
+        """
+        return np.ascontiguousarray(embeddings)
+
+    def corpus_scores(self, embedding: np.ndarray, corpus: np.ndarray) -> np.ndarray:
+        """Compute similarities of prepared query embedding to prepared corpus.
+
+        Args:
+            embedding: Prepared embedding of shape (1, embedding_size)
+            corpus: Prepared embeddings of shape (corpus_size, embedding_size)
+
+        Models whose `metric` is not a similarity must override it
+        as corpora are searched for the highest scores.
+
+        Returns:
+            Vector of similarities (corpus_size,), higher is more similar
+        """
+        return self.metric(embedding, corpus)
+
+    def open_persistent_cache(self, model_path: str, model_file: str = "model.onnx"):
+        """Open on-disk embedding cache and saved corpora in the model directory if enabled.
+
+        They are discarded if the model file has changed since they were written.
+
+        Args:
+            model_path: Path to the model directory.
+            model_file: Name of the model weights file to fingerprint.
+        """
+        if not self.use_persistent_cache and not self.persistent_corpora:
+            return
+        self.model_fingerprint = file_fingerprint(os.path.join(model_path, model_file))
+        if self.use_persistent_cache:
+            self.persistent_cache = PersistentNumpyCache(
+                os.path.join(model_path, "embedding_cache"), self.model_fingerprint
+            )
+            logger.info(
+                f"Loaded {len(self.persistent_cache)} embeddings from disk cache"
+            )
+        if self.persistent_corpora:
+            self.load_corpora(os.path.join(model_path, "corpora"))
+
+    def embed_lines(self, lines: List[str], queries: List[str] = None) -> np.ndarray:
+        """Compute line embeddings reusing on-disk cache if it's open.
+
+        On-disk cache is never evicted so free-form queries are not stored in it.
+        They are embedded in the same batch as the missing lines.
+
+        Args:
+            lines: List of sentences to embed and store on disk
+            queries: List of sentences to embed without storing them on disk
+
+        Returns:
+            Embedding batch of shape (len(lines) + len(queries), embedding_size)
+            with lines first.
+        """
+        queries = queries or []
+        if self.persistent_cache is None:
+            return self.compute_embedding_batch(lines + queries)
+        query_embeddings = []
+
+        def compute(values: List[str]) -> np.ndarray:
+            embeddings = self.compute_embedding_batch(values + queries)
+            query_embeddings.append(embeddings[len(values) :])
+            return embeddings[: len(values)]
+
+        line_embeddings = self.persistent_cache.cache_compute(lines, compute)
+        if len(queries) == 0:
+            return line_embeddings
+        if len(query_embeddings) == 0:
+            query_embeddings.append(self.compute_embedding_batch(queries))
+        return np.concatenate([line_embeddings, query_embeddings[0]])
+
+    def embed_missing(self, values: List[str], lines: List[str]) -> np.ndarray:
+        """Embed sentences missing in memory cache storing only the lines on disk.
+
+        Args:
+            values: List of sentences to embed
+            lines: Context or corpus sentences that can be stored on disk.
+                Other values are queries.
+
+        Returns:
+            Embedding batch of shape (len(values), embedding_size)
+        """
+        lines = set(lines)
+        is_query = np.fromiter(
+            (value not in lines for value in values), dtype=bool, count=len(values)
+        )
+        order = np.argsort(is_query, kind="stable")
+        embeddings = self.embed_lines(
+            [value for value in values if value in lines],
+            [value for value in values if value not in lines],
         )
+        result = np.empty_like(embeddings)
+        result[order] = embeddings
+        return result
 
     @abstractmethod
     def compute_embedding_batch(self, lines: List[str]) -> np.ndarray:
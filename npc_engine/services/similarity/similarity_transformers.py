@@ -64,6 +64,7 @@ class TransformerSemanticSimilarity(SimilarityAPI):
         )
         self.tests = {}
         self.metric_type = metric
+        self.open_persistent_cache(model_path)
 
     def compute_embedding(self, line: str) -> np.ndarray:
         """Compute sentence embedding.
@@ -127,6 +128,36 @@ class TransformerSemanticSimilarity(SimilarityAPI):
         sum_mask = np.clip(attention_mask.sum(1), a_min=1e-9, a_max=None)
         return sum_embeddings / sum_mask
 
+    def prepare_corpus(self, embeddings: np.ndarray) -> np.ndarray:
+        """Normalize embeddings for cosine metric so that it's computed as a dot product.
+
+        Args:
+            embeddings: Embeddings of shape (batch_size, embedding_size)
+
+        Returns:
+            Contiguous embeddings of shape (batch_size, embedding_size)
+        """
+        if self.metric_type == "cosine":
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.clip(norms, a_min=1e-12, a_max=None)
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    def corpus_scores(self, embedding: np.ndarray, corpus: np.ndarray) -> np.ndarray:
+        """Compute similarities of prepared query embedding to prepared corpus.
+
+        Both metrics are a dot product of prepared embeddings
+        as they are normalized for cosine metric.
+        Unlike `metric` for dot product, scores are not negated.
+
+        Args:
+            embedding: Prepared embedding of shape (1, embedding_size)
+            corpus: Prepared embeddings of shape (corpus_size, embedding_size)
+
+        Returns:
+            Vector of similarities (corpus_size,), higher is more similar
+        """
+        return (corpus @ embedding[0]).astype(np.float64)
+
     def metric(self, embedding_a: np.ndarray, embedding_b: np.ndarray) -> np.ndarray:
         """Similarity between two embeddings.
 
@@ -14,3 +14,4 @@ Example:
 from .text_generation_base import TextGenerationAPI  # noqa: F401
 from .hf_text_generation import HfChatbot  # noqa: F401
 from .bart import BartChatbot  # noqa: F401
+from .ort_generation import OrtGenerationChatbot  # noqa: F401
@@ -1,12 +1,21 @@
 """BART based chatbot implementation."""
-from typing import Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Sequence, Tuple, Union
+import hashlib
 import numpy as np
 import onnxruntime as rt
 from npc_engine.services.text_generation.text_generation_base import TextGenerationAPI
 from tokenizers import Tokenizer
 import os
 import json
-from npc_engine.services.text_generation.utils import decode_logits
+from npc_engine.services.utils import DTYPE_MAP
+from npc_engine.services.utils.lru_cache import MemoryLRUCache
+from npc_engine.services.text_generation.utils import (
+    StopCondition,
+    decode_logits,
+    decode_stream,
+    get_deadline,
+    limit_stream,
+)
 
 
 class BartChatbot(TextGenerationAPI):
@@ -31,6 +40,18 @@ class BartChatbot(TextGenerationAPI):
             `decoder_input_ids`
         - outputs:
             `logits`
+
+    Decoder can also be exported with past key values.
+    Then only the last token is fed to it on each step
+    and the cached keys and values are passed between steps via IO binding:
+
+        - inputs:
+            `encoder_hidden_state`
+            `decoder_input_ids`
+            `past_key_values.*`
+        - outputs:
+            `logits`
+            `present.*`
     """
 
     def __init__(
@@ -43,6 +64,9 @@ class BartChatbot(TextGenerationAPI):
         pad_token_id=1,
         sep_token_id=None,
         trunc_length=512,
+        repetition_penalty=1.0,
+        topp=None,
+        prompt_cache_size_mb=32,
         *args,
         **kwargs,
     ):
@@ -57,6 +81,11 @@ class BartChatbot(TextGenerationAPI):
             eos_token_id: end of sequence token id
             pad_token_id: padding token id
             sep_token_id: token id for separating sequence into multiple parts
+            trunc_length: length to truncate model prompt to
+            repetition_penalty: probability coef for same tokens to appear multiple times
+            topp: if not none samples only from the smallest set of tokens
+                with cumulative probability above this value
+            prompt_cache_size_mb: memory limit for encoder hidden states of recent prompts
 
         """
         super().__init__(*args, **kwargs)
@@ -77,6 +106,14 @@ class BartChatbot(TextGenerationAPI):
             providers=self.get_providers(),
             sess_options=sess_options,
         )
+        self.past_inputs = [
+            i for i in self.decoder_model.get_inputs() if "past_key_values" in i.name
+        ]
+        self.with_past = len(self.past_inputs) > 0
+        decoder_ids_input = [
+            i for i in self.decoder_model.get_inputs() if i.name == "decoder_input_ids"
+        ][0]
+        self.decoder_batch_fixed = decoder_ids_input.shape[0] == 1
         self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
         added_tokens_path = os.path.join(model_path, "added_tokens.txt")
         if os.path.exists(added_tokens_path):
@@ -109,6 +146,9 @@ class BartChatbot(TextGenerationAPI):
         self.max_steps = max_steps
         self.min_length = min_length
         self.trunc_length = trunc_length
+        self.repetition_penalty = repetition_penalty
+        self.topp = topp
+        self.encoder_cache = MemoryLRUCache(int(prompt_cache_size_mb * 2**20))
 
     def run(
         self,
@@ -116,79 +156,302 @@ class BartChatbot(TextGenerationAPI):
         temperature: float = 1.0,
         topk: int = None,
         num_sampled: int = 3,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline_ms: float = None,
+        seed: int = None,
     ) -> str:
         """Run text generation from given prompt and parameters.
 
         Args:
             prompt: Fromatted prompt.
             temperature: Temperature parameter for sampling.
-                Controls how random model output is: more temperature - more randomness
+                Controls how random model output is: more temperature - more randomness.
+                Tokens are selected greedily if 0.
             topk: If not none selects top n of predictions to sample from during generation.
             num_sampled: Number of token sequences to generate. Best one is selected by model confidence.
+            max_new_tokens: If not none stops sequences at this number of tokens.
+            stop: Stop string or strings. Sequences are finished and cut before them.
+            deadline_ms: If not none stops generation after this time
+                and returns the best of the partial sequences.
+            seed: Seed of the random generator used for this request only.
 
         Returns:
             Generated text
         """
-        tokens = self.tokenizer.encode(prompt)
-        total = np.asarray(tokens.ids, dtype=np.int64).reshape([1, -1])
-        total_enc = self.encoder_model.run(None, {"input_ids": total})[0]
+        rng = np.random.default_rng(seed)
+        condition = StopCondition(
+            self.tokenizer,
+            self.eos_token_id,
+            num_sampled,
+            max_new_tokens,
+            stop,
+            get_deadline(deadline_ms),
+        )
+        total_enc = self.encode_prompt(prompt)
         log_probs = []
-        utterances = []
-
-        for _ in range(num_sampled):
-            utterance, log_prob = self.run_decoder(total_enc, temperature, topk)
-            log_probs.append(log_prob[0])
-            utterances.append(utterance)
-        decoded = [
-            self.tokenizer.decode(line, skip_special_tokens=True) for line in utterances
-        ]
-        lengths = [len(line) - 1 for line in utterances]
-        mean_log_probs = [
-            log_prob / length for log_prob, length in zip(log_probs, lengths)
-        ]
-        return decoded[np.argmax(mean_log_probs)]
+        if self.decoder_batch_fixed:
+            batch_sizes = [1] * num_sampled
+        else:
+            batch_sizes = [num_sampled]
+        for batch_size in batch_sizes:
+            if len(log_probs) > 0 and all(condition.finished):
+                break
+            sequences = range(len(log_probs), len(log_probs) + batch_size)
+            log_probs += self.run_decoder(
+                total_enc, temperature, topk, condition, sequences, rng
+            )
+        return condition.best(log_probs)
+
+    def encode_prompt(self, prompt: str) -> np.ndarray:
+        """Run encoder on the prompt reusing cached hidden state for repeated prompts.
+
+        Args:
+            prompt: Formatted prompt.
+
+        Returns:
+            Encoder hidden state of shape (1, sequence, hidden).
+        """
+        total = np.asarray(self.tokenizer.encode(prompt).ids, dtype=np.int64)
+        key = hashlib.sha1(total.tobytes()).hexdigest()
+        total_enc = self.encoder_cache.get(key)
+        if total_enc is None:
+            total_enc = self.encoder_model.run(
+                None, {"input_ids": total.reshape([1, -1])}
+            )[0]
+            self.encoder_cache.put(key, total_enc)
+        return total_enc
 
     def run_decoder(
-        self, encoder_hidden_state: np.ndarray, temperature: float, topk: int
-    ) -> Tuple[List[float], List[float]]:
+        self,
+        encoder_hidden_state: np.ndarray,
+        temperature: float,
+        topk: int,
+        condition: StopCondition,
+        sequences: range,
+        rng: np.random.Generator = None,
+    ) -> List[float]:
         """Run decoder model on given encoder hidden state.
 
         Args:
             encoder_hidden_state: Encoder hidden state.
             temperature: Temperature parameter for sampling.
             topk: If not none selects top n of predictions to sample from during generation.
+            condition: Stop condition that collects decoded tokens.
+            sequences: Indices of the condition sequences to decode in one batch.
+            rng: Random generator to sample with. Global numpy random state is used if None.
 
         Returns:
-            (Decoded tokens, sequence probabilities)
+            Sequence log probabilities
         """
-        utterance = np.asarray([self.eos_token_id], dtype=np.int64).reshape([1, 1])
-        log_probs = [
-            0,
-        ]
-        for i in range(self.max_steps):
-            o = self.decoder_model.run(
-                None,
-                {
-                    "encoder_hidden_state": encoder_hidden_state,
-                    "decoder_input_ids": utterance,
-                },
+        log_probs = [0 for _ in sequences]
+        for tokens, log_probs in self.generate_tokens(
+            encoder_hidden_state, temperature, topk, len(sequences), rng
+        ):
+            condition.update(tokens, sequences)
+            if all(condition.finished[i] for i in sequences):
+                break
+        return list(log_probs)
+
+    def run_stream(
+        self,
+        prompt: str,
+        temperature: float = 1.0,
+        topk: int = None,
+        num_sampled: int = 1,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline_ms: float = None,
+        seed: int = None,
+    ) -> Iterator[str]:
+        """Generate text from the prompt streaming it as text deltas.
+
+        Best of several candidates can't be picked before generation is finished,
+        so if more than one sequence is sampled the reply is generated with `run`
+        and yielded at once.
+
+        Args:
+            prompt: Fromatted prompt.
+            temperature: Temperature parameter for sampling.
+                Controls how random model output is: more temperature - more randomness.
+                Tokens are selected greedily if 0.
+            topk: If not none selects top n of predictions to sample from during generation.
+            num_sampled: Number of token sequences to generate. Best one is selected by model confidence.
+            max_new_tokens: If not none stops generation at this number of tokens.
+            stop: Stop string or strings. Stream ends before them.
+            deadline_ms: If not none stops generation after this time.
+            seed: Seed of the random generator used for this request only.
+
+        Yields:
+            Pieces of generated text.
+        """
+        if num_sampled > 1:
+            yield self.run(
+                prompt,
+                temperature,
+                topk,
+                num_sampled,
+                max_new_tokens,
+                stop,
+                deadline_ms,
+                seed,
+            )
+            return
+        condition = StopCondition(
+            self.tokenizer,
+            self.eos_token_id,
+            max_new_tokens=max_new_tokens,
+            deadline=get_deadline(deadline_ms),
+        )
+        total_enc = self.encode_prompt(prompt)
+        tokens = limit_stream(
+            self.generate_tokens(
+                total_enc, temperature, topk, rng=np.random.default_rng(seed)
+            ),
+            condition,
+        )
+        yield from decode_stream(self.tokenizer, tokens, self.eos_token_id, stop)
+
+    def generate_tokens(
+        self,
+        encoder_hidden_state: np.ndarray,
+        temperature: float,
+        topk: int,
+        num_sampled: int = 1,
+        rng: np.random.Generator = None,
+    ) -> Iterator[Tuple[List[int], List[float]]]:
+        """Sample tokens from the decoder step by step.
+
+        Sequences are decoded as one batch sharing the encoder output.
+        Sequences that produced end of sequence token keep producing it
+        without changing their log probabilities until all of them are finished.
+
+        Args:
+            encoder_hidden_state: Encoder hidden state of shape (1, sequence, hidden).
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            num_sampled: Number of sequences to sample.
+            rng: Random generator to sample with. Global numpy random state is used if None.
+
+        Yields:
+            (Sampled tokens, cumulative sequence log probabilities)
+        """
+        utterance = np.full([num_sampled, 1], self.eos_token_id, dtype=np.int64)
+        log_probs = [0 for _ in range(num_sampled)]
+        finished = np.zeros([num_sampled], dtype=bool)
+        encoder_hidden_state = np.repeat(encoder_hidden_state, num_sampled, axis=0)
+        if self.with_past:
+            past = self.create_empty_past(utterance.shape[0])
+            encoder_hidden_state = rt.OrtValue.ortvalue_from_numpy(
+                encoder_hidden_state, "cpu", 0
             )
-            logits = o[0][:, -1, :]
+        for i in range(self.max_steps):
+            if self.with_past:
+                logits, past = self.run_decoder_with_past(
+                    encoder_hidden_state, utterance[:, -1:], past
+                )
+            else:
+                logits = self.decoder_model.run(
+                    None,
+                    {
+                        "encoder_hidden_state": encoder_hidden_state,
+                        "decoder_input_ids": utterance,
+                    },
+                )[0]
+            logits = logits[:, -1, :]
             if i < self.min_length:
                 logits[:, self.eos_token_id] = float("-inf")
-            tokens, log_probs = decode_logits(logits, temperature, topk, log_probs)
-            utterance = np.concatenate(
-                [utterance, np.asarray(tokens, dtype=utterance.dtype).reshape([-1, 1])],
-                axis=1,
+            tokens, new_log_probs = decode_logits(
+                logits,
+                temperature,
+                topk,
+                log_probs,
+                self.topp,
+                self.repetition_penalty,
+                utterance[:, 1:],
+                rng,
             )
-            if tokens[0] == self.eos_token_id:
+            tokens = np.where(finished, self.eos_token_id, tokens)
+            log_probs = np.where(finished, log_probs, new_log_probs)
+            yield tokens.tolist(), log_probs
+            tokens = np.asarray(tokens, dtype=utterance.dtype).reshape([-1, 1])
+            utterance = np.concatenate([utterance, tokens], axis=1)
+            finished |= tokens[:, 0] == self.eos_token_id
+            if finished.all():
                 break
-        return utterance.reshape([-1]).tolist(), log_probs
+
+    def create_empty_past(self, batch_size: int) -> List[rt.OrtValue]:
+        """Create empty past key values to start decoding with.
+
+        Args:
+            batch_size: Number of decoded sequences.
+
+        Returns:
+            Past key values with zero length sequence dimensions.
+        """
+        past = []
+        for inp in self.past_inputs:
+            shape = [
+                dim if isinstance(dim, int) else (batch_size if "batch" in dim else 0)
+                for dim in inp.shape
+            ]
+            past.append(
+                rt.OrtValue.ortvalue_from_numpy(
+                    np.empty(shape, dtype=DTYPE_MAP[inp.type]), "cpu", 0
+                )
+            )
+        return past
+
+    def run_decoder_with_past(
+        self,
+        encoder_hidden_state: rt.OrtValue,
+        decoder_input_ids: np.ndarray,
+        past: List[rt.OrtValue],
+    ) -> Tuple[np.ndarray, List[rt.OrtValue]]:
+        """Run one decoder step with past key values.
+
+        Present key values stay in OrtValues and are bound as the past of the next step
+        without copying them to numpy.
+
+        Args:
+            encoder_hidden_state: Encoder hidden state.
+            decoder_input_ids: Last decoded tokens of shape (batch, 1).
+            past: Past key values from previous step.
+
+        Returns:
+            (Logits, present key values)
+        """
+        io_binding = self.decoder_model.io_binding()
+        io_binding.bind_ortvalue_input("encoder_hidden_state", encoder_hidden_state)
+        io_binding.bind_cpu_input("decoder_input_ids", decoder_input_ids)
+        io_binding.bind_output("logits", "cpu")
+        for inp, value in zip(self.past_inputs, past):
+            io_binding.bind_ortvalue_input(inp.name, value)
+            io_binding.bind_output(
+                inp.name.replace("past_key_values", "present"), "cpu"
+            )
+        self.decoder_model.run_with_iobinding(io_binding)
+        outputs = io_binding.get_outputs()
+        return outputs[0].numpy(), outputs[1:]
 
     def get_special_tokens(self) -> Dict[str, str]:
         """Retrun dict of special tokens to be renderable from template."""
         return self.special_tokens
 
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return encoder cache counters in addition to the base metrics."""
+        metrics = super().get_metrics()
+        metrics["encoder_cache"] = self.encoder_cache.stats()
+        return metrics
+
     def string_too_long(self, prompt):
         """Check if prompt is too long for the model."""
         return len(self.tokenizer.encode(prompt)) > self.trunc_length
+
+    def count_tokens(self, text: str) -> int:
+        """Count tokens in the text without special tokens."""
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def get_token_budget(self) -> int:
+        """Return maximum prompt length in tokens."""
+        return self.trunc_length
@@ -1,6 +1,6 @@
 """BART based chatbot implementation."""
 from copy import copy
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 import numpy as np
 import onnxruntime as rt
 from npc_engine.services.text_generation.text_generation_base import TextGenerationAPI
@@ -8,7 +8,17 @@ from tokenizers import Tokenizer
 import os
 import json
 from npc_engine.services.utils import DTYPE_MAP
-from npc_engine.services.text_generation.utils import decode_logits
+from npc_engine.services.utils.lru_cache import TokenPrefixLRUCache
+from npc_engine.services.text_generation.utils import (
+    StopCondition,
+    decode_logits,
+    decode_stream,
+    get_deadline,
+    limit_stream,
+)
+from npc_engine.services.text_generation.scheduler import ContinuousBatchScheduler
+from npc_engine.services.text_generation.speculative import SpeculativeDecoder
+from loguru import logger
 
 
 class HfChatbot(TextGenerationAPI):
@@ -18,6 +28,8 @@ class HfChatbot(TextGenerationAPI):
     Features seq2seq-lm, causal-lm, seq2seq-lm-with-past, causal-lm-with-past are supported
     """
 
+    SCHEDULED_METHODS: Dict[str, str] = {"generate_reply": "schedule_reply"}
+
     def __init__(
         self,
         model_path: str,
@@ -26,6 +38,12 @@ class HfChatbot(TextGenerationAPI):
         repetition_penalty: float = 1,
         trunc_length: int = 512,
         num_sampled: int = 1,
+        topp: float = None,
+        prompt_cache_size_mb: float = 128,
+        continuous_batching: bool = False,
+        max_batch_sequences: int = 16,
+        draft_model: str = None,
+        num_draft_tokens: int = 4,
         *args,
         **kwargs,
     ):
@@ -38,6 +56,20 @@ class HfChatbot(TextGenerationAPI):
                 this long in tokens
             repetition_penalty: probability coef for same tokens to appear multiple times
             trunc_length: length to truncate model prompt to
+            num_sampled: number of sequences to sample. Best one is selected by model confidence.
+            topp: if not none samples only from the smallest set of tokens
+                with cumulative probability above this value
+            prompt_cache_size_mb: memory limit for past key values of recent prompts.
+                Only used by decoder-only models exported with past.
+            continuous_batching: decode concurrent generate_reply requests in a shared batch
+                that admits new requests and retires finished ones between steps.
+                Requires decoder-only model exported with past and position_ids input.
+            max_batch_sequences: maximum number of sequences decoded together with continuous batching.
+            draft_model: file name of a smaller causal-lm ONNX model in model_path
+                that shares the tokenizer. If set, replies with a single sampled sequence
+                are generated with speculative decoding: draft model proposes tokens
+                and the main model verifies them in one forward pass.
+            num_draft_tokens: number of tokens draft model proposes for each verification.
 
         """
         super().__init__(*args, **kwargs)
@@ -78,75 +110,458 @@ class HfChatbot(TextGenerationAPI):
         self.dtypes = {i.name: DTYPE_MAP[i.type] for i in self.model_inputs}
         self.trunc_length = trunc_length
         self.num_sampled = num_sampled
+        self.topp = topp
+        self.prompt_cache = TokenPrefixLRUCache(int(prompt_cache_size_mb * 2**20))
+        self.use_prompt_cache = (
+            self.with_past and not self.is_encdec and self.prompt_cache.max_bytes > 0
+        )
+        self.output_names = [o.name for o in self.model.get_outputs()]
+        att_mask_name = "decoder_attention_mask" if self.is_encdec else "attention_mask"
+        self.attention_mask_buffer = np.ones(
+            [0], dtype=self.dtypes.get(att_mask_name, np.int64)
+        )
+        self.past_names = [
+            i.name for i in self.model_inputs if "past_key_values" in i.name
+        ]
+        self.past_sequence_axis = {
+            i.name: [
+                axis
+                for axis, dim in enumerate(i.shape)
+                if isinstance(dim, str) and "sequence" in dim
+            ][0]
+            for i in self.model_inputs
+            if i.name in self.past_names
+        }
+        self.scheduler = None
+        if continuous_batching:
+            if self.with_past and not self.is_encdec and "position_ids" in self.dtypes:
+                self.scheduler = ContinuousBatchScheduler(self, max_batch_sequences)
+            else:
+                logger.warning(
+                    "Continuous batching requires decoder-only model "
+                    "exported with past and position_ids input, it is disabled"
+                )
+        if self.scheduler is None:
+            self.scheduled_methods = {}
+        self.scheduled_keys = {}
+        self.speculative = None
+        if draft_model is not None:
+            if self.is_encdec:
+                logger.warning(
+                    "Speculative decoding requires decoder-only model, it is disabled"
+                )
+            else:
+                draft_session = rt.InferenceSession(
+                    os.path.join(model_path, draft_model),
+                    providers=self.get_providers(),
+                    sess_options=sess_options,
+                )
+                self.speculative = SpeculativeDecoder(
+                    self, draft_session, num_draft_tokens
+                )
 
-    def run(self, prompt: str, temperature: float = 1.0, topk: int = None) -> str:
+    def run(
+        self,
+        prompt: str,
+        temperature: float = 1.0,
+        topk: int = None,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline_ms: float = None,
+        seed: int = None,
+    ) -> str:
         """Run text generation from given prompt and parameters.
 
         Args:
             prompt: Formatted prompt.
             temperature: Temperature parameter for sampling.
-                Controls how random model output is: more temperature - more randomness
+                Controls how random model output is: more temperature - more randomness.
+                Tokens are selected greedily if 0.
             topk: If not none selects top n of predictions to sample from during generation.
+            max_new_tokens: If not none stops sequences at this number of tokens.
+            stop: Stop string or strings. Sequences are finished and cut before them.
+            deadline_ms: If not none stops generation after this time
+                and returns the best of the partial sequences.
+            seed: Seed of the random generator used for this request only.
 
         Returns:
             Generated text
         """
-        inputs = self.create_starter_inputs(prompt)
-        utterance = [[] for _ in range(self.num_sampled)]
-        log_probs = [0 for _ in range(self.num_sampled)]
-        for i in range(self.max_steps):
-            o = self.model.run(
-                None,
-                inputs,
+        rng = np.random.default_rng(seed)
+        condition = StopCondition(
+            self.tokenizer,
+            self.eos_token_id,
+            self.num_sampled,
+            max_new_tokens,
+            stop,
+            get_deadline(deadline_ms),
+        )
+        if self.speculative is None or self.num_sampled > 1:
+            log_probs = self.generate_candidates(
+                prompt, temperature, topk, condition, rng
+            )
+            return condition.best(log_probs)
+        log_probs = [0]
+        for tokens, log_probs in self.generate_tokens(
+            prompt, temperature, topk, 1, rng
+        ):
+            if condition.update(tokens):
+                break
+        return condition.best(log_probs)
+
+    def schedule_reply(
+        self,
+        context: Dict[str, Any],
+        temperature: float = 1.0,
+        topk: int = None,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline_ms: float = None,
+        seed: int = None,
+    ) -> int:
+        """Schedule reply generation with continuous batching.
+
+        Args:
+            context: Context to render the prompt from.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            max_new_tokens: If not none stops sequences at this number of tokens.
+            stop: Stop string or strings. Sequences are finished and cut before them.
+            deadline_ms: If not none stops generation after this time
+                and returns the best of the partial sequences.
+            seed: Seed of the random generator used for this request only.
+
+        Returns:
+            Job id.
+        """
+        prompt = self.render_prompt(context)
+        key = self.get_response_key(
+            prompt, seed, temperature, topk, max_new_tokens, stop, deadline_ms
+        )
+        reply = self.response_cache.get(key) if key is not None else None
+        if reply is not None:
+            return self.scheduler.complete(reply)
+        job_id = self.scheduler.submit(
+            prompt,
+            temperature,
+            topk,
+            max_new_tokens,
+            stop,
+            get_deadline(deadline_ms),
+            seed,
+        )
+        if key is not None:
+            self.scheduled_keys[job_id] = key
+        return job_id
+
+    def step_scheduled(self) -> List[Tuple[int, Any]]:
+        """Run one continuous batching step.
+
+        Returns:
+            List of (job id, generated text or exception) for finished jobs.
+        """
+        finished = self.scheduler.step()
+        for job_id, result in finished:
+            key = self.scheduled_keys.pop(job_id, None)
+            if key is not None and not isinstance(result, Exception):
+                self.response_cache.put(key, result)
+        return finished
+
+    def run_stream(
+        self,
+        prompt: str,
+        temperature: float = 1.0,
+        topk: int = None,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline_ms: float = None,
+        seed: int = None,
+    ) -> Iterator[str]:
+        """Generate text from the prompt streaming it as text deltas.
+
+        A single sequence is sampled as there is no way to pick the best candidate
+        before generation is finished.
+
+        Args:
+            prompt: Formatted prompt.
+            temperature: Temperature parameter for sampling.
+                Controls how random model output is: more temperature - more randomness.
+                Tokens are selected greedily if 0.
+            topk: If not none selects top n of predictions to sample from during generation.
+            max_new_tokens: If not none stops generation at this number of tokens.
+            stop: Stop string or strings. Stream ends before them.
+            deadline_ms: If not none stops generation after this time.
+            seed: Seed of the random generator used for this request only.
+
+        Yields:
+            Pieces of generated text.
+        """
+        condition = StopCondition(
+            self.tokenizer,
+            self.eos_token_id,
+            max_new_tokens=max_new_tokens,
+            deadline=get_deadline(deadline_ms),
+        )
+        tokens = limit_stream(
+            self.generate_tokens(
+                prompt, temperature, topk, 1, np.random.default_rng(seed)
+            ),
+            condition,
+        )
+        yield from decode_stream(self.tokenizer, tokens, self.eos_token_id, stop)
+
+    def generate_tokens(
+        self,
+        prompt: str,
+        temperature: float,
+        topk: int,
+        num_sampled: int,
+        rng: np.random.Generator = None,
+    ) -> Iterator[Tuple[List[int], List[float]]]:
+        """Sample token sequences from the model step by step.
+
+        Single sequence is sampled with speculative decoding if draft model is configured.
+
+        Args:
+            prompt: Formatted prompt.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            num_sampled: Number of sequences to sample.
+            rng: Random generator to sample with. Global numpy random state is used if None.
+
+        Yields:
+            (Tokens sampled for each sequence at this step, cumulative sequence log probabilities)
+        """
+        prompt_ids = self.tokenizer.encode(prompt).ids
+        if self.speculative is not None and num_sampled == 1:
+            yield from self.speculative.generate_tokens(
+                prompt_ids, temperature, topk, rng
             )
-            logits = o[0][:, -1, :]
+            return
+        inputs = self.create_starter_inputs(prompt, num_sampled, prompt_ids)
+        log_probs = [0 for _ in range(num_sampled)]
+        generated_ids = np.zeros([num_sampled, 0], dtype=np.int64)
+        for i in range(self.max_steps):
+            logits, result_dict = self.run_step(inputs)
+            logits = logits[:, -1, :]
             if i < self.min_length:
                 logits[:, self.eos_token_id] = float("-inf")
             tokens, log_probs = decode_logits(
-                logits, temperature, topk, log_probs=log_probs
+                logits,
+                temperature,
+                topk,
+                log_probs,
+                self.topp,
+                self.repetition_penalty,
+                generated_ids,
+                rng,
             )
-            for i, token in enumerate(tokens):
-                utterance[i].append(token)
-            result_dict = {
-                outp.name: o[i] for i, outp in enumerate(self.model.get_outputs())
-            }
+            generated_ids = np.concatenate([generated_ids, tokens[:, None]], axis=1)
+            yield tokens.tolist(), log_probs
+            if i == 0 and self.use_prompt_cache:
+                self.cache_prompt(prompt_ids, result_dict)
             inputs = self.update_inputs_with_results(inputs, result_dict, tokens)
             if all([token == self.eos_token_id for token in tokens]):
                 break
-        decoded = [
-            self.tokenizer.decode(
-                line[: line.index(self.eos_token_id)], skip_special_tokens=True
+
+    def generate_candidates(
+        self,
+        prompt: str,
+        temperature: float,
+        topk: int,
+        condition: StopCondition,
+        rng: np.random.Generator = None,
+    ) -> List[float]:
+        """Sample `num_sampled` candidate sequences until the condition finishes them.
+
+        Finished candidates are fed end of sequence tokens and their outputs are ignored
+        until at most half of the batch is still live, then they are dropped from the batch
+        together with their past key values (see `compact_inputs`).
+        Candidates whose mean log probability can't reach the best finished candidate's
+        even if all the remaining tokens are certain are pruned as they can't be selected.
+
+        Args:
+            prompt: Formatted prompt.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            condition: Per-request limits that track generated tokens of the candidates.
+            rng: Random generator to sample with. Global numpy random state is used if None.
+
+        Returns:
+            Cumulative log probabilities of the candidates.
+        """
+        prompt_ids = self.tokenizer.encode(prompt).ids
+        inputs = self.create_starter_inputs(prompt, self.num_sampled, prompt_ids)
+        log_probs = [0 for _ in range(self.num_sampled)]
+        # Candidate of each batch row, finished ones included until compaction
+        rows = list(range(self.num_sampled))
+        live = list(range(self.num_sampled))
+        generated_ids = np.zeros([self.num_sampled, 0], dtype=np.int64)
+        for i in range(self.max_steps):
+            logits, result_dict = self.run_step(inputs)
+            logits = logits[live, -1, :]
+            if i < self.min_length:
+                logits[:, self.eos_token_id] = float("-inf")
+            active = [rows[row] for row in live]
+            tokens, step_log_probs = decode_logits(
+                logits,
+                temperature,
+                topk,
+                [log_probs[c] for c in active],
+                self.topp,
+                self.repetition_penalty,
+                generated_ids[live],
+                rng,
             )
-            if self.eos_token_id in line
-            else self.tokenizer.decode(line, skip_special_tokens=True)
-            for line in utterance
-        ]
-        lengths = [
-            len(line[: line.index(self.eos_token_id)])
-            if self.eos_token_id in line
-            else len(line)
-            for line in utterance
-        ]
-        mean_log_probs = [
-            (log_prob / length) for log_prob, length in zip(log_probs, lengths)
+            for candidate, log_prob in zip(active, step_log_probs):
+                log_probs[candidate] = log_prob
+            row_tokens = np.full(len(rows), self.eos_token_id, dtype=np.int64)
+            row_tokens[live] = tokens
+            generated_ids = np.concatenate([generated_ids, row_tokens[:, None]], axis=1)
+            if i == 0 and self.use_prompt_cache:
+                self.cache_prompt(prompt_ids, result_dict)
+            if condition.update(tokens, active):
+                break
+            self.prune_candidates(condition, log_probs, self.max_steps - i - 1)
+            inputs = self.update_inputs_with_results(inputs, result_dict, row_tokens)
+            live = [row for row, c in enumerate(rows) if not condition.finished[c]]
+            if len(live) < len(rows) and self.should_compact(inputs, len(live), len(rows)):
+                inputs = self.compact_inputs(inputs, live)
+                generated_ids = generated_ids[live]
+                rows = [rows[row] for row in live]
+                live = list(range(len(rows)))
+        return log_probs
+
+    def prune_candidates(
+        self, condition: StopCondition, log_probs: List[float], remaining_steps: int
+    ):
+        """Finish candidates that can't outscore the best finished candidate.
+
+        Log probabilities are not positive so the mean log probability of a candidate
+        is at most its cumulative log probability over the maximum possible length.
+
+        Args:
+            condition: Per-request limits that track generated tokens of the candidates.
+            log_probs: Cumulative log probabilities of the candidates.
+            remaining_steps: Number of generation steps left.
+        """
+        finished_means = [
+            log_prob / max(len(tokens), 1)
+            for log_prob, tokens, finished in zip(
+                log_probs, condition.tokens, condition.finished
+            )
+            if finished
         ]
-        return decoded[mean_log_probs.index(max(mean_log_probs))]
+        if len(finished_means) == 0:
+            return
+        best_mean = max(finished_means)
+        for candidate, tokens in enumerate(condition.tokens):
+            if condition.finished[candidate]:
+                continue
+            remaining = remaining_steps
+            if condition.max_new_tokens is not None:
+                remaining = min(remaining, condition.max_new_tokens - len(tokens))
+            max_length = max(len(tokens) + remaining, 1)
+            if log_probs[candidate] / max_length < best_mean:
+                condition.finished[candidate] = True
+
+    def should_compact(
+        self, inputs: Dict[str, Any], num_live: int, batch_size: int
+    ) -> bool:
+        """Check if dropping finished rows from the batch is worth a copy of the inputs.
+
+        Past key values are left on the device as OrtValues and ONNX Runtime can't gather
+        their rows in place, so compaction copies the whole cache through the host.
+        It's done only once at most half of the batch is live, so each copy at least
+        halves the cost of the following steps. Host inputs are compacted right away.
+
+        Args:
+            inputs: Model inputs as numpy arrays or OrtValues with batch as the first axis.
+            num_live: Number of rows that are not finished.
+            batch_size: Number of rows in the batch.
+
+        Returns:
+            True if the inputs should be compacted.
+        """
+        if not any(isinstance(value, rt.OrtValue) for value in inputs.values()):
+            return True
+        return num_live <= batch_size // 2
+
+    def compact_inputs(
+        self, inputs: Dict[str, Any], keep: List[int]
+    ) -> Dict[str, np.ndarray]:
+        """Keep only the given batch rows of the next step inputs.
+
+        OrtValues are copied to the host, see `should_compact`.
+
+        Args:
+            inputs: Model inputs as numpy arrays or OrtValues with batch as the first axis.
+            keep: Indices of the rows to keep.
+
+        Returns:
+            Inputs of the kept rows.
+        """
+        return {
+            name: (value.numpy() if isinstance(value, rt.OrtValue) else value)[keep]
+            for name, value in inputs.items()
+        }
+
+    def run_step(self, inputs: Dict[str, Any]) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Run one generation step of the model.
 
-    def create_starter_inputs(self, prompt: str = "") -> Dict[str, Any]:
+        Models with past are run with IO binding and their outputs are left as OrtValues
+        so that present key values can be fed as the next past without host copies.
+
+        Args:
+            inputs: Model inputs as numpy arrays or OrtValues.
+
+        Returns:
+            (Logits, results by output name)
+        """
+        if not self.with_past:
+            outputs = self.model.run(None, inputs)
+            return outputs[0], dict(zip(self.output_names, outputs))
+        io_binding = self.model.io_binding()
+        for name, value in inputs.items():
+            if isinstance(value, rt.OrtValue):
+                io_binding.bind_ortvalue_input(name, value)
+            else:
+                io_binding.bind_cpu_input(name, value)
+        for name in self.output_names:
+            io_binding.bind_output(name, "cpu")
+        self.model.run_with_iobinding(io_binding)
+        outputs = io_binding.get_outputs()
+        return outputs[0].numpy(), dict(zip(self.output_names, outputs))
+
+    def create_starter_inputs(
+        self, prompt: str = "", num_sampled: int = None, tokens: List[int] = None
+    ) -> Dict[str, Any]:
         """Create starter inputs for the model.
 
+        If past key values for a prefix of the prompt are cached
+        only the rest of the prompt is fed to the model.
+
         Args:
             prompt: Prompt to start generation from.
+            num_sampled: Batch size of the inputs. Defaults to `num_sampled` from config.
+            tokens: Already tokenized prompt.
 
         Returns:
             Dict of inputs to the model
         """
-        tokens = self.tokenizer.encode(prompt).ids
+        if num_sampled is None:
+            num_sampled = self.num_sampled
+        shape_dict = {**self.shape_dict, "batch": num_sampled}
+        if tokens is None:
+            tokens = self.tokenizer.encode(prompt).ids
+        cached_length, cached_past = 0, None
+        if self.use_prompt_cache:
+            cached_length, cached_past = self.get_cached_prefix(tokens)
         inputs = {}
         if self.is_encdec:
-            prompt_start = [copy(tokens[-1:]) for _ in range(self.num_sampled)]
+            prompt_start = [copy(tokens[-1:]) for _ in range(num_sampled)]
             inputs["input_ids"] = np.asarray(
-                [copy(tokens[:-1]) for _ in range(self.num_sampled)],
+                [copy(tokens[:-1]) for _ in range(num_sampled)],
                 dtype=self.dtypes["input_ids"],
             )
             inputs["decoder_input_ids"] = np.asarray(
@@ -161,20 +576,65 @@ class HfChatbot(TextGenerationAPI):
             )
         else:
             inputs["input_ids"] = np.asarray(
-                [copy(tokens) for _ in range(self.num_sampled)],
+                [copy(tokens[cached_length:]) for _ in range(num_sampled)],
                 dtype=self.dtypes["input_ids"],
             )
-            inputs["attention_mask"] = np.ones_like(
-                inputs["input_ids"], dtype=self.dtypes["attention_mask"]
+            inputs["attention_mask"] = np.ones(
+                [num_sampled, len(tokens)], dtype=self.dtypes["attention_mask"]
             )
+            if "position_ids" in self.dtypes:
+                inputs["position_ids"] = np.tile(
+                    np.arange(cached_length, len(tokens)), [num_sampled, 1]
+                ).astype(self.dtypes["position_ids"])
 
         if self.with_past:
             for i in self.model_inputs:
-                if "past_key_values" in i.name:
-                    shape_tuple = [self.shape_dict.get(dim, dim) for dim in i.shape]
+                if cached_past is not None and i.name in cached_past:
+                    inputs[i.name] = np.repeat(cached_past[i.name], num_sampled, axis=0)
+                elif "past_key_values" in i.name:
+                    shape_tuple = [shape_dict.get(dim, dim) for dim in i.shape]
                     inputs[i.name] = np.empty(shape_tuple, dtype=self.dtypes[i.name])
         return inputs
 
+    def get_cached_prefix(
+        self, tokens: List[int]
+    ) -> Tuple[int, Optional[Dict[str, np.ndarray]]]:
+        """Find past key values of the longest cached prefix of the prompt.
+
+        Args:
+            tokens: Tokenized prompt.
+
+        Returns:
+            (Length of the cached prefix, past key values for it or None)
+        """
+        cached_length, past = self.prompt_cache.get_longest_prefix(tokens)
+        if past is None:
+            return 0, None
+        # At least one token has to be fed to the model to get logits
+        length = min(cached_length, len(tokens) - 1)
+        past = {
+            name: value.take(range(length), axis=self.past_sequence_axis[name])
+            if length < cached_length
+            else value
+            for name, value in past.items()
+        }
+        return length, past
+
+    def cache_prompt(self, tokens: List[int], results: Dict[str, np.ndarray]):
+        """Cache past key values computed for the prompt.
+
+        Args:
+            tokens: Tokenized prompt.
+            results: Model results of the first generation step as numpy arrays or OrtValues.
+        """
+        past = {}
+        for name in self.past_names:
+            present = results[name.replace("past_key_values", "present")]
+            if isinstance(present, rt.OrtValue):
+                present = present.numpy()
+            past[name] = present[:1].copy()
+        self.prompt_cache.put(tokens, past)
+
     def update_inputs_with_results(
         self,
         inputs: Dict[str, np.ndarray],
@@ -198,10 +658,13 @@ class HfChatbot(TextGenerationAPI):
             inputs[ids_name] = np.asarray(
                 [[tok] for tok in decoded_tokens], dtype=self.dtypes[ids_name]
             )
-            inputs[att_mask_name] = np.ones(
-                [self.num_sampled, inputs[att_mask_name].shape[-1] + 1],
-                dtype=self.dtypes[att_mask_name],
+            inputs[att_mask_name] = self.get_attention_mask(
+                len(decoded_tokens), inputs[att_mask_name].shape[-1] + 1
             )
+            if "position_ids" in inputs:
+                inputs["position_ids"] = np.full_like(
+                    inputs["position_ids"][:, -1:], inputs[att_mask_name].shape[-1] - 1
+                )
             for inp in self.model_inputs:
                 if "past_key_values" in inp.name:
                     inputs[inp.name] = results[
@@ -224,12 +687,53 @@ class HfChatbot(TextGenerationAPI):
             )
             inputs[ids_name] = decoder_input_ids
             inputs[att_mask_name] = decoder_attention_mask
+            if "position_ids" in inputs:
+                inputs["position_ids"] = np.tile(
+                    np.arange(decoder_input_ids.shape[1]), [len(decoded_tokens), 1]
+                ).astype(inputs["position_ids"].dtype)
         return inputs
 
+    def get_attention_mask(self, batch_size: int, length: int) -> np.ndarray:
+        """Get attention mask of ones without allocating it on every step.
+
+        Mask is a view of a preallocated buffer that grows when needed.
+
+        Args:
+            batch_size: Batch size.
+            length: Sequence length.
+
+        Returns:
+            Attention mask of shape (batch_size, length).
+        """
+        size = batch_size * length
+        if self.attention_mask_buffer.size < size:
+            self.attention_mask_buffer = np.ones(
+                max(size, 2 * self.attention_mask_buffer.size),
+                dtype=self.attention_mask_buffer.dtype,
+            )
+        return self.attention_mask_buffer[:size].reshape([batch_size, length])
+
     def get_special_tokens(self) -> Dict[str, str]:
         """Return dict of special tokens to be renderable from template."""
         return self.special_tokens
 
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return prompt cache counters and draft acceptance rate in addition to the base metrics."""
+        metrics = super().get_metrics()
+        if self.use_prompt_cache:
+            metrics["prompt_cache"] = self.prompt_cache.stats()
+        if self.speculative is not None:
+            metrics["draft"] = self.speculative.stats()
+        return metrics
+
     def string_too_long(self, prompt):
         """Check if prompt is too long for the model."""
         return len(self.tokenizer.encode(prompt)) > self.trunc_length
+
+    def count_tokens(self, text: str) -> int:
+        """Count tokens in the text without special tokens."""
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def get_token_budget(self) -> int:
+        """Return maximum prompt length in tokens."""
+        return self.trunc_length
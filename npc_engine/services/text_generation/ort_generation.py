@@ -0,0 +1,200 @@
+"""Chatbot implementation for models with ONNX Runtime generation operators."""
+from typing import Any, Dict, List, Sequence, Union
+import json
+import os
+
+import numpy as np
+import onnxruntime as rt
+from tokenizers import Tokenizer
+
+from npc_engine.services.text_generation.text_generation_base import TextGenerationAPI
+from npc_engine.services.text_generation.utils import StopCondition
+from npc_engine.services.utils import DTYPE_MAP
+
+
+class OrtGenerationChatbot(TextGenerationAPI):
+    """Chatbot that runs the whole generation loop inside ONNX Runtime.
+
+    Requires `model.onnx` exported with one of `com.microsoft` BeamSearch, GreedySearch
+    or Sampling operators (e.g. with `onnxruntime.transformers.convert_generation`),
+    `tokenizer.json` with huggingface tokenizers definition and `special_tokens_map.json`.
+    Search, sampling and past key values are handled by the operator
+    so generation takes a single `InferenceSession.run` call.
+
+    Sampling parameters that are operator attributes (temperature and top_p of Sampling operator)
+    are fixed at export time, so `temperature` and `topk` arguments of requests are ignored.
+    Generation can't be interrupted so `deadline_ms` is ignored too.
+    Search parameters that are operator inputs are set from the config.
+    Replies of BeamSearch and GreedySearch are always deterministic
+    and replies of Sampling only with a fixed seed, so only those are cached.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        max_length: int = 100,
+        min_length: int = 2,
+        num_beams: int = 4,
+        length_penalty: float = 1.0,
+        repetition_penalty: float = 1.0,
+        trunc_length: int = 512,
+        encoder_decoder: bool = False,
+        seed: int = None,
+        sampling: bool = None,
+        *args,
+        **kwargs,
+    ):
+        """Create the chatbot from config args and kwargs.
+
+        Args:
+            model_path: path to scan for model files (weights and configs)
+            max_length: stop generation at this number of tokens
+            min_length: model can't stop generating text before it's atleast
+                this long in tokens
+            num_beams: number of beams for BeamSearch operator
+            length_penalty: exponential length penalty for BeamSearch operator
+            repetition_penalty: probability coef for same tokens to appear multiple times
+            trunc_length: length to truncate model prompt to
+            encoder_decoder: model was exported from encoder-decoder architecture.
+                Generated sequences of decoder-only models start with the prompt.
+            seed: random seed for Sampling operator. Random for each request if none.
+            sampling: model was exported with Sampling operator.
+                Detected by its `seed` and `presence_mask` inputs if none.
+        """
+        super().__init__(*args, **kwargs)
+        sess_options = rt.SessionOptions()
+        sess_options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.model = rt.InferenceSession(
+            os.path.join(model_path, "model.onnx"),
+            providers=self.get_providers(),
+            sess_options=sess_options,
+        )
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        special_tokens_map_path = os.path.join(model_path, "special_tokens_map.json")
+        with open(special_tokens_map_path, "r") as f:
+            self.special_tokens = json.load(f)
+        self.eos_token_id = self.tokenizer.encode(self.special_tokens["eos_token"]).ids[
+            0
+        ]
+
+        self.max_length = max_length
+        self.min_length = min_length
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.repetition_penalty = repetition_penalty
+        self.trunc_length = trunc_length
+        self.encoder_decoder = encoder_decoder
+        self.seed = seed
+        self.dtypes = {i.name: DTYPE_MAP[i.type] for i in self.model.get_inputs()}
+        if sampling is None:
+            sampling = "seed" in self.dtypes or "presence_mask" in self.dtypes
+        self.sampling = sampling
+
+    def run(
+        self,
+        prompt: str,
+        temperature: float = 1.0,
+        topk: int = None,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline_ms: float = None,
+        seed: int = None,
+    ) -> str:
+        """Run text generation from given prompt.
+
+        Args:
+            prompt: Formatted prompt.
+            temperature: Ignored, sampling parameters are fixed at export time.
+            topk: Ignored, sampling parameters are fixed at export time.
+            max_new_tokens: If not none stops generation at this number of tokens.
+            stop: Stop string or strings. Generated text is cut before them.
+            deadline_ms: Ignored, generation runs in a single call.
+            seed: Seed for Sampling operator. Overrides `seed` from config if not none.
+
+        Returns:
+            Generated text
+        """
+        prompt_ids = self.tokenizer.encode(prompt).ids
+        sequences = self.model.run(
+            ["sequences"], self.create_inputs(prompt_ids, max_new_tokens, seed)
+        )[0]
+        # (batch, num_return_sequences, length) for BeamSearch, (batch, length) otherwise
+        sequence = sequences.reshape([-1, sequences.shape[-1]])[0].tolist()
+        if not self.encoder_decoder:
+            sequence = sequence[len(prompt_ids) :]
+        condition = StopCondition(self.tokenizer, self.eos_token_id, stop=stop)
+        for token in sequence:
+            if condition.update([token]):
+                break
+        return condition.best([0])
+
+    def create_inputs(
+        self, prompt_ids: List[int], max_new_tokens: int = None, seed: int = None
+    ) -> Dict[str, Any]:
+        """Create inputs of the generation operator that the model exposes.
+
+        Args:
+            prompt_ids: Tokenized prompt.
+            max_new_tokens: Overrides `max_length` from config if not none.
+            seed: Overrides `seed` from config if not none.
+
+        Returns:
+            Dict of inputs to the model
+        """
+        if max_new_tokens is None:
+            max_new_tokens = self.max_length
+        prompt_length = 0 if self.encoder_decoder else len(prompt_ids)
+        if seed is None:
+            seed = self.seed
+        if seed is None:
+            seed = np.random.randint(np.iinfo(np.int32).max)
+        values = {
+            "input_ids": [prompt_ids],
+            "max_length": [prompt_length + max_new_tokens],
+            "min_length": [prompt_length + min(self.min_length, max_new_tokens)],
+            "num_beams": [self.num_beams],
+            "num_return_sequences": [1],
+            "length_penalty": [self.length_penalty],
+            "repetition_penalty": [self.repetition_penalty],
+            "attention_mask": np.ones([1, len(prompt_ids)]),
+            "seed": [seed],
+        }
+        return {
+            name: np.asarray(values[name], dtype=dtype)
+            for name, dtype in self.dtypes.items()
+            if name in values
+        }
+
+    def is_deterministic(self, params: Dict[str, Any], seed: int) -> bool:
+        """Check if the reply doesn't depend on random state.
+
+        Temperature is ignored by the operators, so replies of BeamSearch and GreedySearch
+        are always deterministic and replies of Sampling only if the seed is fixed
+        by the request or the config and the model has a `seed` input.
+
+        Args:
+            params: Generation parameters of `run` by name.
+            seed: Seed of the request.
+
+        Returns:
+            True if the same request always gets the same reply.
+        """
+        if not self.sampling:
+            return True
+        return "seed" in self.dtypes and (seed is not None or self.seed is not None)
+
+    def get_special_tokens(self) -> Dict[str, str]:
+        """Return dict of special tokens to be renderable from template."""
+        return self.special_tokens
+
+    def string_too_long(self, prompt: str) -> bool:
+        """Check if prompt is too long for the model."""
+        return len(self.tokenizer.encode(prompt)) > self.trunc_length
+
+    def count_tokens(self, text: str) -> int:
+        """Count tokens in the text without special tokens."""
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def get_token_budget(self) -> int:
+        """Return maximum prompt length in tokens."""
+        return self.trunc_length
@@ -0,0 +1,347 @@
+"""Continuous batching of text generation requests."""
+import collections
+import itertools
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+import onnxruntime as rt
+from loguru import logger
+
+from npc_engine.services.text_generation.utils import StopCondition, decode_logits
+
+
+class GenerationJob:
+    """State of a single scheduled generation request."""
+
+    def __init__(
+        self,
+        job_id: int,
+        prompt_ids: List[int],
+        temperature: float,
+        topk: int,
+        num_sampled: int,
+        condition: StopCondition,
+        seed: int = None,
+    ):
+        """Create job with empty candidates.
+
+        Args:
+            job_id: Id of the job.
+            prompt_ids: Tokenized prompt.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from.
+            num_sampled: Number of candidates to sample.
+            condition: Per-request limits of the candidates.
+            seed: Seed of the random generator the job's candidates are sampled with.
+        """
+        self.job_id = job_id
+        self.prompt_ids = prompt_ids
+        self.temperature = temperature
+        self.topk = topk
+        self.tokens = [[] for _ in range(num_sampled)]
+        self.log_probs = [0 for _ in range(num_sampled)]
+        self.finished = [False for _ in range(num_sampled)]
+        self.condition = condition
+        self.rng = np.random.default_rng(seed)
+
+
+class ContinuousBatchScheduler:
+    """Runs generation requests of decoder-only HfChatbot models in a shared batch.
+
+    Requests are admitted into the running batch between decoding steps
+    and retired as soon as all their candidates are finished,
+    so that short replies don't wait for long ones and new requests don't wait for the batch to drain.
+    Past key values of sequences with different lengths are left padded
+    and padding is masked out with attention mask.
+    Model must accept `position_ids` so that padding doesn't shift token positions.
+    """
+
+    def __init__(self, model: Any, max_batch_sequences: int = 16):
+        """Create scheduler with empty batch.
+
+        Args:
+            model: HfChatbot exported with past key values.
+            max_batch_sequences: Maximum number of sequences decoded together.
+                Each request takes `num_sampled` sequences.
+        """
+        self.model = model
+        self.max_batch_sequences = max_batch_sequences
+        self.job_ids = itertools.count()
+        self.queue = collections.deque()
+        self.completed = []
+        self.rows: List[Tuple[GenerationJob, int]] = []
+        self.past = None
+        self.attention_mask = None
+        self.positions = None
+        self.last_tokens = None
+
+    def submit(
+        self,
+        prompt: str,
+        temperature: float = 1.0,
+        topk: int = None,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline: float = None,
+        seed: int = None,
+    ) -> int:
+        """Queue generation request.
+
+        Args:
+            prompt: Formatted prompt.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            max_new_tokens: If not none stops sequences at this number of tokens.
+            stop: Stop string or strings. Sequences are finished and cut before them.
+            deadline: `time.monotonic` time after which the best partial sequence is returned.
+            seed: Seed of the random generator used for this request only.
+
+        Returns:
+            Job id.
+        """
+        condition = StopCondition(
+            self.model.tokenizer,
+            self.model.eos_token_id,
+            self.model.num_sampled,
+            max_new_tokens,
+            stop,
+            deadline,
+        )
+        job = GenerationJob(
+            next(self.job_ids),
+            self.model.tokenizer.encode(prompt).ids,
+            temperature,
+            topk,
+            self.model.num_sampled,
+            condition,
+            seed,
+        )
+        self.queue.append(job)
+        return job.job_id
+
+    def complete(self, result: str) -> int:
+        """Add a job that is already done, e.g. served from cache.
+
+        Args:
+            result: Generated text.
+
+        Returns:
+            Job id.
+        """
+        job_id = next(self.job_ids)
+        self.completed.append((job_id, result))
+        return job_id
+
+    def has_jobs(self) -> bool:
+        """Check if there are queued, running or completed jobs."""
+        return len(self.queue) > 0 or len(self.rows) > 0 or len(self.completed) > 0
+
+    def step(self) -> List[Tuple[int, Any]]:
+        """Admit queued jobs and run one decoding step for the batch.
+
+        Returns:
+            List of (job id, generated text or exception) for finished jobs.
+        """
+        completed, self.completed = self.completed, []
+        failed = self.admit()
+        finished = self.retire()
+        if len(self.rows) > 0:
+            try:
+                self.decode()
+            except Exception as e:
+                logger.exception(e)
+                failed += [(job.job_id, e) for job in self.running_jobs()]
+                self.reset()
+        finished += self.retire()
+        return (
+            completed
+            + failed
+            + [(job.job_id, job.condition.best(job.log_probs)) for job in finished]
+        )
+
+    def running_jobs(self) -> List[GenerationJob]:
+        """Return jobs that have sequences in the batch."""
+        return list({id(job): job for job, _ in self.rows}.values())
+
+    def reset(self):
+        """Drop all sequences from the batch."""
+        self.rows = []
+        self.past = None
+        self.attention_mask = None
+        self.positions = None
+        self.last_tokens = None
+
+    def admit(self) -> List[Tuple[int, Exception]]:
+        """Prefill queued jobs that fit into the batch and merge them into it.
+
+        Returns:
+            List of (job id, exception) for jobs that failed to prefill.
+        """
+        failed = []
+        while len(self.queue) > 0 and (
+            len(self.rows) == 0
+            or len(self.rows) + len(self.queue[0].tokens) <= self.max_batch_sequences
+        ):
+            job = self.queue.popleft()
+            try:
+                self.prefill(job)
+            except Exception as e:
+                logger.exception(e)
+                failed.append((job.job_id, e))
+        return failed
+
+    def prefill(self, job: GenerationJob):
+        """Run the prompt of the job through the model and add its sequences to the batch."""
+        num_sampled = len(job.tokens)
+        inputs = self.model.create_starter_inputs(
+            num_sampled=num_sampled, tokens=job.prompt_ids
+        )
+        logits, results = self.model.run_step(inputs)
+        if self.model.use_prompt_cache:
+            self.model.cache_prompt(job.prompt_ids, results)
+        tokens = self.sample(job, list(range(num_sampled)), logits[:, -1, :])
+        past = {
+            name: _to_numpy(results[name.replace("past_key_values", "present")])
+            for name in self.model.past_names
+        }
+        mask = np.ones(
+            [num_sampled, len(job.prompt_ids)],
+            dtype=self.model.dtypes["attention_mask"],
+        )
+        positions = np.full([num_sampled], len(job.prompt_ids), dtype=np.int64)
+        self.merge(job, past, mask, positions, tokens)
+
+    def merge(
+        self,
+        job: GenerationJob,
+        past: Dict[str, np.ndarray],
+        mask: np.ndarray,
+        positions: np.ndarray,
+        tokens: np.ndarray,
+    ):
+        """Merge prefilled sequences into the batch left padding the shorter side."""
+        rows = [(job, candidate) for candidate in range(len(job.tokens))]
+        if len(self.rows) == 0:
+            self.rows = rows
+            self.past, self.attention_mask = past, mask
+            self.positions, self.last_tokens = positions, tokens
+            return
+        old_past = {name: _to_numpy(value) for name, value in self.past.items()}
+        self.past = {
+            name: np.concatenate(self._pad_past(name, [old_past[name], past[name]]))
+            for name in self.model.past_names
+        }
+        self.attention_mask = np.concatenate(
+            _left_pad([self.attention_mask, mask], axis=1)
+        )
+        self.positions = np.concatenate([self.positions, positions])
+        self.last_tokens = np.concatenate([self.last_tokens, tokens])
+        self.rows += rows
+
+    def decode(self):
+        """Run one decoding step for all sequences in the batch."""
+        dtypes = self.model.dtypes
+        inputs = {
+            "input_ids": self.last_tokens[:, None].astype(dtypes["input_ids"]),
+            "attention_mask": np.concatenate(
+                [
+                    self.attention_mask,
+                    np.ones([len(self.rows), 1], dtype=self.attention_mask.dtype),
+                ],
+                axis=1,
+            ),
+            **self.past,
+        }
+        if "position_ids" in dtypes:
+            inputs["position_ids"] = self.positions[:, None].astype(
+                dtypes["position_ids"]
+            )
+        logits, results = self.model.run_step(inputs)
+        logits = logits[:, -1, :]
+        tokens = np.empty([len(self.rows)], dtype=np.int64)
+        for job in self.running_jobs():
+            idx = [i for i, (row_job, _) in enumerate(self.rows) if row_job is job]
+            candidates = [self.rows[i][1] for i in idx]
+            tokens[idx] = self.sample(job, candidates, logits[idx])
+        self.past = {
+            name: results[name.replace("past_key_values", "present")]
+            for name in self.model.past_names
+        }
+        self.attention_mask = inputs["attention_mask"]
+        self.positions = self.positions + 1
+        self.last_tokens = tokens
+
+    def sample(
+        self, job: GenerationJob, candidates: List[int], logits: np.ndarray
+    ) -> np.ndarray:
+        """Sample next tokens for the candidates of the job and record them."""
+        if len(job.tokens[candidates[0]]) < self.model.min_length:
+            logits[:, self.model.eos_token_id] = float("-inf")
+        generated_ids = np.asarray(
+            [job.tokens[c] for c in candidates], dtype=np.int64
+        ).reshape([len(candidates), -1])
+        tokens, log_probs = decode_logits(
+            logits,
+            job.temperature,
+            job.topk,
+            [job.log_probs[c] for c in candidates],
+            self.model.topp,
+            self.model.repetition_penalty,
+            generated_ids,
+            job.rng,
+        )
+        job.condition.update(tokens, candidates)
+        for candidate, token, log_prob in zip(candidates, tokens, log_probs):
+            job.tokens[candidate].append(int(token))
+            job.log_probs[candidate] = log_prob
+        for candidate, finished in enumerate(job.condition.finished):
+            job.finished[candidate] = (
+                finished or len(job.tokens[candidate]) >= self.model.max_steps
+            )
+        return tokens
+
+    def retire(self) -> List[GenerationJob]:
+        """Remove finished sequences from the batch.
+
+        Returns:
+            Jobs that have all their candidates finished.
+        """
+        keep = [i for i, (job, c) in enumerate(self.rows) if not job.finished[c]]
+        if len(keep) == len(self.rows):
+            return []
+        finished = [job for job in self.running_jobs() if all(job.finished)]
+        if len(keep) == 0:
+            self.reset()
+            return finished
+        mask = self.attention_mask[keep]
+        start = int(np.argmax(mask.any(axis=0)))
+        self.attention_mask = mask[:, start:]
+        past = {}
+        for name, value in self.past.items():
+            value = _to_numpy(value).take(keep, axis=0)
+            axis = self.model.past_sequence_axis[name]
+            past[name] = value.take(range(start, value.shape[axis]), axis=axis)
+        self.past = past
+        self.rows = [self.rows[i] for i in keep]
+        self.positions = self.positions[keep]
+        self.last_tokens = self.last_tokens[keep]
+        return finished
+
+    def _pad_past(self, name: str, values: List[np.ndarray]) -> List[np.ndarray]:
+        return _left_pad(values, self.model.past_sequence_axis[name])
+
+
+def _left_pad(values: List[np.ndarray], axis: int) -> List[np.ndarray]:
+    length = max(value.shape[axis] for value in values)
+    padded = []
+    for value in values:
+        pad = [(0, 0)] * value.ndim
+        pad[axis] = (length - value.shape[axis], 0)
+        padded.append(np.pad(value, pad))
+    return padded
+
+
+def _to_numpy(value: Any) -> np.ndarray:
+    if isinstance(value, rt.OrtValue):
+        return value.numpy()
+    return value
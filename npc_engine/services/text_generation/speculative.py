@@ -0,0 +1,319 @@
+"""Speculative decoding with a small draft model."""
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+import onnxruntime as rt
+from loguru import logger
+
+from npc_engine.services.text_generation.utils import sample_probs, sampling_probs
+from npc_engine.services.utils import DTYPE_MAP
+
+
+class SequenceRunner:
+    """Runs decoder-only ONNX model on a single growing sequence.
+
+    Past key values of the already fed tokens are kept between calls
+    so that only new tokens are fed to models exported with past.
+    """
+
+    def __init__(self, session: rt.InferenceSession):
+        """Create runner for the session.
+
+        Args:
+            session: Decoder-only causal language model.
+        """
+        self.session = session
+        inputs = session.get_inputs()
+        self.dtypes = {i.name: DTYPE_MAP[i.type] for i in inputs}
+        self.past_inputs = [i for i in inputs if "past_key_values" in i.name]
+        self.with_past = len(self.past_inputs) > 0
+        self.past_sequence_axis = {
+            i.name: [
+                axis
+                for axis, dim in enumerate(i.shape)
+                if isinstance(dim, str) and "sequence" in dim
+            ][0]
+            for i in self.past_inputs
+        }
+        self.output_names = [o.name for o in session.get_outputs()]
+        self.reset()
+
+    def reset(self, past: Dict[str, np.ndarray] = None, length: int = 0):
+        """Start a new sequence.
+
+        Args:
+            past: Past key values of the first `length` tokens of the sequence.
+            length: Number of tokens covered by past.
+        """
+        if past is None:
+            past = {
+                i.name: np.empty(
+                    [
+                        1 if dim == "batch" else 0 if isinstance(dim, str) else dim
+                        for dim in i.shape
+                    ],
+                    dtype=self.dtypes[i.name],
+                )
+                for i in self.past_inputs
+            }
+            length = 0
+        self.past = past
+        self.length = length
+
+    def forward(self, ids: List[int]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Feed tokens of the sequence that were not fed yet.
+
+        Args:
+            ids: Whole sequence.
+
+        Returns:
+            (Logits for the fed tokens of shape (tokens, vocab_size), results by output name)
+        """
+        start = self.length if self.with_past else 0
+        inputs = {
+            "input_ids": np.asarray([ids[start:]], dtype=self.dtypes["input_ids"])
+        }
+        if "attention_mask" in self.dtypes:
+            inputs["attention_mask"] = np.ones(
+                [1, len(ids)], dtype=self.dtypes["attention_mask"]
+            )
+        if "position_ids" in self.dtypes:
+            inputs["position_ids"] = np.arange(start, len(ids))[None].astype(
+                self.dtypes["position_ids"]
+            )
+        inputs.update(self.past)
+        outputs = self.session.run(None, inputs)
+        results = dict(zip(self.output_names, outputs))
+        if self.with_past:
+            self.past = {
+                name: results[name.replace("past_key_values", "present")]
+                for name in self.past
+            }
+            self.length = len(ids)
+        return outputs[0][0], results
+
+    def rewind(self, length: int):
+        """Drop past key values of the tokens after `length`."""
+        if length >= self.length:
+            return
+        self.past = {
+            name: self.prefix(name, value, length) for name, value in self.past.items()
+        }
+        self.length = length
+
+    def prefix(self, name: str, value: np.ndarray, length: int) -> np.ndarray:
+        """Slice past key values of the first `length` tokens."""
+        index = [slice(None)] * value.ndim
+        index[self.past_sequence_axis[name]] = slice(0, length)
+        return value[tuple(index)]
+
+
+class SpeculativeDecoder:
+    """Generates tokens of HfChatbot proposing them with a smaller draft model.
+
+    Draft model proposes `num_draft_tokens` tokens that are verified
+    by the main model in one forward pass.
+    Proposals are accepted with probability min(1, p / q) and the first rejected one is resampled
+    from the normalized max(0, p - q) so that the generated tokens follow the main model's distribution.
+    Draft model must share the tokenizer with the main model.
+    """
+
+    def __init__(
+        self, model: Any, draft_session: rt.InferenceSession, num_draft_tokens: int = 4
+    ):
+        """Create decoder.
+
+        Args:
+            model: Decoder-only HfChatbot.
+            draft_session: Draft causal language model.
+            num_draft_tokens: Number of tokens proposed by draft model for each verification.
+        """
+        self.model = model
+        self.target = SequenceRunner(model.model)
+        self.draft = SequenceRunner(draft_session)
+        self.num_draft_tokens = num_draft_tokens
+        self.proposed = 0
+        self.accepted = 0
+
+    def acceptance_rate(self) -> float:
+        """Return fraction of proposed draft tokens accepted by the main model."""
+        if self.proposed == 0:
+            return 0.0
+        return self.accepted / self.proposed
+
+    def stats(self) -> Dict[str, float]:
+        """Return counters of proposed and accepted draft tokens with the acceptance rate."""
+        return {
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": self.acceptance_rate(),
+        }
+
+    def generate_tokens(
+        self,
+        prompt_ids: List[int],
+        temperature: float,
+        topk: int,
+        rng: np.random.Generator = None,
+    ) -> Iterator[Tuple[List[int], List[float]]]:
+        """Sample a token sequence from the main model.
+
+        Args:
+            prompt_ids: Tokenized prompt.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            rng: Random generator to sample with. Global numpy random state is used if None.
+
+        Yields:
+            ([Sampled token], [cumulative sequence log probability])
+        """
+        self.target.reset(*self.get_cached_prefix(prompt_ids))
+        self.draft.reset()
+        ids = list(prompt_ids)
+        log_prob = 0
+        while len(ids) - len(prompt_ids) < self.model.max_steps:
+            generated = ids[len(prompt_ids) :]
+            num_draft = min(
+                self.num_draft_tokens, self.model.max_steps - len(generated) - 1
+            )
+            drafts, draft_probs = self.propose(
+                ids, generated, num_draft, temperature, topk, rng
+            )
+            logits, _ = self.target.forward(ids + drafts)
+            if len(generated) == 0 and self.model.use_prompt_cache:
+                self.cache_prompt(prompt_ids)
+            tokens, token_log_probs = self.verify(
+                generated,
+                drafts,
+                draft_probs,
+                logits[-(num_draft + 1) :],
+                temperature,
+                topk,
+                rng,
+            )
+            self.target.rewind(len(ids) + len(tokens) - 1)
+            self.draft.rewind(len(ids) + len(tokens) - 1)
+            for token, token_log_prob in zip(tokens, token_log_probs):
+                ids.append(token)
+                log_prob += token_log_prob
+                yield [token], [log_prob]
+                if token == self.model.eos_token_id:
+                    logger.info(f"Draft acceptance rate {self.acceptance_rate():.2f}")
+                    return
+        logger.info(f"Draft acceptance rate {self.acceptance_rate():.2f}")
+
+    def propose(
+        self,
+        ids: List[int],
+        generated: List[int],
+        num_draft: int,
+        temperature: float,
+        topk: int,
+        rng: np.random.Generator = None,
+    ) -> Tuple[List[int], List[np.ndarray]]:
+        """Sample draft tokens continuing the sequence.
+
+        Args:
+            ids: Whole sequence.
+            generated: Generated part of the sequence.
+            num_draft: Number of tokens to propose.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            rng: Random generator to sample with.
+
+        Returns:
+            (Draft tokens, distributions they were sampled from)
+        """
+        drafts, draft_probs = [], []
+        for _ in range(num_draft):
+            logits, _ = self.draft.forward(ids + drafts)
+            probs = self.probs(logits[-1], generated + drafts, temperature, topk)
+            drafts.append(int(sample_probs(probs[None], rng)[0]))
+            draft_probs.append(probs)
+        return drafts, draft_probs
+
+    def verify(
+        self,
+        generated: List[int],
+        drafts: List[int],
+        draft_probs: List[np.ndarray],
+        logits: np.ndarray,
+        temperature: float,
+        topk: int,
+        rng: np.random.Generator = None,
+    ) -> Tuple[List[int], List[float]]:
+        """Accept draft tokens with acceptance sampling.
+
+        Args:
+            generated: Tokens generated before the drafts.
+            drafts: Draft tokens.
+            draft_probs: Draft distributions the tokens were sampled from.
+            logits: Main model logits for the positions of the drafts and the following one.
+            temperature: Temperature parameter for sampling.
+            topk: If not none selects top n of predictions to sample from during generation.
+            rng: Random generator to sample with.
+
+        Returns:
+            (Accepted tokens followed by a resampled or a bonus one, their log probabilities)
+        """
+        random = np.random if rng is None else rng
+        tokens, log_probs = [], []
+        for j, draft in enumerate(drafts + [None]):
+            probs = self.probs(logits[j], generated + tokens, temperature, topk)
+            if draft is None:
+                token = int(sample_probs(probs[None], rng)[0])
+            elif random.random() * draft_probs[j][draft] < probs[draft]:
+                token = draft
+                self.accepted += 1
+            else:
+                residual = np.maximum(probs - draft_probs[j], 0)
+                token = int(
+                    sample_probs(
+                        (residual if residual.sum() > 0 else probs)[None], rng
+                    )[0]
+                )
+            tokens.append(token)
+            with np.errstate(divide="ignore"):
+                log_prob = np.log2(probs[token])
+            log_probs.append(log_prob if np.isfinite(log_prob) else -10)
+            if token != draft or token == self.model.eos_token_id:
+                break
+        self.proposed += len(drafts)
+        return tokens, log_probs
+
+    def probs(
+        self, logits: np.ndarray, generated: List[int], temperature: float, topk: int
+    ) -> np.ndarray:
+        """Compute sampling distribution for the next token."""
+        logits = np.array(logits, dtype=np.float64)
+        if len(generated) < self.model.min_length:
+            logits[self.model.eos_token_id] = float("-inf")
+        return sampling_probs(
+            logits[None],
+            temperature,
+            topk,
+            self.model.topp,
+            self.model.repetition_penalty,
+            np.asarray([generated], dtype=np.int64),
+        )[0]
+
+    def get_cached_prefix(
+        self, prompt_ids: List[int]
+    ) -> Tuple[Dict[str, np.ndarray], int]:
+        """Get past key values of the cached prompt prefix for the main model."""
+        if not self.model.use_prompt_cache:
+            return None, 0
+        length, past = self.model.get_cached_prefix(prompt_ids)
+        return past, length
+
+    def cache_prompt(self, prompt_ids: List[int]):
+        """Cache past key values of the prompt computed by the main model."""
+        self.model.cache_prompt(
+            prompt_ids,
+            {
+                name.replace("past_key_values", "present"): self.target.prefix(
+                    name, value, len(prompt_ids)
+                )
+                for name, value in self.target.past.items()
+            },
+        )
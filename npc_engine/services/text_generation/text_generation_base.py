@@ -1,9 +1,17 @@
 """Module that implements text generation model API."""
-from itertools import chain
-from typing import Dict, Any, List
+from bisect import bisect_left
+import copy
+from functools import lru_cache
+import hashlib
+import inspect
+import json
+from itertools import accumulate, chain
+from typing import Dict, Any, Iterator, List, Optional, Sequence, Tuple, Union
 
 from abc import abstractmethod
 from npc_engine.services.base_service import BaseService
+from npc_engine.services.utils.streams import StreamRegistry
+from npc_engine.services.utils.lru_cache import TTLLRUCache
 from loguru import logger
 from jinja2 import Template
 from jinja2schema import infer, to_json_schema
@@ -16,9 +24,12 @@ class TextGenerationAPI(BaseService):
 
     API_METHODS: List[str] = [
         "generate_reply",
+        "generate_reply_start",
+        "generate_reply_get_results",
         "get_prompt_template",
         "get_special_tokens",
         "get_context_template",
+        "get_metrics",
     ]
 
     def __init__(
@@ -26,6 +37,11 @@ class TextGenerationAPI(BaseService):
         template_string: str = None,
         context_template: str = None,
         history_template: str = None,
+        max_streams: int = 16,
+        stream_idle_timeout: float = 60,
+        response_cache_size: int = 0,
+        response_cache_ttl: float = None,
+        history_cache_size: int = 4096,
         *args,
         **kwargs,
     ):
@@ -33,6 +49,13 @@ class TextGenerationAPI(BaseService):
 
         Args:
             template_string: Template string to be rendered as prompt.
+            max_streams: Maximum number of concurrently streamed replies.
+                Least recently polled stream is dropped when it's exceeded.
+            stream_idle_timeout: Seconds after which not polled stream is dropped.
+            response_cache_size: Number of replies to deterministic requests
+                (temperature 0 or fixed seed) to cache. Disabled if 0.
+            response_cache_ttl: Seconds after which cached replies expire. Never if None.
+            history_cache_size: Number of separately rendered history entries to cache.
         """
         super().__init__(*args, **kwargs)
         if template_string is not None:
@@ -49,6 +72,13 @@ class TextGenerationAPI(BaseService):
             self.history_template_string = history_template
             self.context_template = Template(context_template)
             self.history_template = Template(history_template)
+        self.streams = StreamRegistry(max_streams, stream_idle_timeout)
+        self.response_cache = TTLLRUCache(response_cache_size, response_cache_ttl)
+        self._count_tokens_cached = lru_cache(maxsize=4096)(self.count_tokens)
+        self.history_cache = TTLLRUCache(history_cache_size)
+        self.incremental_history = None
+        self._special_tokens = None
+        self.context_template_schema = self.infer_context_template()
         self.initialized = True
 
     @classmethod
@@ -56,49 +86,235 @@ class TextGenerationAPI(BaseService):
         """Get the API name."""
         return "TextGenerationAPI"
 
-    def generate_reply(self, context: Dict[str, Any], *args, **kwargs) -> str:
+    def generate_reply(
+        self, context: Dict[str, Any], *args, seed: int = None, **kwargs
+    ) -> str:
         """Format the model prompt and generate response.
 
+        Replies to deterministic requests are served from the response cache if it's enabled.
+
         Args:
             context: Prompt context.
             *args
-            **kwargs
+            seed: Seed of the random generator used for this request only.
+                Makes the reply reproducible. Passed to `run` if set.
+            **kwargs: Generation parameters passed to `run`:
+                `temperature`, `topk`, `max_new_tokens`, `stop` strings
+                and `deadline_ms` after which the best partial reply is returned.
 
         Returns:
             Text response to a prompt.
         """
+        prompt = self.render_prompt(context)
+        key = self.get_response_key(prompt, seed, *args, **kwargs)
+        reply = self.response_cache.get(key) if key is not None else None
+        if reply is not None:
+            return reply
+        if seed is not None:
+            kwargs["seed"] = seed
+        reply = self.run(prompt, *args, **kwargs)
+        if key is not None:
+            self.response_cache.put(key, reply)
+        return reply
+
+    def get_response_key(
+        self, prompt: str, seed: int, *args, **kwargs
+    ) -> Optional[str]:
+        """Build response cache key for the request if its reply is deterministic.
+
+        Reply is deterministic if `is_deterministic` says so and it has no time budget.
+
+        Args:
+            prompt: Formatted prompt.
+            seed: Seed for random sampling.
+            *args: Generation parameters passed to `run`.
+            **kwargs: Generation parameters passed to `run`.
+
+        Returns:
+            Key of the reply or None if it should not be cached.
+        """
+        if self.response_cache.max_size <= 0:
+            return None
+        try:
+            arguments = inspect.signature(self.run).bind(prompt, *args, **kwargs)
+        except TypeError:
+            return None
+        arguments.apply_defaults()
+        params = dict(arguments.arguments)
+        params.update(params.pop("kwargs", {}))
+        if params.get("deadline_ms") is not None:
+            return None
+        if not self.is_deterministic(params, seed):
+            return None
+        key = json.dumps([params, seed], sort_keys=True, default=str)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def is_deterministic(self, params: Dict[str, Any], seed: int) -> bool:
+        """Check if the reply doesn't depend on random state.
+
+        Reply is deterministic if it's generated greedily (temperature 0) or with a fixed seed.
+
+        Args:
+            params: Generation parameters of `run` by name.
+            seed: Seed for random sampling.
+
+        Returns:
+            True if the same request always gets the same reply.
+        """
+        return seed is not None or params.get("temperature") == 0
+
+    def generate_reply_start(self, context: Dict[str, Any], *args, **kwargs) -> str:
+        """Format the model prompt and start streaming generation of the response.
+
+        Generated text is then retrieved piece by piece with `generate_reply_get_results`.
+
+        Args:
+            context: Prompt context.
+            *args
+            **kwargs
+
+        Returns:
+            Id of the started stream.
+        """
+        prompt = self.render_prompt(context)
+        return self.streams.add(self.run_stream(prompt, *args, **kwargs))
+
+    def generate_reply_get_results(self, stream_id: str) -> Dict[str, Any]:
+        """Retrieve the next piece of text generated by the stream.
+
+        Args:
+            stream_id: Id returned by `generate_reply_start`.
+
+        Returns:
+            Dict with `text` delta generated since the last call
+            and `finished` flag that is set when generation is over.
+        """
+        try:
+            delta = self.streams.next(stream_id)
+        except StopIteration:
+            return {"text": "", "finished": True}
+        return {"text": delta, "finished": False}
+
+    def render_prompt(self, context: Dict[str, Any]) -> str:
+        """Render model prompt from the context, cropping history if it's too long.
+
+        Args:
+            context: Prompt context.
+
+        Returns:
+            Formatted prompt.
+        """
         if not self.initialized:
             raise AssertionError(
                 "Can not generate replies before Base Service class was initialized"
             )
+        variables = {**context, **self.get_cached_special_tokens()}
         if self.legacy:
-            prompt = self.template.render(**context, **self.get_special_tokens())
+            prompt = self.template.render(variables)
         else:
             history = context.get("history", [])
-            history_prompt = self.history_template.render(
-                **context, **self.get_special_tokens()
-            )
-            context_prompt = self.context_template.render(
-                **context, **self.get_special_tokens()
-            )
-            prompt = context_prompt + "".join(history_prompt)
-
-            if isinstance(history, list):
-                while self.string_too_long(prompt):
+            context_prompt = self.context_template.render(variables)
+            if isinstance(history, list) and len(history) > 0:
+                fragments = self.render_history_entries(variables)
+                start = self.truncate_history(fragments, context_prompt)
+                if start > 0:
+                    logger.warning(f"Deleted {history[:start]} from history")
+                    del history[:start]
+                    del fragments[:start]
+                prompt = context_prompt + self.join_history(variables, fragments)
+                # Token counts of separately rendered entries are an estimate
+                while self.string_too_long(prompt) and len(history) > 0:
                     deleted = history.pop(0)
+                    fragments.pop(0)
                     logger.warning(f"Deleted {deleted} from history")
-                    history_prompt = self.history_template.render(
-                        **context, **self.get_special_tokens()
-                    )
-                    prompt = context_prompt + history_prompt
-                    if len(history) == 0:
-                        break
+                    prompt = context_prompt + self.join_history(variables, fragments)
             else:
-                history_prompt = self.history_template.render(
-                    **context, **self.get_special_tokens()
-                )
+                history_prompt = self.history_template.render(variables)
                 prompt = context_prompt + history_prompt
-        return self.run(prompt, *args, **kwargs)
+        return prompt
+
+    def render_history_entries(
+        self, variables: Dict[str, Any]
+    ) -> List[Tuple[str, Optional[int]]]:
+        """Render each history entry separately reusing cached fragments.
+
+        Fragments are cached by the entry and the rest of the context
+        so that only entries added since the previous turn are rendered and tokenized.
+
+        Args:
+            variables: Prompt context merged with special tokens.
+
+        Returns:
+            List of (rendered entry, its token count) for each history entry.
+        """
+        shared_key = json.dumps(
+            {key: value for key, value in variables.items() if key != "history"},
+            sort_keys=True,
+            default=str,
+        )
+        fragments = []
+        for entry in variables["history"]:
+            key = (shared_key, json.dumps(entry, sort_keys=True, default=str))
+            fragment = self.history_cache.get(key)
+            if fragment is None:
+                text = self.history_template.render({**variables, "history": [entry]})
+                fragment = (text, self.count_tokens(text))
+                self.history_cache.put(key, fragment)
+            fragments.append(fragment)
+        return fragments
+
+    def join_history(
+        self, variables: Dict[str, Any], fragments: List[Tuple[str, Optional[int]]]
+    ) -> str:
+        """Build history part of the prompt.
+
+        Separately rendered entries are concatenated if the history template
+        renders the same way, otherwise the whole history is rendered.
+        This is checked once on the first history with several entries.
+
+        Args:
+            variables: Prompt context merged with special tokens.
+            fragments: Rendered history entries.
+
+        Returns:
+            Rendered history.
+        """
+        if self.incremental_history:
+            return "".join(text for text, _ in fragments)
+        history_prompt = self.history_template.render(variables)
+        if self.incremental_history is None and len(fragments) > 1:
+            self.incremental_history = history_prompt == "".join(
+                text for text, _ in fragments
+            )
+            if not self.incremental_history:
+                logger.info(
+                    "History template entries depend on each other, "
+                    "rendering whole history on each request"
+                )
+        return history_prompt
+
+    def truncate_history(
+        self, fragments: List[Tuple[str, Optional[int]]], context_prompt: str
+    ) -> int:
+        """Find the oldest history entries to drop so that the prompt fits into the token budget.
+
+        Kept suffix is found with a binary search over prefix sums of
+        cached token counts of the entries without re-tokenizing the whole prompt.
+
+        Args:
+            fragments: Rendered history entries with their token counts.
+            context_prompt: Rendered context part of the prompt.
+
+        Returns:
+            Number of entries to drop.
+        """
+        budget = self.get_token_budget()
+        counts = [count for _, count in fragments]
+        if budget is None or None in counts:
+            return 0
+        prefix_sums = list(accumulate(counts, initial=0))
+        budget -= self._count_tokens_cached(context_prompt)
+        return bisect_left(prefix_sums, prefix_sums[-1] - budget)
 
     def get_prompt_template(self) -> str:
         """Return prompt template string used to render model prompt.
@@ -114,6 +330,16 @@ class TextGenerationAPI(BaseService):
     def get_context_template(self) -> Dict[str, Any]:
         """Return context template.
 
+        Schema is inferred from the templates once on initialization.
+
+        Returns:
+            Example context
+        """
+        return copy.deepcopy(self.context_template_schema)
+
+    def infer_context_template(self) -> Dict[str, Any]:
+        """Infer example context from the template strings.
+
         Returns:
             Example context
         """
@@ -139,8 +365,37 @@ class TextGenerationAPI(BaseService):
                     combined_dict[key] = context_dict[key]
             return combined_dict
 
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return runtime metrics of the model, e.g. cache hit rates.
+
+        Returns:
+            Dict mapping metric name to its value or to a dict of counters.
+        """
+        metrics = {}
+        if self.response_cache.max_size > 0:
+            metrics["response_cache"] = self.response_cache.stats()
+        return metrics
+
+    def get_cached_special_tokens(self) -> Dict[str, str]:
+        """Return special tokens to render templates with.
+
+        Special tokens are requested from the model once on the first render.
+        """
+        if self._special_tokens is None:
+            self._special_tokens = dict(self.get_special_tokens())
+        return self._special_tokens
+
     @abstractmethod
-    def run(self, prompt: str, temperature: float = 1, topk: int = None) -> str:
+    def run(
+        self,
+        prompt: str,
+        temperature: float = 1,
+        topk: int = None,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline_ms: float = None,
+        seed: int = None,
+    ) -> str:
         """Abstract method for concrete implementation of generation.
 
         Args:
@@ -148,12 +403,59 @@ class TextGenerationAPI(BaseService):
             temperature: Temperature parameter for sampling.
                 Controls how random model output is: more temperature - more randomness
             topk: If not none selects top n of predictions to sample from during generation.
+            max_new_tokens: If not none stops generation at this number of tokens.
+            stop: Stop string or strings. Generated text is cut before them.
+            deadline_ms: If not none stops generation after this time
+                and returns the best partial result.
+            seed: Seed of the random generator used for this request only.
+                Sampling must not use or change global random state if it's set.
 
         Returns:
             Generated text
         """
         return None
 
+    def run_stream(
+        self, prompt: str, temperature: float = 1, topk: int = None, **kwargs
+    ) -> Iterator[str]:
+        """Generate text from the prompt as a sequence of text deltas.
+
+        Models that can decode token by token should override this.
+        Default implementation yields whole `run` result at once.
+
+        Args:
+            prompt: Fromatted prompt.
+            temperature: Temperature parameter for sampling.
+                Controls how random model output is: more temperature - more randomness
+            topk: If not none selects top n of predictions to sample from during generation.
+            **kwargs: Per-request limits passed to `run`.
+
+        Yields:
+            Pieces of generated text.
+        """
+        yield self.run(prompt, temperature, topk, **kwargs)
+
+    def count_tokens(self, text: str) -> Optional[int]:
+        """Count tokens in the text without special tokens.
+
+        Models that return None are truncated with `string_too_long` only.
+
+        Args:
+            text: Text to tokenize.
+
+        Returns:
+            Number of tokens or None if not supported.
+        """
+        return None
+
+    def get_token_budget(self) -> Optional[int]:
+        """Return maximum prompt length in tokens.
+
+        Returns:
+            Maximum number of tokens or None if not supported.
+        """
+        return None
+
     @abstractmethod
     def string_too_long(self, prompt: str) -> bool:
         """Check if prompt is too long.
@@ -1,38 +1,341 @@
 """Utility functions for the text generation service."""
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import time
 import numpy as np
 import scipy.special as scp
+from tokenizers import Tokenizer
 
 
 def decode_logits(
-    logits: np.ndarray, temperature: float, topk: int, log_probs: List[float]
-) -> Tuple[int, List[float]]:
-    """Decode logits to token.
+    logits: np.ndarray,
+    temperature: float,
+    topk: int,
+    log_probs: List[float],
+    topp: float = None,
+    repetition_penalty: float = 1.0,
+    generated_ids: np.ndarray = None,
+    rng: np.random.Generator = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample next tokens for the whole batch of logits at once.
 
     Args:
         logits: Logits to decode of shape (batch, vocab_size,)
         temperature: Temperature parameter for sampling.
+            If 0 tokens are selected greedily.
         topk: If not none selects top n of predictions to sample from during generation.
         log_probs: Cummulative logarithm of sequence probabilities for previous tokens in the sequence.
+        topp: If not none samples from the smallest set of tokens
+            with cumulative probability above this value (nucleus sampling).
+        repetition_penalty: Logits of already generated tokens are divided by this value
+            (multiplied if negative).
+        generated_ids: Tokens generated so far of shape (batch, sequence).
+            Used for repetition penalty.
+        rng: Random generator to sample with. Global numpy random state is used if None.
 
     Returns:
-        Tuple of (token, log_probs)
-        where token is the decoded token and sequence_probabilities are update
+        Tuple of (tokens, log_probs)
+        where tokens are the sampled tokens for each row and log_probs are updated
     """
-    tokens = []
-    for i, logit in enumerate(logits):
-        if topk is not None:
-            ind = np.argpartition(logit, -topk)[-topk:]
-            new_logits = np.zeros(logit.shape)
-            new_logits[ind] = logit[ind]
-            logit = new_logits
-
-        probs = scp.softmax(logit / temperature, axis=0)
-        token = np.random.choice(np.arange(probs.shape[0]), p=probs)
-        if np.isnan(np.log2(probs[token])):
-            log_probs[i] += -10
-        else:
-            log_probs[i] += np.log2(probs[token])
-        token = token.ravel()[0]
-        tokens.append(token)
-    return tokens, log_probs
+    logits = _penalize_repetitions(
+        np.array(logits, dtype=np.float64), repetition_penalty, generated_ids
+    )
+    rows = np.arange(logits.shape[0])
+    if temperature == 0:
+        tokens = logits.argmax(axis=-1)
+        probs = scp.softmax(logits, axis=-1)
+    else:
+        probs = scp.softmax(_filter_logits(logits / temperature, topk, topp), axis=-1)
+        tokens = sample_probs(probs, rng)
+    with np.errstate(divide="ignore"):
+        token_log_probs = np.log2(probs[rows, tokens])
+    token_log_probs[~np.isfinite(token_log_probs)] = -10
+    return tokens, np.asarray(log_probs) + token_log_probs
+
+
+def sampling_probs(
+    logits: np.ndarray,
+    temperature: float,
+    topk: int,
+    topp: float = None,
+    repetition_penalty: float = 1.0,
+    generated_ids: np.ndarray = None,
+) -> np.ndarray:
+    """Compute distributions that `decode_logits` samples tokens from.
+
+    Args:
+        logits: Logits of shape (batch, vocab_size,)
+        temperature: Temperature parameter for sampling.
+            If 0 distributions are one-hot at the greedy token.
+        topk: If not none keeps only top n of predictions.
+        topp: If not none keeps the smallest set of tokens
+            with cumulative probability above this value.
+        repetition_penalty: Logits of already generated tokens are divided by this value
+            (multiplied if negative).
+        generated_ids: Tokens generated so far of shape (batch, sequence).
+
+    Returns:
+        Probabilities of shape (batch, vocab_size,)
+    """
+    logits = _penalize_repetitions(
+        np.array(logits, dtype=np.float64), repetition_penalty, generated_ids
+    )
+    if temperature == 0:
+        probs = np.zeros_like(logits)
+        probs[np.arange(logits.shape[0]), logits.argmax(axis=-1)] = 1
+        return probs
+    return scp.softmax(_filter_logits(logits / temperature, topk, topp), axis=-1)
+
+
+def sample_probs(probs: np.ndarray, rng: np.random.Generator = None) -> np.ndarray:
+    """Sample a token from each row of (possibly unnormalized) probabilities.
+
+    Args:
+        probs: Probabilities of shape (batch, vocab_size,)
+        rng: Random generator to sample with. Global numpy random state is used if None.
+
+    Returns:
+        Sampled tokens of shape (batch,)
+    """
+    cdf = np.cumsum(probs, axis=-1)
+    random = (np.random if rng is None else rng).random([probs.shape[0], 1])
+    random = random * cdf[:, -1:]
+    return np.minimum((cdf < random).sum(axis=-1), probs.shape[-1] - 1)
+
+
+def _penalize_repetitions(
+    logits: np.ndarray, repetition_penalty: float, generated_ids: np.ndarray
+) -> np.ndarray:
+    """Apply repetition penalty to already generated tokens inplace."""
+    if repetition_penalty == 1 or generated_ids is None or np.size(generated_ids) == 0:
+        return logits
+    rows = np.arange(logits.shape[0])
+    penalized = logits[rows[:, None], generated_ids]
+    logits[rows[:, None], generated_ids] = np.where(
+        penalized < 0,
+        penalized * repetition_penalty,
+        penalized / repetition_penalty,
+    )
+    return logits
+
+
+def _filter_logits(logits: np.ndarray, topk: int, topp: float) -> np.ndarray:
+    """Mask logits outside of top-k and top-p with -inf inplace."""
+    if topk is not None and topk < logits.shape[-1]:
+        kth = np.partition(logits, -topk, axis=-1)[:, -topk, None]
+        logits[logits < kth] = float("-inf")
+    if topp is not None and topp < 1:
+        _mask_nucleus(logits, topp)
+    return logits
+
+
+def _mask_nucleus(logits: np.ndarray, topp: float):
+    """Mask logits outside of top-p nucleus with -inf inplace."""
+    order = np.argsort(-logits, axis=-1)
+    sorted_logits = np.take_along_axis(logits, order, axis=-1)
+    sorted_probs = scp.softmax(sorted_logits, axis=-1)
+    outside = np.cumsum(sorted_probs, axis=-1) - sorted_probs > topp
+    sorted_logits[outside] = float("-inf")
+    np.put_along_axis(logits, order, sorted_logits, axis=-1)
+
+
+def decode_stream(
+    tokenizer: Tokenizer,
+    tokens: Iterable[int],
+    eos_token_id: int,
+    stop: Union[str, Sequence[str]] = None,
+) -> Iterator[str]:
+    """Decode a stream of tokens into text deltas.
+
+    Whole sequence is re-decoded on every token so that merges of subword tokens
+    are handled by the tokenizer. Deltas ending with an incomplete character
+    are held back until the following tokens complete it.
+    Text that may be the beginning of a stop string is held back
+    until it's clear it is not.
+
+    Args:
+        tokenizer: Tokenizer to decode tokens with.
+        tokens: Iterable of generated token ids.
+        eos_token_id: Token id that ends the stream.
+        stop: Stop string or strings. Stream ends before the first of them.
+
+    Yields:
+        Text generated since previous delta.
+    """
+    stop = _as_list(stop)
+    ids = []
+    text = ""
+    new_text = ""
+    for token in tokens:
+        if token == eos_token_id:
+            break
+        ids.append(int(token))
+        new_text = tokenizer.decode(ids, skip_special_tokens=True)
+        new_text, stopped = truncate_at_stop(new_text, stop, len(text))
+        if stopped:
+            break
+        if new_text.endswith("\ufffd"):
+            continue
+        end = len(new_text) - _stop_prefix_length(new_text, stop)
+        if end <= len(text):
+            continue
+        delta = new_text[len(text) : end]
+        text = new_text[:end]
+        yield delta
+    if len(new_text) > len(text) and not new_text.endswith("\ufffd"):
+        yield new_text[len(text) :]
+
+
+def limit_stream(
+    steps: Iterable[Tuple[List[int], List[float]]], condition: "StopCondition"
+) -> Iterator[int]:
+    """Take tokens of the first sequence from generation steps until condition is met.
+
+    Args:
+        steps: Generation steps yielding (tokens, log probabilities).
+        condition: Stop condition of a single sequence.
+
+    Yields:
+        Generated tokens.
+    """
+    for tokens, _ in steps:
+        yield tokens[0]
+        if condition.update(tokens[:1]):
+            break
+
+
+def truncate_at_stop(
+    text: str, stop: Sequence[str], start: int = 0
+) -> Tuple[str, bool]:
+    """Cut text before the first stop string.
+
+    Args:
+        text: Generated text.
+        stop: Stop strings.
+        start: Position in the text before which stop strings were already checked.
+
+    Returns:
+        (Text before the first stop string, whether it was found)
+    """
+    if len(stop) == 0:
+        return text, False
+    start = max(0, start - max(len(s) for s in stop) + 1)
+    found = [index for index in (text.find(s, start) for s in stop) if index >= 0]
+    if len(found) == 0:
+        return text, False
+    return text[: min(found)], True
+
+
+def _stop_prefix_length(text: str, stop: Sequence[str]) -> int:
+    """Get length of the longest text suffix that is a proper prefix of a stop string."""
+    return max(
+        [
+            length
+            for s in stop
+            for length in range(1, len(s))
+            if text.endswith(s[:length])
+        ],
+        default=0,
+    )
+
+
+def _as_list(stop: Union[str, Sequence[str], None]) -> List[str]:
+    if stop is None:
+        return []
+    if isinstance(stop, str):
+        return [stop]
+    return [s for s in stop if len(s) > 0]
+
+
+def get_deadline(deadline_ms: Optional[float]) -> Optional[float]:
+    """Convert time budget in milliseconds to `time.monotonic` deadline."""
+    if deadline_ms is None:
+        return None
+    return time.monotonic() + deadline_ms / 1000
+
+
+class StopCondition:
+    """Tracks per-request limits of sampled sequences.
+
+    Sequence is finished when it produces end of sequence token,
+    when it's decoded text contains a stop string
+    or when `max_new_tokens` tokens were generated.
+    All sequences are finished when the deadline passes.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        eos_token_id: int,
+        num_sequences: int = 1,
+        max_new_tokens: int = None,
+        stop: Union[str, Sequence[str]] = None,
+        deadline: float = None,
+    ):
+        """Create condition for sequences without tokens.
+
+        Args:
+            tokenizer: Tokenizer to decode tokens with.
+            eos_token_id: End of sequence token id.
+            num_sequences: Number of tracked sequences.
+            max_new_tokens: Maximum number of tokens in a sequence.
+            stop: Stop string or strings.
+            deadline: `time.monotonic` time after which generation is stopped.
+        """
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.max_new_tokens = max_new_tokens
+        self.stop = _as_list(stop)
+        self.deadline = deadline
+        self.tokens = [[] for _ in range(num_sequences)]
+        self.texts = ["" for _ in range(num_sequences)]
+        self.finished = [False for _ in range(num_sequences)]
+
+    def update(self, tokens: Iterable[int], sequences: Iterable[int] = None) -> bool:
+        """Record next tokens of the sequences.
+
+        Args:
+            tokens: Next token for each sequence.
+            sequences: Indices of the sequences the tokens belong to. Defaults to all.
+
+        Returns:
+            True if all sequences are finished.
+        """
+        if sequences is None:
+            sequences = range(len(self.tokens))
+        for i, token in zip(sequences, tokens):
+            if self.finished[i]:
+                continue
+            if token == self.eos_token_id:
+                self.finished[i] = True
+                continue
+            self.tokens[i].append(int(token))
+            if len(self.stop) > 0:
+                text = self.tokenizer.decode(self.tokens[i], skip_special_tokens=True)
+                self.texts[i], self.finished[i] = truncate_at_stop(
+                    text, self.stop, len(self.texts[i])
+                )
+            if (
+                self.max_new_tokens is not None
+                and len(self.tokens[i]) >= self.max_new_tokens
+            ):
+                self.finished[i] = True
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.finished = [True for _ in self.finished]
+        return all(self.finished)
+
+    def best(self, log_probs: Sequence[float]) -> str:
+        """Get text of the sequence with the highest mean token log probability.
+
+        Args:
+            log_probs: Cumulative log probabilities of the sequences.
+
+        Returns:
+            Generated text cut before stop strings.
+        """
+        mean_log_probs = [
+            log_prob / max(len(tokens), 1)
+            for log_prob, tokens in zip(log_probs, self.tokens)
+        ]
+        best = int(np.argmax(mean_log_probs))
+        text = self.tokenizer.decode(self.tokens[best], skip_special_tokens=True)
+        return truncate_at_stop(text, self.stop)[0]
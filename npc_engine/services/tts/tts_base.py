@@ -3,6 +3,7 @@ from typing import Iterable, List
 
 from abc import abstractmethod
 from npc_engine.services.base_service import BaseService
+from npc_engine.services.utils.streams import StreamRegistry
 import numpy as np
 import re
 
@@ -13,9 +14,17 @@ class TextToSpeechAPI(BaseService):
     #: Methods that are going to be exposed as services.
     API_METHODS: List[str] = ["tts_start", "tts_get_results", "get_speaker_ids"]
 
-    def __init__(self, *args, **kwargs) -> None:
-        """Empty initialization method for API to be similar to other model base classes."""
-        self.generator = None
+    def __init__(
+        self, max_streams: int = 16, stream_idle_timeout: float = 60, *args, **kwargs
+    ) -> None:
+        """Initialize the registry of speech generation streams.
+
+        Args:
+            max_streams: Maximum number of concurrently generated speech streams.
+                Least recently polled stream is dropped when it's exceeded.
+            stream_idle_timeout: Seconds after which not polled stream is dropped.
+        """
+        self.streams = StreamRegistry(max_streams, stream_idle_timeout)
         super().__init__(*args, **kwargs)
         self.initialized = True
 
@@ -24,7 +33,7 @@ class TextToSpeechAPI(BaseService):
         """Get the API name."""
         return "TextToSpeechAPI"
 
-    def tts_start(self, speaker_id: str, text: str, n_chunks: int) -> None:
+    def tts_start(self, speaker_id: str, text: str, n_chunks: int) -> str:
         """Initiate iterative generation of speech.
 
         Args:
@@ -32,9 +41,11 @@ class TextToSpeechAPI(BaseService):
             text: Text to generate speech from.
             n_chunks: Number of chunks to split generation into.
 
+        Returns:
+            Id of the stream to pass to `tts_get_results`.
         """
         sentences = re.split(r"(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s", text)
-        self.generator = self._chain_run(speaker_id, sentences, n_chunks)
+        return self.streams.add(self._chain_run(speaker_id, sentences, n_chunks))
 
     def _chain_run(self, speaker_id, sentences, n_chunks) -> Iterable[np.ndarray]:
         """Chain the run method to be used in the generator."""
@@ -43,15 +54,21 @@ class TextToSpeechAPI(BaseService):
             if sentence != "":
                 yield from self.run(speaker_id, sentence, n_chunks)
 
-    def tts_get_results(self) -> Iterable[np.ndarray]:
+    def tts_get_results(self, stream_id: str = None) -> np.ndarray:
         """Retrieve the next chunk of generated speech.
 
+        Array is sent as a list of floats or as a raw buffer
+        if client requested binary reply.
+
+        Args:
+            stream_id: Id returned by `tts_start`. Defaults to the last started stream.
+
         Returns:
             Next chunk of speech in the form of f32 ndarray.
         """
-        if self.generator is not None:
-            return next(self.generator).tolist()
-        else:
+        try:
+            return self.streams.next(stream_id)
+        except ValueError:
             raise ValueError(
                 "Speech generation was not started. Use tts_start to start it"
             )
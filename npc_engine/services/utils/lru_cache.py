@@ -1,80 +1,94 @@
 """LRU cache."""
 import collections
-from typing import Any, List, Tuple, Callable
+import time
+from typing import Any, Dict, List, Callable, Optional, Sequence, Tuple, Union
 import numpy as np
 
 
 class NumpyLRUCache:
-    """Dict based LRU cache for numpy arrays."""
+    """LRU cache for rows of numpy arrays backed by a single preallocated array.
+
+    Rows are stored in slots of a slab array of shape (size, *common_dim)
+    allocated in the dtype of the first cached batch.
+    Keys are mapped to slots in least recently used order
+    so that hits are gathered and misses are scattered with vectorized indexing.
+    """
 
     def __init__(self, size):
         """Crate cache."""
         self.size = size
         self.lru_cache = collections.OrderedDict()
         self.common_dim = None
+        self.slab = None
+        self.free_slots = list(range(max(size, 0)))[::-1]
 
-    def _get(self, key: Any, default=None) -> np.ndarray:
-        try:
-            value = self.lru_cache.pop(key)
-            self.lru_cache[key] = value
-            return value
-        except KeyError:
-            return default
-
-    def _put(self, key: Any, value: np.ndarray):
-        try:
-            self.lru_cache.pop(key)
-        except KeyError:
-            if len(self.lru_cache) >= self.size:
-                self.lru_cache.popitem(last=False)
-            self.lru_cache[key] = value
-
-    def cache_compute(
-        self, keys: List[Any], function: Callable
-    ) -> Tuple[np.ndarray, List[Any]]:
+    def cache_compute(self, keys: List[Any], function: Callable) -> np.ndarray:
         """Get batch from cache and compute missing.
 
+        Each missing key is computed once even if it's repeated.
+
         Args:
             keys: List of keys
+            function: Function that computes values for a list of missing keys.
 
         Returns:
-            np.ndarray or None: Found entries concatenated over 0 axis.
-            list(_) or None: Keys that were not found.
+            np.ndarray: Entries for the keys concatenated over 0 axis.
         """
-        if len(self.lru_cache) == 0:
-            result = function(keys)
-            self.put_batch(keys, result)
-            return result
+        slots = np.fromiter(
+            (self._get_slot(key) for key in keys), dtype=np.int64, count=len(keys)
+        )
+        if len(keys) > 0 and (slots >= 0).all():
+            return self.slab.take(slots, axis=0)
+        hit_rows = np.flatnonzero(slots >= 0)
+        miss_rows = np.flatnonzero(slots < 0)
+        missing = {}
+        miss_index = [missing.setdefault(keys[row], len(missing)) for row in miss_rows]
+        computed = np.asarray(function(list(missing)))
+        if len(missing) == len(keys):
+            result = computed
         else:
-            result = np.zeros((len(keys), *self.common_dim))
-            items = [self._get(key) for key in keys]
-            not_found = [key for item, key in zip(items, keys) if item is None]
-            if len(not_found) > 0:
-                computed = function(not_found)
-            computed_idx = 0
-            for idx, item in enumerate(items):
-                if item is None:
-                    result_slc = tuple([idx] + [slice(None)] * len(self.common_dim))
-                    computed_slc = tuple(
-                        [computed_idx] + [slice(None)] * len(self.common_dim)
-                    )
-                    result[result_slc] = computed[computed_slc]
-                    computed_idx += 1
-                else:
-                    result_slc = tuple([idx] + [slice(None)] * len(self.common_dim))
-                    result[result_slc] = item
+            result = np.empty((len(keys), *computed.shape[1:]), dtype=computed.dtype)
+            result[miss_rows] = computed[miss_index]
+            if len(hit_rows) > 0:
+                result[hit_rows] = self.slab.take(slots[hit_rows], axis=0)
+        if len(missing) > 0:
+            self.put_batch(list(missing), computed)
         return result
 
     def put_batch(self, keys: List[Any], values: np.ndarray):
         """Put batch to cache.
 
+        Only the last `size` entries are stored if the batch doesn't fit.
+
         Args:
             keys: List of keys
             values: Ndarray of shape (len(keys), *common_dim)
         """
         self._validate_shape(values)
-        for key, item in zip(keys, values):
-            self._put(key, item)
+        if self.size <= 0:
+            return
+        if self.slab is None:
+            self.slab = np.empty((self.size, *self.common_dim), dtype=values.dtype)
+        entries = dict(zip(keys, range(len(keys))))
+        for key in entries:
+            slot = self.lru_cache.pop(key, None)
+            if slot is not None:
+                self.free_slots.append(slot)
+        rows = list(entries.values())[-self.size :]
+        while len(self.free_slots) < len(rows):
+            _, slot = self.lru_cache.popitem(last=False)
+            self.free_slots.append(slot)
+        slots = [self.free_slots.pop() for _ in rows]
+        self.slab[slots] = values[rows]
+        for row, slot in zip(rows, slots):
+            self.lru_cache[keys[row]] = slot
+
+    def _get_slot(self, key: Any) -> int:
+        slot = self.lru_cache.get(key)
+        if slot is None:
+            return -1
+        self.lru_cache.move_to_end(key)
+        return slot
 
     def _validate_shape(self, value):
         if self.common_dim is None:
@@ -87,3 +101,239 @@ class NumpyLRUCache:
                     Shape found: {value.shape[1:]}
                 """
                 )
+
+
+class MemoryLRUCache:
+    """LRU cache for numpy arrays bounded by their total memory size.
+
+    Values can be single arrays or dicts of arrays.
+    Hits and misses are counted to monitor cache efficiency.
+    """
+
+    def __init__(self, max_bytes: int):
+        """Create cache.
+
+        Args:
+            max_bytes: Maximum total size of cached arrays in bytes.
+                Cache is disabled if 0.
+        """
+        self.max_bytes = max_bytes
+        self.lru_cache = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: Any) -> bool:
+        """Check if key is cached without updating its recency and counters."""
+        return key in self.lru_cache
+
+    def __len__(self) -> int:
+        """Return number of cached entries."""
+        return len(self.lru_cache)
+
+    def keys(self) -> List[Any]:
+        """Return cached keys from least to most recently used."""
+        return list(self.lru_cache.keys())
+
+    def get(
+        self, key: Any, default=None
+    ) -> Union[np.ndarray, Dict[str, np.ndarray], None]:
+        """Get cached value and mark it as recently used.
+
+        Args:
+            key: Key of the value.
+            default: Value to return if key is not cached.
+
+        Returns:
+            Cached value or default.
+        """
+        if key not in self.lru_cache:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.lru_cache.move_to_end(key)
+        return self.lru_cache[key]
+
+    def put(self, key: Any, value: Union[np.ndarray, Dict[str, np.ndarray]]):
+        """Put value to cache evicting least recently used entries to fit it.
+
+        Values bigger than the cache itself are not stored.
+
+        Args:
+            key: Key of the value.
+            value: Array or dict of arrays.
+        """
+        nbytes = self._nbytes(value)
+        if key in self.lru_cache:
+            self._discard(key)
+        if nbytes > self.max_bytes:
+            return
+        while self.total_bytes + nbytes > self.max_bytes:
+            self._discard(next(iter(self.lru_cache)))
+        self.lru_cache[key] = value
+        self.total_bytes += nbytes
+
+    def hit_rate(self) -> float:
+        """Return share of cache lookups that were hits."""
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit and miss counters with the hit rate."""
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate()}
+
+    def _discard(self, key: Any):
+        self.total_bytes -= self._nbytes(self.lru_cache.pop(key))
+
+    @staticmethod
+    def _nbytes(value: Union[np.ndarray, Dict[str, np.ndarray]]) -> int:
+        if isinstance(value, dict):
+            return sum(v.nbytes for v in value.values())
+        return value.nbytes
+
+
+class TokenPrefixLRUCache(MemoryLRUCache):
+    """Memory bounded LRU cache keyed by token sequences.
+
+    Cached sequences are indexed in a trie so that the longest cached prefix
+    of a sequence is found in a single walk over its tokens.
+    """
+
+    #: Trie node key marking the end of a cached sequence.
+    _END = None
+
+    def __init__(self, max_bytes: int):
+        """Create cache.
+
+        Args:
+            max_bytes: Maximum total size of cached arrays in bytes.
+                Cache is disabled if 0.
+        """
+        super().__init__(max_bytes)
+        self.trie = {}
+
+    def put(
+        self, key: Sequence[int], value: Union[np.ndarray, Dict[str, np.ndarray]]
+    ):
+        """Put value for the token sequence to cache.
+
+        Args:
+            key: Token sequence.
+            value: Array or dict of arrays.
+        """
+        key = tuple(key)
+        super().put(key, value)
+        if key in self.lru_cache:
+            node = self.trie
+            for token in key:
+                node = node.setdefault(token, {})
+            node[self._END] = True
+
+    def get_longest_prefix(
+        self, tokens: Sequence[int]
+    ) -> Tuple[int, Optional[Union[np.ndarray, Dict[str, np.ndarray]]]]:
+        """Get cached value of the longest cached prefix of the tokens.
+
+        Args:
+            tokens: Token sequence.
+
+        Returns:
+            (Length of the prefix, its cached value) or (0, None) if nothing is cached.
+        """
+        node, length = self.trie, 0
+        for i, token in enumerate(tokens):
+            node = node.get(token)
+            if node is None:
+                break
+            if self._END in node:
+                length = i + 1
+        if length == 0:
+            self.misses += 1
+            return 0, None
+        return length, self.get(tuple(tokens[:length]))
+
+    def _discard(self, key: Tuple[int, ...]):
+        super()._discard(key)
+        path = [self.trie]
+        for token in key:
+            path.append(path[-1][token])
+        del path[-1][self._END]
+        for depth in range(len(key), 0, -1):
+            if len(path[depth]) > 0:
+                break
+            del path[depth - 1][key[depth - 1]]
+
+
+class TTLLRUCache:
+    """LRU cache bounded by number of entries with optional time to live.
+
+    Hits and misses are counted to monitor cache efficiency.
+    """
+
+    def __init__(self, max_size: int, ttl: float = None):
+        """Create cache.
+
+        Args:
+            max_size: Maximum number of cached entries. Cache is disabled if 0.
+            ttl: Seconds after which entries expire. Entries don't expire if None.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lru_cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: Any) -> bool:
+        """Check if key is cached and not expired without updating counters."""
+        return key in self.lru_cache and not self._expired(key)
+
+    def __len__(self) -> int:
+        """Return number of cached entries including expired ones not yet evicted."""
+        return len(self.lru_cache)
+
+    def get(self, key: Any, default=None) -> Any:
+        """Get cached value and mark it as recently used.
+
+        Args:
+            key: Key of the value.
+            default: Value to return if key is not cached or expired.
+
+        Returns:
+            Cached value or default.
+        """
+        if key in self.lru_cache and self._expired(key):
+            del self.lru_cache[key]
+        if key not in self.lru_cache:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.lru_cache.move_to_end(key)
+        return self.lru_cache[key][0]
+
+    def put(self, key: Any, value: Any):
+        """Put value to cache evicting least recently used entries to fit it.
+
+        Args:
+            key: Key of the value.
+            value: Value to cache.
+        """
+        if self.max_size <= 0:
+            return
+        self.lru_cache.pop(key, None)
+        while len(self.lru_cache) >= self.max_size:
+            self.lru_cache.popitem(last=False)
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self.lru_cache[key] = (value, expires)
+
+    def hit_rate(self) -> float:
+        """Return share of cache lookups that were hits."""
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit and miss counters with the hit rate."""
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate()}
+
+    def _expired(self, key: Any) -> bool:
+        expires = self.lru_cache[key][1]
+        return expires is not None and time.monotonic() > expires
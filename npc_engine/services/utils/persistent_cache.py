@@ -0,0 +1,297 @@
+"""Append-only on-disk cache for numpy arrays."""
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from typing import Any, Callable, Iterator, List
+
+import numpy as np
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+def file_fingerprint(path: str) -> str:
+    """Compute sha1 hash of the file contents.
+
+    Args:
+        path: Path to the file.
+
+    Returns:
+        Hex digest of the hash.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Hold an exclusive inter-process lock on the file while in the context.
+
+    Args:
+        path: Path to the lock file. It's created if it doesn't exist.
+    """
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class PersistentNumpyCache:
+    """Cache for rows of numpy arrays that persists between service restarts.
+
+    Rows are appended to a raw binary file that is memory-mapped on load
+    and their keys are appended to a json lines index in the same order.
+    Cache is cleared when its fingerprint (e.g. hash of the model file) changes.
+    Entries are never evicted.
+
+    Several processes (e.g. service replicas) can share the cache directory.
+    Files are only changed with an exclusive file lock held
+    and entries appended by other processes are read before appending.
+    """
+
+    ROWS_FILE = "rows.bin"
+    KEYS_FILE = "keys.jsonl"
+    META_FILE = "meta.json"
+    LOCK_FILE = "cache.lock"
+
+    def __init__(self, path: str, fingerprint: str):
+        """Open the cache creating it if it doesn't exist.
+
+        Args:
+            path: Directory to store cache files in.
+            fingerprint: Identifier of the function that computes the values.
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.index = {}
+        self.num_rows = 0
+        self.keys_offset = 0
+        self.rows = None
+        self.dtype = None
+        self.common_dim = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def __len__(self) -> int:
+        """Return number of cached entries."""
+        return len(self.index)
+
+    def __contains__(self, key: Any) -> bool:
+        """Check if key is cached."""
+        return key in self.index
+
+    def load(self):
+        """Memory-map cached rows and read their keys.
+
+        Rows without a key and partially written keys are dropped.
+        """
+        with file_lock(self._file(self.LOCK_FILE)):
+            self._load()
+
+    def clear(self):
+        """Remove all entries and start the cache for the current fingerprint."""
+        with file_lock(self._file(self.LOCK_FILE)):
+            self._clear()
+
+    def _load(self):
+        meta = self._read_meta()
+        if meta is None or meta.get("fingerprint") != self.fingerprint:
+            self._clear()
+            return
+        if meta.get("dtype") is None:
+            self._reset()
+            return
+        self.dtype = np.dtype(meta["dtype"])
+        self.common_dim = tuple(meta["shape"])
+        keys = []
+        if os.path.exists(self._file(self.KEYS_FILE)):
+            with open(self._file(self.KEYS_FILE), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        keys.append(_as_key(json.loads(line)))
+                    except ValueError:
+                        break
+        rows_path = self._file(self.ROWS_FILE)
+        rows_size = os.path.getsize(rows_path) if os.path.exists(rows_path) else 0
+        count = min(len(keys), rows_size // self._row_bytes())
+        with open(rows_path, "ab") as f:
+            f.truncate(count * self._row_bytes())
+        with open(self._file(self.KEYS_FILE), "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(key) + "\n" for key in keys[:count])
+        self.index = {key: row for row, key in enumerate(keys[:count])}
+        self.num_rows = count
+        self.keys_offset = os.path.getsize(self._file(self.KEYS_FILE))
+        self._map()
+
+    def _clear(self):
+        self._reset()
+        for name in [self.ROWS_FILE, self.KEYS_FILE]:
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+        self._write_meta()
+
+    def _reset(self):
+        self.rows = None
+        self.index = {}
+        self.num_rows = 0
+        self.keys_offset = 0
+        self.dtype = None
+        self.common_dim = None
+
+    def cache_compute(self, keys: List[Any], function: Callable) -> np.ndarray:
+        """Get batch from cache and compute and append missing.
+
+        Args:
+            keys: List of keys
+            function: Function that computes values for a list of missing keys.
+
+        Returns:
+            np.ndarray: Entries for the keys concatenated over 0 axis.
+        """
+        rows = np.fromiter(
+            (self.index.get(key, -1) for key in keys), dtype=np.int64, count=len(keys)
+        )
+        if len(keys) > 0 and (rows >= 0).all():
+            return np.asarray(self.rows[rows])
+        hit_rows = np.flatnonzero(rows >= 0)
+        miss_rows = np.flatnonzero(rows < 0)
+        missing = {}
+        miss_index = [missing.setdefault(keys[row], len(missing)) for row in miss_rows]
+        computed = np.asarray(function(list(missing)))
+        if len(missing) == len(keys):
+            result = computed
+        else:
+            result = np.empty((len(keys), *computed.shape[1:]), dtype=computed.dtype)
+            result[miss_rows] = computed[miss_index]
+            if len(hit_rows) > 0:
+                result[hit_rows] = self.rows[rows[hit_rows]]
+        if len(missing) > 0:
+            self.append(list(missing), computed)
+        return result
+
+    def append(self, keys: List[Any], values: np.ndarray):
+        """Append entries to the cache files.
+
+        Keys appended by other processes in the meantime are skipped.
+
+        Args:
+            keys: List of keys that are not cached yet.
+            values: Ndarray of shape (len(keys), *common_dim)
+        """
+        with file_lock(self._file(self.LOCK_FILE)):
+            self._sync()
+            if self.common_dim is None:
+                self.dtype = values.dtype
+                self.common_dim = values.shape[1:]
+                self._write_meta()
+            elif self.common_dim != values.shape[1:]:
+                raise ValueError(
+                    f"""Cached arrays must have the same shape.
+                    Shape expected: {self.common_dim}
+                    Shape found: {values.shape[1:]}
+                """
+                )
+            new = [row for row, key in enumerate(keys) if key not in self.index]
+            keys = [keys[row] for row in new]
+            values = np.ascontiguousarray(values[new], dtype=self.dtype)
+            with open(self._file(self.ROWS_FILE), "ab") as f:
+                f.write(values.tobytes())
+            with open(self._file(self.KEYS_FILE), "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(key) + "\n" for key in keys)
+            for key in keys:
+                self.index[key] = self.num_rows
+                self.num_rows += 1
+            self.keys_offset = os.path.getsize(self._file(self.KEYS_FILE))
+        self._map()
+
+    def _sync(self):
+        """Read entries appended to the files by other processes.
+
+        Must be called with the lock held.
+        Cache is reloaded if the files were rewritten.
+        """
+        meta = self._read_meta()
+        keys_path = self._file(self.KEYS_FILE)
+        size = os.path.getsize(keys_path) if os.path.exists(keys_path) else 0
+        if (
+            meta is None
+            or meta.get("fingerprint") != self.fingerprint
+            or (meta.get("dtype") is None) != (self.dtype is None)
+            or size < self.keys_offset
+        ):
+            self._load()
+            return
+        if size == self.keys_offset:
+            return
+        with open(keys_path, "rb") as f:
+            f.seek(self.keys_offset)
+            lines = f.read().split(b"\n")
+        if lines[-1].strip() != b"":
+            self._load()
+            return
+        for line in lines[:-1]:
+            self.index[_as_key(json.loads(line))] = self.num_rows
+            self.num_rows += 1
+        self.keys_offset = size
+
+    def _map(self):
+        if self.num_rows == 0:
+            self.rows = None
+            return
+        self.rows = np.memmap(
+            self._file(self.ROWS_FILE),
+            dtype=self.dtype,
+            mode="r",
+            shape=(self.num_rows, *self.common_dim),
+        )
+
+    def _row_bytes(self) -> int:
+        return self.dtype.itemsize * int(np.prod(self.common_dim))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_meta(self):
+        try:
+            with open(self._file(self.META_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self):
+        with open(self._file(self.META_FILE), "w") as f:
+            json.dump(
+                {
+                    "fingerprint": self.fingerprint,
+                    "dtype": None if self.dtype is None else self.dtype.str,
+                    "shape": None if self.common_dim is None else self.common_dim,
+                },
+                f,
+            )
+
+
+def _as_key(value: Any) -> Any:
+    if isinstance(value, list):
+        return tuple(_as_key(item) for item in value)
+    return value
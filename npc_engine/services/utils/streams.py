@@ -0,0 +1,90 @@
+"""Registry of concurrently running generation streams."""
+import collections
+import time
+from typing import Any, Iterator
+import uuid
+
+from loguru import logger
+
+
+class StreamRegistry:
+    """Bounded registry of generators addressed by stream ids.
+
+    Streams are kept in least recently used order.
+    Streams that were not polled for `idle_timeout` seconds are evicted
+    and when there are more than `max_streams` open the least recently used one is dropped.
+    """
+
+    def __init__(self, max_streams: int = 16, idle_timeout: float = 60):
+        """Create empty registry.
+
+        Args:
+            max_streams: Maximum number of open streams.
+            idle_timeout: Seconds after which not polled stream is evicted.
+        """
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.streams = collections.OrderedDict()
+        self.last_stream_id = None
+
+    def __len__(self) -> int:
+        """Return number of open streams."""
+        return len(self.streams)
+
+    def __contains__(self, stream_id: str) -> bool:
+        """Check if stream is open."""
+        return stream_id in self.streams
+
+    def add(self, generator: Iterator[Any]) -> str:
+        """Register new stream.
+
+        Args:
+            generator: Generator that produces stream results.
+
+        Returns:
+            Id of the new stream.
+        """
+        self.evict_idle()
+        while len(self.streams) >= max(self.max_streams, 1):
+            stream_id, _ = self.streams.popitem(last=False)
+            logger.warning(f"Too many open streams, dropped stream {stream_id}")
+        stream_id = uuid.uuid4().hex
+        self.streams[stream_id] = (generator, time.monotonic())
+        self.last_stream_id = stream_id
+        return stream_id
+
+    def next(self, stream_id: str = None) -> Any:
+        """Advance the stream and return its next result.
+
+        Stream is closed when its generator is exhausted.
+
+        Args:
+            stream_id: Id of the stream. Defaults to the last started one.
+
+        Raises:
+            ValueError: If stream does not exist or was evicted.
+            StopIteration: If stream is finished.
+
+        Returns:
+            Next value produced by the stream.
+        """
+        if stream_id is None:
+            stream_id = self.last_stream_id
+        self.evict_idle()
+        try:
+            generator, _ = self.streams.pop(stream_id)
+        except KeyError:
+            raise ValueError(f"Stream {stream_id} was not started or was evicted")
+        value = next(generator)
+        self.streams[stream_id] = (generator, time.monotonic())
+        return value
+
+    def evict_idle(self):
+        """Drop streams that were not polled for longer than idle timeout."""
+        now = time.monotonic()
+        while len(self.streams) > 0:
+            stream_id, (_, last_access) = next(iter(self.streams.items()))
+            if now - last_access <= self.idle_timeout:
+                break
+            del self.streams[stream_id]
+            logger.info(f"Evicted idle stream {stream_id}")
@@ -0,0 +1,210 @@
+import numpy as np
+import onnxruntime as rt
+
+
+class NodeArg:
+    def __init__(self, name, shape, type="tensor(float)"):
+        self.name = name
+        self.shape = shape
+        self.type = type
+
+
+class IOBinding:
+    def __init__(self):
+        self.inputs = {}
+        self.output_names = []
+        self.outputs = []
+
+    def bind_cpu_input(self, name, value):
+        self.inputs[name] = np.asarray(value)
+
+    def bind_ortvalue_input(self, name, value):
+        self.inputs[name] = value.numpy()
+
+    def bind_output(self, name, *args, **kwargs):
+        self.output_names.append(name)
+
+    def get_outputs(self):
+        return self.outputs
+
+
+class InferenceSession:
+    """Session that computes outputs with numpy and records feeds of all calls."""
+
+    def __init__(self, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.calls = []
+
+    def get_inputs(self):
+        return self.inputs
+
+    def get_outputs(self):
+        return self.outputs
+
+    def run(self, output_names, feed, run_options=None):
+        self.calls.append(feed)
+        results = self.compute(feed)
+        if output_names is None:
+            output_names = [output.name for output in self.outputs]
+        return [results[name] for name in output_names]
+
+    def io_binding(self):
+        return IOBinding()
+
+    def run_with_iobinding(self, io_binding, run_options=None):
+        self.calls.append(io_binding.inputs)
+        results = self.compute(io_binding.inputs)
+        io_binding.outputs = [
+            rt.OrtValue.ortvalue_from_numpy(np.ascontiguousarray(results[name]))
+            for name in io_binding.output_names
+        ]
+
+    def compute(self, feed):
+        raise NotImplementedError()
+
+
+class DecoderSession(InferenceSession):
+    """Tiny causal language model.
+
+    Token and position embeddings are averaged over the attended tokens,
+    so logits depend on the whole sequence, positions and attention mask.
+    Past key values are the embeddings of the already fed tokens.
+    Only the first `vocab_size - 1` tokens and end of sequence token get finite logits.
+    """
+
+    def __init__(
+        self,
+        vocab_size=32,
+        eos_token_id=2,
+        logits_size=None,
+        hidden_size=8,
+        ids_name="input_ids",
+        past_name="past_key_values.0.key",
+        with_past=True,
+        position_ids=True,
+        attention_mask=True,
+        encoder=False,
+        batch="batch",
+        dtype="tensor(float)",
+        seed=0,
+    ):
+        rng = np.random.RandomState(seed)
+        self.np_dtype = np.float64 if dtype == "tensor(double)" else np.float32
+        self.token_ids = sorted(set(range(vocab_size - 1)) | {eos_token_id})
+        self.logits_size = logits_size or max(self.token_ids) + 1
+        self.embeddings = rng.randn(max(self.token_ids) + 1, hidden_size)
+        self.position_embeddings = rng.randn(512, hidden_size)
+        self.encoder_weights = rng.randn(hidden_size)
+        self.projection = 3 * rng.randn(hidden_size, len(self.token_ids))
+        self.ids_name = ids_name
+        self.past_name = past_name if with_past else None
+        self.batch = batch
+        inputs = [NodeArg(ids_name, [batch, "sequence"], "tensor(int64)")]
+        if attention_mask:
+            inputs.append(
+                NodeArg(
+                    "attention_mask",
+                    [batch, "past_sequence + sequence"],
+                    "tensor(int64)",
+                )
+            )
+        if position_ids:
+            inputs.append(NodeArg("position_ids", [batch, "sequence"], "tensor(int64)"))
+        if encoder:
+            inputs.append(
+                NodeArg("encoder_hidden_state", [batch, "encoder_sequence", 1024])
+            )
+        outputs = [NodeArg("logits", [batch, "sequence", self.logits_size], dtype)]
+        if with_past:
+            shape = ["batch", 1, "past_sequence + sequence", hidden_size]
+            inputs.append(NodeArg(past_name, shape, dtype))
+            outputs.append(
+                NodeArg(past_name.replace("past_key_values", "present"), shape, dtype)
+            )
+        super().__init__(inputs, outputs)
+
+    def compute(self, feed):
+        ids = np.asarray(feed[self.ids_name])
+        batch_size, length = ids.shape
+        if self.batch == 1:
+            assert batch_size == 1
+        past = feed.get(self.past_name)
+        past_length = 0 if past is None else past.shape[2]
+        mask = feed.get("attention_mask", np.ones([batch_size, past_length + length]))
+        positions = feed.get(
+            "position_ids",
+            np.tile(np.arange(past_length, past_length + length), [batch_size, 1]),
+        )
+        states = (self.embeddings[ids] + self.position_embeddings[positions]).astype(
+            self.np_dtype
+        )
+        if past is not None:
+            states = np.concatenate([past[:, 0], states], axis=1)
+        hidden = np.empty([batch_size, length, states.shape[-1]])
+        for t in range(length):
+            weights = mask[:, : past_length + t + 1, None].astype(self.np_dtype)
+            hidden[:, t] = (states[:, : past_length + t + 1] * weights).sum(
+                axis=1
+            ) / np.maximum(weights.sum(axis=1), 1)
+        if "encoder_hidden_state" in feed:
+            encoder_state = np.asarray(feed["encoder_hidden_state"]).mean(axis=(1, 2))
+            hidden += encoder_state[:, None, None] * self.encoder_weights
+        logits = np.full([batch_size, length, self.logits_size], -1e4)
+        logits[:, :, self.token_ids] = np.tanh(hidden) @ self.projection
+        results = {"logits": logits.astype(self.np_dtype)}
+        if self.past_name is not None:
+            present_name = self.past_name.replace("past_key_values", "present")
+            results[present_name] = np.ascontiguousarray(states[:, None])
+        return results
+
+
+class GenerationSession(InferenceSession):
+    """Model exported with a `com.microsoft` BeamSearch, GreedySearch or Sampling operator.
+
+    Generates `tokens` after the prompt (or without it if `prefix_prompt` is false),
+    Sampling permutes them with its seed. Sequences are truncated to `max_length`.
+    """
+
+    def __init__(self, op="GreedySearch", tokens=(), prefix_prompt=True):
+        self.op = op
+        self.tokens = list(tokens)
+        self.prefix_prompt = prefix_prompt
+        inputs = [
+            NodeArg("input_ids", ["batch_size", "sequence_length"], "tensor(int32)"),
+            NodeArg("max_length", [1], "tensor(int32)"),
+            NodeArg("min_length", [1], "tensor(int32)"),
+        ]
+        if op == "BeamSearch":
+            inputs += [
+                NodeArg("num_beams", [1], "tensor(int32)"),
+                NodeArg("num_return_sequences", [1], "tensor(int32)"),
+                NodeArg("length_penalty", [1], "tensor(float)"),
+            ]
+        inputs += [
+            NodeArg("repetition_penalty", [1], "tensor(float)"),
+            NodeArg("vocab_mask", ["vocab_size"], "tensor(int32)"),
+            NodeArg("prefix_vocab_mask", ["batch_size", "vocab_size"], "tensor(int32)"),
+            NodeArg(
+                "attention_mask", ["batch_size", "sequence_length"], "tensor(int32)"
+            ),
+        ]
+        if op == "Sampling":
+            inputs.append(NodeArg("seed", [1], "tensor(int32)"))
+        if op == "BeamSearch":
+            shape = ["batch_size", "num_return_sequences", "max_length"]
+        else:
+            shape = ["batch_size", "max_length"]
+        super().__init__(inputs, [NodeArg("sequences", shape, "tensor(int32)")])
+
+    def compute(self, feed):
+        tokens = self.tokens
+        if self.op == "Sampling":
+            rng = np.random.RandomState(feed["seed"][0])
+            tokens = [tokens[i] for i in rng.permutation(len(tokens))]
+        sequence = list(feed["input_ids"][0]) if self.prefix_prompt else []
+        sequence = (sequence + tokens)[: feed["max_length"][0]]
+        sequences = np.asarray([sequence], dtype=np.int32)
+        if self.op == "BeamSearch":
+            sequences = sequences[:, None]
+        return {"sequences": sequences}
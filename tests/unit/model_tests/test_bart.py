@@ -1,5 +1,7 @@
 """Text generation test."""
 import os
+import numpy as np
+import onnxruntime as rt
 from npc_engine.services import BaseService
 import inspect
 import sys
@@ -10,6 +12,7 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 import mocks.zmq_mocks as zmq
+import mocks.ort_mocks as ort
 import yaml
 
 path = os.path.join(os.path.dirname(__file__), "..", "..", "resources", "models")
@@ -63,3 +66,121 @@ They keep shrinking!""",
         topk=None,
     )
     assert answer is not None
+
+
+def test_reply_stream_num_sampled():
+    """Check if streaming accepts the same generation parameters as generate_reply"""
+    chatbot_model = BaseService.create(
+        zmq.Context(), bart_paths[0], service_id="test", uri="test"
+    )
+    context = chatbot_model.get_context_template()
+    for num_sampled in [1, 2]:
+        stream_id = chatbot_model.generate_reply_start(
+            context, temperature=0.8, topk=None, num_sampled=num_sampled
+        )
+        result = chatbot_model.generate_reply_get_results(stream_id)
+        while not result["finished"]:
+            result = chatbot_model.generate_reply_get_results(stream_id)
+
+
+def create_with_decoder(monkeypatch, decoder):
+    """Create chatbot from the mock model replacing its decoder session"""
+    create_session = rt.InferenceSession
+
+    def create_decoder_session(path, *args, **kwargs):
+        if os.path.basename(path) == "decoder_bart.onnx":
+            return decoder
+        return create_session(path, *args, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(rt, "InferenceSession", create_decoder_session)
+        return BaseService.create(
+            zmq.Context(), bart_paths[0], service_id="test", uri="test"
+        )
+
+
+def create_decoder(with_past=False, batch="batch"):
+    return ort.DecoderSession(
+        vocab_size=64,
+        eos_token_id=2,
+        ids_name="decoder_input_ids",
+        past_name="past_key_values.0",
+        with_past=with_past,
+        position_ids=False,
+        attention_mask=False,
+        encoder=True,
+        batch=batch,
+    )
+
+
+def test_decoder_with_past(monkeypatch):
+    """Check if decoding with past key values gives the same tokens as full recompute"""
+    results = []
+    for with_past in [False, True]:
+        decoder = create_decoder(with_past)
+        chatbot_model = create_with_decoder(monkeypatch, decoder)
+        assert chatbot_model.with_past == with_past
+        chatbot_model.max_steps = 16
+        encoder_hidden_state = chatbot_model.encode_prompt("Hello friend!")
+        greedy = list(chatbot_model.generate_tokens(encoder_hidden_state, 0, None, 3))
+        sampled = list(
+            chatbot_model.generate_tokens(
+                encoder_hidden_state, 1.0, None, 3, np.random.default_rng(0)
+            )
+        )
+        results.append((greedy, sampled, decoder.calls))
+    (greedy, sampled, calls), (past_greedy, past_sampled, past_calls) = results
+    assert max(call["decoder_input_ids"].shape[1] for call in calls) > 1
+    assert all(call["decoder_input_ids"].shape[1] == 1 for call in past_calls)
+    assert len(set(token for tokens, _ in greedy for token in tokens)) > 2
+    assert len(set(tuple(tokens) for tokens, _ in sampled)) > 1
+    for expected, result in [(greedy, past_greedy), (sampled, past_sampled)]:
+        assert [tokens for tokens, _ in result] == [tokens for tokens, _ in expected]
+        assert np.allclose(result[-1][1], expected[-1][1])
+
+
+class RowGenerator:
+    """Random generator that draws each batch row from its own generator"""
+
+    def __init__(self, seeds):
+        self.generators = [np.random.default_rng(seed) for seed in seeds]
+
+    def random(self, size):
+        assert size[0] == len(self.generators)
+        return np.asarray([[rng.random()] for rng in self.generators])
+
+
+def test_decoder_batch(monkeypatch):
+    """Check if candidates decoded in one batch match candidates decoded one by one"""
+    decoder = create_decoder(batch=1)
+    single_model = create_with_decoder(monkeypatch, decoder)
+    batch_decoder = create_decoder()
+    batch_model = create_with_decoder(monkeypatch, batch_decoder)
+    assert single_model.decoder_batch_fixed
+    assert not batch_model.decoder_batch_fixed
+    for chatbot_model in [single_model, batch_model]:
+        chatbot_model.max_steps = 16
+    encoder_hidden_state = batch_model.encode_prompt("Hello friend!")
+    steps = list(
+        batch_model.generate_tokens(
+            encoder_hidden_state, 1.0, None, 3, RowGenerator([0, 1, 2])
+        )
+    )
+    assert all(call["decoder_input_ids"].shape[0] == 3 for call in batch_decoder.calls)
+    sequences = []
+    for row in range(3):
+        expected = list(
+            single_model.generate_tokens(
+                encoder_hidden_state, 1.0, None, 1, np.random.default_rng(row)
+            )
+        )
+        tokens = [step[0][row] for step in steps][: len(expected)]
+        assert tokens == [step[0][0] for step in expected]
+        assert np.isclose(steps[-1][1][row], expected[-1][1][0])
+        sequences.append(tuple(tokens))
+    assert len(set(sequences)) == 3
+
+    num_calls = len(batch_decoder.calls)
+    reply = batch_model.run("Hello friend!", temperature=0, num_sampled=3)
+    assert len(batch_decoder.calls) - num_calls <= batch_model.max_steps
+    assert reply == single_model.run("Hello friend!", temperature=0, num_sampled=3)
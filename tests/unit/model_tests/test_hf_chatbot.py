@@ -1,6 +1,9 @@
 """Text generation test."""
 import os
+import numpy as np
+import onnxruntime as rt
 from npc_engine.services import BaseService
+from npc_engine.services.text_generation import HfChatbot
 import time
 import inspect
 import sys
@@ -11,6 +14,7 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 import mocks.zmq_mocks as zmq
+import mocks.ort_mocks as ort
 import yaml
 
 path = os.path.join(os.path.dirname(__file__), "..", "..", "resources", "models")
@@ -32,6 +36,28 @@ hf_chatbot_paths = [
 ]
 
 
+def create_with_session(monkeypatch, session, **kwargs):
+    """Create chatbot with the tokenizer and config of the mock model and a stub session"""
+    config = dict(configs[subdirs.index(hf_chatbot_paths[0])], **kwargs)
+    config.pop("model_type")
+    with monkeypatch.context() as patch:
+        patch.setattr(rt, "InferenceSession", lambda *args, **kwargs: session)
+        return HfChatbot(
+            model_path=hf_chatbot_paths[0],
+            context=zmq.Context(),
+            uri="inproc://test",
+            service_id="test",
+            **config,
+        )
+
+
+def create_session(**kwargs):
+    """Create stub causal language model with gpt2 end of sequence token"""
+    return ort.DecoderSession(
+        vocab_size=64, eos_token_id=50256, logits_size=50257, **kwargs
+    )
+
+
 def test_reply_default():
     """Check if chatbot works"""
     chatbot_model = BaseService.create(
@@ -65,3 +91,305 @@ They keep shrinking!""",
     context = chatbot_model.get_context_template()
     assert isinstance(context, dict)
     assert answer is not None
+
+
+def test_reply_stream():
+    """Check if chatbot streams the reply"""
+    chatbot_model = BaseService.create(
+        zmq.Context(), hf_chatbot_paths[0], "inproc://test", service_id="test"
+    )
+    stream_id = chatbot_model.generate_reply_start(
+        context=dict(
+            name="pet dog",
+            persona="I am mans best friend.",
+            other_name="the town baker's husband",
+            other_persona="I love eating pastries.",
+            history=["<speaker_other>Hello friend!"],
+        ),
+        temperature=0.8,
+    )
+    chunks = []
+    result = chatbot_model.generate_reply_get_results(stream_id)
+    while not result["finished"]:
+        chunks.append(result["text"])
+        result = chatbot_model.generate_reply_get_results(stream_id)
+    assert len("".join(chunks)) > 0
+
+
+def test_prompt_cache():
+    """Check if past key values of the prompt prefix are reused"""
+    chatbot_model = BaseService.create(
+        zmq.Context(), hf_chatbot_paths[0], "inproc://test", service_id="test"
+    )
+    if not chatbot_model.use_prompt_cache:
+        return
+    prompt = "Hello friend! How are you?"
+    chatbot_model.run(prompt, temperature=0.8)
+    assert chatbot_model.prompt_cache.misses == 1
+    length, past = chatbot_model.get_cached_prefix(
+        chatbot_model.tokenizer.encode(prompt + " I am fine.").ids
+    )
+    assert length == len(chatbot_model.tokenizer.encode(prompt).ids)
+    assert past is not None
+    chatbot_model.run(prompt + " I am fine.", temperature=0.8)
+    assert chatbot_model.prompt_cache.hits == 2
+    assert chatbot_model.get_metrics()["prompt_cache"]["hit_rate"] == 2 / 3
+
+
+def test_continuous_batching(monkeypatch):
+    """Check if scheduled requests produce the same replies as sequential ones"""
+    chatbot_model = create_with_session(
+        monkeypatch,
+        create_session(),
+        continuous_batching=True,
+        max_batch_sequences=3,
+        max_length=16,
+    )
+    scheduler = chatbot_model.scheduler
+    assert scheduler is not None
+    prompts = [
+        "Hello friend!",
+        "How are you doing today, my old friend?",
+        "What a nice day it is.",
+        "Bye",
+    ]
+    max_new_tokens = [12, 4, 10, 6]
+    expected = [
+        chatbot_model.run(prompt, temperature=0, max_new_tokens=num_tokens)
+        for prompt, num_tokens in zip(prompts, max_new_tokens)
+    ]
+    assert len(set(expected)) == len(prompts)
+    lengths = [len(chatbot_model.tokenizer.encode(prompt).ids) for prompt in prompts]
+    assert lengths[0] < lengths[1]
+
+    job_ids = [
+        scheduler.submit(prompt, temperature=0, max_new_tokens=num_tokens)
+        for prompt, num_tokens in zip(prompts[:2], max_new_tokens[:2])
+    ]
+    scheduler.admit()
+    padding = lengths[1] - lengths[0]
+    assert scheduler.attention_mask.tolist() == [
+        [0] * padding + [1] * lengths[0],
+        [1] * lengths[1],
+    ]
+    past = scheduler.past["past_key_values.0.key"]
+    assert past.shape[2] == lengths[1]
+    assert not past[0, :, :padding].any()
+    assert past[0, :, padding:].all()
+
+    results = {}
+    widths = []
+    while scheduler.has_jobs():
+        if len(widths) == 1:
+            job_ids += [
+                scheduler.submit(prompt, temperature=0, max_new_tokens=num_tokens)
+                for prompt, num_tokens in zip(prompts[2:], max_new_tokens[2:])
+            ]
+        results.update(scheduler.step())
+        if len(widths) == 1:
+            assert len(scheduler.rows) == 3
+            assert len(scheduler.queue) == 1
+        if len(scheduler.rows) > 0:
+            mask = scheduler.attention_mask
+            assert mask[:, 0].any()
+            past = scheduler.past["past_key_values.0.key"]
+            if isinstance(past, rt.OrtValue):
+                past = past.numpy()
+            assert past.shape[0] == len(scheduler.rows)
+            assert past.shape[2] == mask.shape[1]
+            widths.append(mask.shape[1])
+    assert any(width < previous for previous, width in zip(widths, widths[1:]))
+    assert [results[job_id] for job_id in job_ids] == expected
+
+
+def test_seed():
+    """Check if seeded requests are reproducible and don't touch global random state"""
+    from npc_engine.services.text_generation.scheduler import (
+        ContinuousBatchScheduler,
+    )
+
+    chatbot_model = BaseService.create(
+        zmq.Context(), hf_chatbot_paths[0], "inproc://test", service_id="test"
+    )
+    prompt = "Hello friend! How are you?"
+    np.random.seed(0)
+    state = np.random.get_state()[1].copy()
+    reply = chatbot_model.run(prompt, temperature=1.5, seed=3)
+    assert chatbot_model.run(prompt, temperature=1.5, seed=3) == reply
+    assert (np.random.get_state()[1] == state).all()
+    if not chatbot_model.with_past or "position_ids" not in chatbot_model.dtypes:
+        return
+    scheduler = ContinuousBatchScheduler(chatbot_model, max_batch_sequences=4)
+    job_ids = [scheduler.submit(prompt, temperature=1.5, seed=3) for _ in range(2)]
+    results = {}
+    while scheduler.has_jobs():
+        results.update(scheduler.step())
+    assert results[job_ids[0]] == results[job_ids[1]]
+
+
+def test_speculative_decoding(monkeypatch):
+    """Check if speculative decoding with a different draft model keeps the replies"""
+    from npc_engine.services.text_generation.speculative import SpeculativeDecoder
+
+    chatbot_model = create_with_session(monkeypatch, create_session(), max_length=24)
+    prompt = "Hello friend! How are you?"
+    expected = chatbot_model.run(prompt, temperature=0)
+    draft_session = create_session()
+    draft_session.projection = draft_session.projection + np.random.RandomState(
+        1
+    ).randn(*draft_session.projection.shape)
+    chatbot_model.speculative = SpeculativeDecoder(
+        chatbot_model, draft_session, num_draft_tokens=3
+    )
+    assert chatbot_model.run(prompt, temperature=0) == expected
+    assert 0 < chatbot_model.speculative.acceptance_rate() < 1
+    metrics = chatbot_model.get_metrics()["draft"]
+    assert metrics["acceptance_rate"] == chatbot_model.speculative.acceptance_rate()
+    reply = chatbot_model.run(prompt, temperature=1.0, seed=3)
+    assert chatbot_model.run(prompt, temperature=1.0, seed=3) == reply
+
+
+def create_verifier():
+    """Create speculative decoder for a model with 8 tokens and end of sequence token 7"""
+    from types import SimpleNamespace
+    from npc_engine.services.text_generation.speculative import SpeculativeDecoder
+
+    model = SimpleNamespace(
+        model=create_session(),
+        eos_token_id=7,
+        min_length=0,
+        topp=None,
+        repetition_penalty=1.0,
+    )
+    return SpeculativeDecoder(model, create_session(seed=1))
+
+
+def distribution_logits(probs):
+    logits = np.full([8], float("-inf"))
+    for token, prob in probs.items():
+        logits[token] = np.log(prob)
+    return logits
+
+
+def test_speculative_verify():
+    """Check acceptance sampling of the draft tokens"""
+    decoder = create_verifier()
+    rng = np.random.default_rng(0)
+
+    def verify(drafts, draft_distributions, distributions):
+        logits = np.stack([distribution_logits(probs) for probs in distributions])
+        draft_probs = [
+            decoder.probs(distribution_logits(probs), [], 1.0, None)
+            for probs in draft_distributions
+        ]
+        return decoder.verify([], drafts, draft_probs, logits, 1.0, None, rng)
+
+    # All drafts are accepted and the bonus token is sampled from the last position
+    certain = [{token: 1.0} for token in [1, 2, 3, 4]]
+    assert verify([1, 2, 3], certain[:3], certain) == ([1, 2, 3, 4], [0, 0, 0, 0])
+    assert decoder.stats() == {"proposed": 3, "accepted": 3, "acceptance_rate": 1}
+
+    # Draft token the main model never generates is rejected
+    # and resampled from the residual max(0, p - q)
+    probs = {1: 0.5, 2: 0.5}
+    draft_probs = {2: 0.5, 3: 0.5}
+    assert verify([3], [draft_probs], [probs, probs]) == ([1], [-1])
+    assert verify([1, 3], [{1: 1.0}, draft_probs], [{1: 1.0}, probs, probs]) == (
+        [1, 1],
+        [0, -1],
+    )
+    assert decoder.stats() == {"proposed": 6, "accepted": 4, "acceptance_rate": 4 / 6}
+
+    # Accepted end of sequence token stops verification
+    certain = [{token: 1.0} for token in [1, 7, 2, 3]]
+    assert verify([1, 7, 2], certain[:3], certain) == ([1, 7], [0, 0])
+
+
+def test_speculative_distribution():
+    """Check if tokens verified from draft samples follow the main model distribution"""
+    from npc_engine.services.text_generation.utils import sample_probs
+
+    decoder = create_verifier()
+    rng = np.random.default_rng(0)
+    probs = {1: 0.6, 2: 0.3, 3: 0.1}
+    logits = np.stack([distribution_logits(probs)] * 2)
+    draft_probs = decoder.probs(
+        distribution_logits({1: 0.2, 2: 0.3, 3: 0.5}), [], 1.0, None
+    )
+    num_samples = 20000
+    counts = np.zeros([8])
+    for _ in range(num_samples):
+        draft = int(sample_probs(draft_probs[None], rng)[0])
+        tokens, _ = decoder.verify([], [draft], [draft_probs], logits, 1.0, None, rng)
+        counts[tokens[0]] += 1
+    expected = np.zeros([8])
+    for token, prob in probs.items():
+        expected[token] = prob
+    assert np.abs(counts / num_samples - expected).max() < 0.02
+    assert 0.4 < decoder.acceptance_rate() < 0.8
+
+
+def test_candidate_compaction():
+    """Check if finished and hopeless candidates are dropped from the batch"""
+    from npc_engine.services.text_generation.utils import StopCondition
+
+    chatbot_model = BaseService.create(
+        zmq.Context(), hf_chatbot_paths[0], "inproc://test", service_id="test"
+    )
+    condition = StopCondition(chatbot_model.tokenizer, chatbot_model.eos_token_id, 3)
+    condition.tokens = [[1, 2], [1, 2, 3], [1]]
+    condition.finished = [True, False, False]
+    chatbot_model.prune_candidates(condition, [-2, -9, -0.5], remaining_steps=2)
+    assert condition.finished == [True, True, False]
+
+    chatbot_model.num_sampled = 3
+    batch_sizes = []
+    run_step = chatbot_model.run_step
+
+    def counting_run_step(inputs):
+        batch_sizes.append(len(inputs["input_ids"]))
+        return run_step(inputs)
+
+    chatbot_model.run_step = counting_run_step
+    for _ in range(5):
+        chatbot_model.run("Hello friend!", temperature=1.0, stop=["e", "a", "o"])
+    assert batch_sizes[0] == 3
+    assert min(batch_sizes) < 3
+
+
+def test_candidate_compaction_on_device(monkeypatch):
+    """Check that past on the device is compacted only once half of the batch finished"""
+    from npc_engine.services.text_generation.utils import StopCondition
+
+    results = {}
+    for with_past in [True, False]:
+        session = create_session(with_past=with_past)
+        chatbot = create_with_session(monkeypatch, session, num_sampled=6)
+        condition = StopCondition(
+            chatbot.tokenizer,
+            chatbot.eos_token_id,
+            6,
+            max_new_tokens=12,
+            stop=["5", "A", "!", "#"],
+        )
+        log_probs = chatbot.generate_candidates(
+            "Hello friend!", 1.0, None, condition, np.random.default_rng(0)
+        )
+        batch_sizes = [len(call["input_ids"]) for call in session.calls]
+        results[with_past] = (condition.texts, log_probs, batch_sizes, session)
+
+    texts, log_probs, batch_sizes, session = results[True]
+    assert texts == results[False][0]
+    assert np.allclose(log_probs, results[False][1])
+    # Without past finished rows are dropped right away
+    assert 4 in results[False][2] or 5 in results[False][2]
+    assert all(size == 6 or size <= 3 for size in batch_sizes)
+    assert min(batch_sizes) < 6
+    # Finished rows are kept in the batch and fed end of sequence
+    assert any(
+        len(call["input_ids"]) == 6
+        and (call["input_ids"] == chatbot.eos_token_id).any()
+        for call in session.calls
+    )
+    for call in session.calls:
+        assert call["past_key_values.0.key"].shape[0] == len(call["input_ids"])
@@ -0,0 +1,155 @@
+"""ONNX Runtime generation operator chatbot test."""
+import os
+import inspect
+import sys
+
+import numpy as np
+import onnxruntime as rt
+import pytest
+from tokenizers import Tokenizer
+
+from npc_engine.services.text_generation import OrtGenerationChatbot
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import mocks.zmq_mocks as zmq
+import mocks.ort_mocks as ort
+
+model_path = os.path.join(
+    os.path.dirname(__file__), "..", "..", "resources", "models", "mock-distilgpt2"
+)
+
+tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+reply_ids = tokenizer.encode(" Hello there. How are you?").ids
+eos_token_id = tokenizer.encode("<|endoftext|>").ids[0]
+
+
+def create_with_session(monkeypatch, session, **kwargs):
+    """Create chatbot with the tokenizer of the mock model and a stub session"""
+    with monkeypatch.context() as patch:
+        patch.setattr(rt, "InferenceSession", lambda *args, **kwargs: session)
+        return OrtGenerationChatbot(
+            model_path=model_path,
+            context=zmq.Context(),
+            uri="inproc://test",
+            service_id="test",
+            template_string="{% for line in history %}{{ line }}\n{% endfor -%}",
+            **kwargs,
+        )
+
+
+@pytest.mark.parametrize("op", ["BeamSearch", "GreedySearch", "Sampling"])
+def test_create_inputs(monkeypatch, op):
+    """Check that only the operator inputs are fed with their dtypes"""
+    session = ort.GenerationSession(op)
+    chatbot = create_with_session(
+        monkeypatch,
+        session,
+        max_length=20,
+        min_length=5,
+        num_beams=3,
+        length_penalty=0.5,
+        repetition_penalty=1.2,
+    )
+    inputs = chatbot.create_inputs([1, 2, 3])
+    names = [i.name for i in session.get_inputs()]
+    assert set(inputs) == set(names) - {"vocab_mask", "prefix_vocab_mask"}
+    for name, value in inputs.items():
+        assert value.dtype == chatbot.dtypes[name]
+    assert inputs["input_ids"].tolist() == [[1, 2, 3]]
+    assert inputs["attention_mask"].tolist() == [[1, 1, 1]]
+    assert inputs["max_length"].tolist() == [23]
+    assert inputs["min_length"].tolist() == [8]
+    assert inputs["repetition_penalty"].tolist() == [np.float32(1.2)]
+    if op == "BeamSearch":
+        assert inputs["num_beams"].tolist() == [3]
+        assert inputs["num_return_sequences"].tolist() == [1]
+        assert inputs["length_penalty"].tolist() == [0.5]
+    if op == "Sampling":
+        assert inputs["seed"].shape == (1,)
+
+
+def test_create_inputs_lengths(monkeypatch):
+    """Check max_length and min_length with max_new_tokens"""
+    chatbot = create_with_session(
+        monkeypatch, ort.GenerationSession(), max_length=20, min_length=5
+    )
+    inputs = chatbot.create_inputs([1, 2, 3], max_new_tokens=10)
+    assert inputs["max_length"].tolist() == [13]
+    assert inputs["min_length"].tolist() == [8]
+    inputs = chatbot.create_inputs([1, 2, 3], max_new_tokens=2)
+    assert inputs["max_length"].tolist() == [5]
+    assert inputs["min_length"].tolist() == [5]
+
+    chatbot = create_with_session(
+        monkeypatch,
+        ort.GenerationSession(),
+        max_length=20,
+        min_length=5,
+        encoder_decoder=True,
+    )
+    inputs = chatbot.create_inputs([1, 2, 3], max_new_tokens=10)
+    assert inputs["max_length"].tolist() == [10]
+    assert inputs["min_length"].tolist() == [5]
+
+
+def test_create_inputs_seed(monkeypatch):
+    """Check that request seed overrides config seed"""
+    session = ort.GenerationSession("Sampling")
+    chatbot = create_with_session(monkeypatch, session, seed=7)
+    assert chatbot.create_inputs([1])["seed"].tolist() == [7]
+    assert chatbot.create_inputs([1], seed=3)["seed"].tolist() == [3]
+
+
+@pytest.mark.parametrize("op", ["BeamSearch", "GreedySearch", "Sampling"])
+def test_run(monkeypatch, op):
+    """Check that the prompt is stripped from decoder-only model sequences"""
+    session = ort.GenerationSession(op, tokens=reply_ids + [eos_token_id])
+    chatbot = create_with_session(monkeypatch, session, seed=0)
+    if op == "Sampling":
+        permutation = np.random.RandomState(0).permutation(len(reply_ids) + 1)
+        tokens = [(reply_ids + [eos_token_id])[i] for i in permutation]
+        expected = tokenizer.decode(tokens[: tokens.index(eos_token_id)])
+    else:
+        expected = " Hello there. How are you?"
+    assert chatbot.run("Hi!") == expected
+
+    session = ort.GenerationSession(op, tokens=reply_ids, prefix_prompt=False)
+    chatbot = create_with_session(monkeypatch, session, encoder_decoder=True)
+    assert sorted(tokenizer.encode(chatbot.run("Hi!")).ids) == sorted(reply_ids)
+
+
+def test_run_stop(monkeypatch):
+    """Check that the reply is cut before stop strings and by max_new_tokens"""
+    session = ort.GenerationSession(tokens=reply_ids)
+    chatbot = create_with_session(monkeypatch, session)
+    assert chatbot.run("Hi!", stop=".") == " Hello there"
+    assert chatbot.run("Hi!", stop=["?", " How"]) == " Hello there."
+    assert chatbot.run("Hi!", max_new_tokens=2) == tokenizer.decode(reply_ids[:2])
+
+
+@pytest.mark.parametrize(
+    "op,config_seed,seed,cached",
+    [
+        ("BeamSearch", None, None, True),
+        ("GreedySearch", None, None, True),
+        ("Sampling", None, None, False),
+        ("Sampling", None, 3, True),
+        ("Sampling", 7, None, True),
+    ],
+)
+def test_response_cache(monkeypatch, op, config_seed, seed, cached):
+    """Check that only deterministic replies are cached whatever the temperature"""
+    session = ort.GenerationSession(op, tokens=reply_ids)
+    chatbot = create_with_session(
+        monkeypatch, session, seed=config_seed, response_cache_size=16
+    )
+    context = dict(history=["Hello"])
+    for temperature in [1.0, 0.0]:
+        session.calls.clear()
+        first = chatbot.generate_reply(context, temperature=temperature, seed=seed)
+        second = chatbot.generate_reply(context, temperature=temperature, seed=seed)
+        assert len(session.calls) == (1 if cached else 2)
+        if cached:
+            assert first == second
@@ -1,4 +1,5 @@
 """Similarity test."""
+import math
 import os
 from npc_engine import services
 import time
@@ -47,3 +48,25 @@ def test_transformers_similarity():
     )
     print("custom test time elapsed", time.time() - start)
     assert len(test_result) == 2
+
+
+def test_transformers_similarity_corpus():
+    """Check that corpus search agrees with compare"""
+    try:
+        semantic_tests = services.BaseService.create(
+            zmq.Context(), model_paths[0], "inproc://test", service_id="test"
+        )
+    except FileNotFoundError:
+        return
+    lines = ["Can I have a beer", "Give me a beer", "Hello there", "Goodbye"]
+    assert semantic_tests.add_corpus("bar", lines[:2]) == 2
+    assert semantic_tests.extend_corpus("bar", lines[2:]) == 4
+    expected = semantic_tests.compare("Can I have a beer", lines)
+    result = semantic_tests.search_corpus("bar", "Can I have a beer", top_k=2)
+    assert len(result["indices"]) == 2
+    assert result["scores"] == sorted(result["scores"], reverse=True)
+    # Mock model embeddings are zeros so cosine similarity is undefined
+    if all(math.isfinite(score) for score in expected):
+        assert abs(result["scores"][0] - max(expected)) < 1e-4
+        for index, score in zip(result["indices"], result["scores"]):
+            assert abs(score - expected[index]) < 1e-4
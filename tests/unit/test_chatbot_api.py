@@ -1,6 +1,16 @@
 """Chatbot test."""
 from npc_engine.services.text_generation import TextGenerationAPI
+from npc_engine.services.text_generation.utils import (
+    StopCondition,
+    decode_logits,
+    decode_stream,
+)
+from jinja2 import Template
+import numpy as np
+import pytest
 import inspect
+import json
+import time
 import os
 import sys
 
@@ -79,6 +89,34 @@ def test_chatbot_api():
     assert "success" == result
 
 
+class MockChatbotModelTokenBudget(TextGenerationAPI):
+    def __init__(self) -> None:
+        super().__init__(
+            context_template="context",
+            history_template=template,
+            service_id="test",
+            context=zmq.Context(),
+            uri="inproc://test",
+        )
+        self.counted = []
+
+    def run(self, prompt: str, temperature: float = 1, topk: int = None):
+        return prompt
+
+    def get_special_tokens(self):
+        return {"bos_token": "{BOS_TOKEN}"}
+
+    def count_tokens(self, text: str) -> int:
+        self.counted.append(text)
+        return len(text.split())
+
+    def get_token_budget(self) -> int:
+        return 6
+
+    def string_too_long(self, prompt: str) -> bool:
+        return len(prompt.split()) > self.get_token_budget()
+
+
 def test_overflow():
 
     chatbot = MockChatbotModelOverflow()
@@ -95,3 +133,264 @@ def test_get_template():
 def test_get_context_template():
     chatbot = MockChatbotModel()
     assert chatbot.get_context_template() == {"history": [""], "bos_token": ""}
+
+
+def test_context_template_memoized(monkeypatch):
+    chatbot = MockChatbotModel()
+    calls = []
+    get_special_tokens = chatbot.get_special_tokens
+    chatbot.get_special_tokens = lambda: calls.append(1) or get_special_tokens()
+    monkeypatch.setattr(
+        "npc_engine.services.text_generation.text_generation_base.infer", None
+    )
+    template = chatbot.get_context_template()
+    template["history"].append("changed")
+    assert chatbot.get_context_template() == {"history": [""], "bos_token": ""}
+    chatbot.generate_reply({"history": ["test", "test"]})
+    chatbot.generate_reply({"history": ["test", "test"]})
+    assert len(calls) == 1
+
+
+def test_chatbot_api_stream():
+    chatbot = MockChatbotModel()
+
+    stream_id = chatbot.generate_reply_start({"history": ["test", "test"]})
+    assert chatbot.generate_reply_get_results(stream_id) == {
+        "text": "success",
+        "finished": False,
+    }
+    assert chatbot.generate_reply_get_results(stream_id) == {
+        "text": "",
+        "finished": True,
+    }
+    with pytest.raises(ValueError):
+        chatbot.generate_reply_get_results(stream_id)
+
+
+class MockCountingChatbotModel(MockChatbotModel):
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls = 0
+
+    def run(
+        self, prompt: str, temperature: float = 1, topk: int = None, seed: int = None
+    ):
+        self.calls += 1
+        return super().run(prompt, temperature, topk)
+
+
+def test_chatbot_api_response_cache():
+    from npc_engine.services.utils.lru_cache import TTLLRUCache
+
+    chatbot = MockCountingChatbotModel()
+    chatbot.response_cache = TTLLRUCache(4)
+    context = {"history": ["test", "test"]}
+    assert chatbot.generate_reply(context, temperature=0) == "success"
+    assert chatbot.generate_reply(context, 0) == "success"
+    assert chatbot.calls == 1
+    chatbot.generate_reply(context, seed=1)
+    chatbot.generate_reply(context, seed=1)
+    chatbot.generate_reply(context, seed=2)
+    assert chatbot.calls == 3
+    chatbot.generate_reply(context)
+    chatbot.generate_reply(context)
+    assert chatbot.calls == 5
+    assert chatbot.response_cache.hit_rate() == 0.4
+    assert chatbot.get_metrics()["response_cache"]["hit_rate"] == 0.4
+
+
+class MockScheduledChatbotModel(MockChatbotModel):
+    SCHEDULED_METHODS = {"generate_reply": "schedule_reply"}
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.jobs = {}
+
+    def schedule_reply(self, context, temperature=1.0, topk=None):
+        if temperature == 0:
+            raise ValueError("Can't schedule")
+        job_id = len(self.jobs)
+        self.jobs[job_id] = len(context["history"])
+        return job_id
+
+    def step_scheduled(self):
+        for job_id in self.jobs:
+            self.jobs[job_id] -= 1
+        finished = [job_id for job_id, steps in self.jobs.items() if steps == 0]
+        return [
+            (job_id, "done" if job_id == 0 else RuntimeError("Failed"))
+            for job_id in finished
+        ]
+
+
+def test_chatbot_api_scheduled_requests():
+    """Check that scheduled requests are replied to when their jobs finish"""
+    from jsonrpc import Dispatcher
+    from npc_engine.services.base_service import ScheduledJob
+
+    chatbot = MockScheduledChatbotModel()
+    dispatcher = Dispatcher()
+    dispatcher.update(chatbot.build_api_dict())
+    requests = [
+        json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "method": "generate_reply",
+                "params": [{"history": history}, temperature],
+            }
+        )
+        for request_id, (history, temperature) in enumerate(
+            [(["test"], 1.0), (["test", "test"], 1.0), (["test", "test"], 0)]
+        )
+    ]
+    responses = chatbot.handle_requests(requests, dispatcher)
+    assert responses[0] == ScheduledJob(0, 0)
+    assert responses[1] == ScheduledJob(1, 1)
+    assert responses[2] == {"jsonrpc": "2.0", "id": 2, "result": "success"}
+
+    sent = []
+    chatbot.send_response = lambda message, response: sent.append((message, response))
+    for response in responses[:2]:
+        chatbot.scheduled_requests[response.job_id] = (
+            f"message{response.job_id}",
+            response.request_id,
+        )
+    chatbot.handle_scheduled()
+    assert sent == [("message0", {"jsonrpc": "2.0", "id": 0, "result": "done"})]
+    chatbot.handle_scheduled()
+    assert sent[1][0] == "message1"
+    assert sent[1][1]["error"]["data"]["type"] == "RuntimeError"
+    assert len(chatbot.scheduled_requests) == 0
+
+
+class MockTokenizer:
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(["ab", "\ufffd", "c"][i] for i in ids).replace("\ufffdc", "d")
+
+
+def test_decode_stream():
+    deltas = list(decode_stream(MockTokenizer(), [0, 1, 2, 0, 3, 0], eos_token_id=3))
+    assert deltas == ["ab", "d", "ab"]
+
+
+class MockCharTokenizer:
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(i) for i in ids)
+
+
+def test_decode_stream_stop():
+    tokens = [ord(c) for c in "hello world"]
+    deltas = list(decode_stream(MockCharTokenizer(), tokens, 0, stop=["lo w", "xyz"]))
+    assert "".join(deltas) == "hel"
+    deltas = list(decode_stream(MockCharTokenizer(), tokens, 0, stop="wx"))
+    assert "".join(deltas) == "hello world"
+    assert "w" not in deltas
+
+
+def test_stop_condition():
+    condition = StopCondition(
+        MockCharTokenizer(), 0, num_sequences=3, max_new_tokens=4, stop="c"
+    )
+    assert not condition.update([ord("a"), ord("a"), ord("a")])
+    assert not condition.update([ord("b"), 0, ord("b")])
+    assert not condition.update([ord("c"), ord("x"), ord("b")])
+    assert condition.finished == [True, True, False]
+    assert condition.update([ord("d"), ord("d"), ord("b")])
+    assert condition.tokens[1] == [ord("a")]
+    assert condition.best([-1, -2, -8]) == "ab"
+    assert condition.best([-4, -0.1, -8]) == "a"
+
+    condition = StopCondition(MockCharTokenizer(), 0, deadline=time.monotonic() - 1)
+    assert condition.update([ord("a")])
+    assert condition.best([-1]) == "a"
+
+
+def test_decode_logits():
+    logits = np.asarray([[0.0, 2.0, 1.0, -1.0], [3.0, 0.0, 2.9, 0.0]])
+    tokens, log_probs = decode_logits(logits, 0, None, [0, 0])
+    assert tokens.tolist() == [1, 0]
+    assert (log_probs < 0).all()
+
+    tokens, topk_log_probs = decode_logits(logits, 1.0, 1, log_probs)
+    assert tokens.tolist() == [1, 0]
+    assert np.allclose(topk_log_probs, log_probs)
+
+    tokens, _ = decode_logits(logits, 1.0, None, [0, 0], topp=0.01)
+    assert tokens.tolist() == [1, 0]
+
+    tokens, _ = decode_logits(
+        logits,
+        0,
+        None,
+        [0, 0],
+        repetition_penalty=4.0,
+        generated_ids=np.asarray([[1], [0]]),
+    )
+    assert tokens.tolist() == [2, 2]
+
+
+def test_token_budget_truncation():
+    chatbot = MockChatbotModelTokenBudget()
+
+    history = ["1", "2", "3", "4", "5", "6"]
+    result = chatbot.generate_reply({"history": history})
+    # context + {BOS_TOKEN} per entry + entry itself
+    assert history == ["5", "6"]
+    assert result == "context\n{BOS_TOKEN}\n5\n6"
+
+    counted = len(chatbot.counted)
+    chatbot.generate_reply({"history": ["5", "6", "7"]})
+    assert len(chatbot.counted) == counted + 1
+
+
+def test_incremental_history_rendering():
+    chatbot = MockChatbotModelTokenBudget()
+    assert (
+        chatbot.generate_reply({"history": ["1", "2"]}) == "context\n{BOS_TOKEN}\n1\n2"
+    )
+    assert chatbot.incremental_history is False
+
+    chatbot = MockChatbotModelTokenBudget()
+    chatbot.history_template = Template(
+        "{% for line in history %}\n{{ line }}{% endfor %}"
+    )
+    history = ["1", "2", "3"]
+    assert chatbot.generate_reply({"history": history}) == "context\n1\n2\n3"
+    assert chatbot.incremental_history is True
+    counted = len(chatbot.counted)
+    history.append("4")
+    assert chatbot.generate_reply({"history": history}) == "context\n1\n2\n3\n4"
+    assert chatbot.counted[counted:] == ["\n4"]
+    history = [str(i) for i in range(8)]
+    assert chatbot.generate_reply({"history": history}) == "context\n3\n4\n5\n6\n7"
+    assert history == ["3", "4", "5", "6", "7"]
+
+
+class MockSpeculativeChatbot:
+    min_length = 0
+    eos_token_id = 3
+    topp = None
+    repetition_penalty = 1.0
+
+
+def test_speculative_acceptance_sampling():
+    """Check that verified draft tokens follow the main model distribution"""
+    from npc_engine.services.text_generation.speculative import SpeculativeDecoder
+
+    np.random.seed(0)
+    decoder = SpeculativeDecoder.__new__(SpeculativeDecoder)
+    decoder.model = MockSpeculativeChatbot()
+    decoder.proposed = decoder.accepted = 0
+    target = np.asarray([0.2, 0.5, 0.3])
+    draft = np.asarray([0.6, 0.3, 0.1])
+    logits = np.log(np.stack([target, target]))
+    counts = np.zeros(3)
+    for _ in range(20000):
+        token = np.random.choice(3, p=draft)
+        tokens, _ = decoder.verify([], [token], [draft], logits, 1.0, None)
+        counts[tokens[0]] += 1
+    assert np.allclose(counts / counts.sum(), target, atol=0.02)
+    expected_rate = np.minimum(target, draft).sum()
+    assert abs(decoder.acceptance_rate() - expected_rate) < 0.02
+    assert decoder.stats()["proposed"] == 20000
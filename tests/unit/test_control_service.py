@@ -53,7 +53,9 @@ class TestControlService:
         print("stop_service")
         model_manager.start_service(service)
         print("started")
-        while model_manager.services[service]["dispatch_coroutine"] is None:
+        while (
+            model_manager.services[service]["replicas"][0]["dispatch_coroutine"] is None
+        ):
             await asyncio.sleep(0.1)
         print("dispatch_coroutine")
         assert model_manager.get_service_status(service) == ServiceState.RUNNING
@@ -75,11 +77,13 @@ class TestControlService:
         assert model_manager.get_service_status(service) == ServiceState.STOPPED
         model_manager.start_service(service)
 
-        while model_manager.services[service]["dispatch_coroutine"] is None:
+        while (
+            model_manager.services[service]["replicas"][0]["dispatch_coroutine"] is None
+        ):
             await asyncio.sleep(0.1)
         assert model_manager.get_service_status(service) == ServiceState.RUNNING
-        model_manager.services[service]["process"].kill()
-        model_manager.services[service]["process"].terminate()
+        model_manager.services[service]["replicas"][0]["process"].kill()
+        model_manager.services[service]["replicas"][0]["process"].terminate()
         with pytest.raises(ValueError):
             model_manager.get_service_status(service)
         assert model_manager.get_service_status(service) == ServiceState.ERROR
@@ -98,12 +102,16 @@ class TestControlService:
         assert model_manager.get_service_status(service) == ServiceState.STOPPED
         model_manager.start_service(service)
 
-        while model_manager.services[service]["dispatch_coroutine"] is None:
+        while (
+            model_manager.services[service]["replicas"][0]["dispatch_coroutine"] is None
+        ):
             await asyncio.sleep(0.1)
         assert model_manager.get_service_status(service) == ServiceState.RUNNING
         model_manager.restart_service(service)
 
-        while model_manager.services[service]["dispatch_coroutine"] is None:
+        while (
+            model_manager.services[service]["replicas"][0]["dispatch_coroutine"] is None
+        ):
             await asyncio.sleep(0.1)
         assert model_manager.get_service_status(service) == ServiceState.RUNNING
         npc_engine.server.control_service.service_process = old_sp
@@ -119,7 +127,12 @@ class TestControlService:
         model_manager = ControlService(self.context, self.metadata)
         model_manager.start_service("mock-distilgpt2")
 
-        while model_manager.services["mock-distilgpt2"]["dispatch_coroutine"] is None:
+        while (
+            model_manager.services["mock-distilgpt2"]["replicas"][0][
+                "dispatch_coroutine"
+            ]
+            is None
+        ):
             await asyncio.sleep(0.1)
         address = "mock-distilgpt2"
         request = json.dumps(
@@ -134,6 +147,129 @@ class TestControlService:
         await model_manager.handle_request(address, request)
         npc_engine.server.control_service.service_process = old_sp
 
+    @pytest.mark.asyncio
+    async def test_service_manager_handle_concurrent_requests(self):
+        """Test that concurrent replies are routed to the right callers."""
+        os.environ["COVERAGE_PROCESS_START"] = ".coveragerc"
+
+        old_sp = npc_engine.server.control_service.service_process
+        npc_engine.server.control_service.service_process = wrapped_service
+
+        model_manager = ControlService(self.context, self.metadata)
+        model_manager.start_service("mock-distilgpt2")
+
+        while (
+            model_manager.services["mock-distilgpt2"]["replicas"][0][
+                "dispatch_coroutine"
+            ]
+            is None
+        ):
+            await asyncio.sleep(0.1)
+        requests = [
+            json.dumps(
+                {
+                    "id": i,
+                    "method": "get_prompt_template",
+                    "params": [],
+                    "jsonrpc": "2.0",
+                }
+            )
+            for i in range(10)
+        ]
+        cancelled = asyncio.create_task(
+            model_manager.handle_request("mock-distilgpt2", requests[0])
+        )
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        responses = await asyncio.gather(
+            *[
+                model_manager.handle_request("mock-distilgpt2", request)
+                for request in requests[1:]
+            ]
+        )
+        for i, response in enumerate(responses):
+            assert json.loads(response)["id"] == i + 1
+        assert (
+            len(model_manager.services["mock-distilgpt2"]["replicas"][0]["pending"])
+            == 0
+        )
+        model_manager.stop_service("mock-distilgpt2")
+        npc_engine.server.control_service.service_process = old_sp
+
+    @pytest.mark.asyncio
+    async def test_service_manager_replicas(self):
+        """Test that requests are balanced between service replicas."""
+        os.environ["COVERAGE_PROCESS_START"] = ".coveragerc"
+
+        old_sp = npc_engine.server.control_service.service_process
+        npc_engine.server.control_service.service_process = wrapped_service
+
+        service = "mock-distilgpt2"
+        old_descriptor = self.metadata.services[service]
+        self.metadata.services[service] = old_descriptor._replace(replicas=2)
+        model_manager = ControlService(self.context, self.metadata)
+        assert model_manager.get_service_status(service, per_replica=True) == [
+            ServiceState.STOPPED,
+            ServiceState.STOPPED,
+        ]
+        model_manager.start_service(service)
+        replicas = model_manager.services[service]["replicas"]
+        while any([replica["dispatch_coroutine"] is None for replica in replicas]):
+            await asyncio.sleep(0.1)
+        assert model_manager.get_service_status(service, per_replica=True) == [
+            ServiceState.RUNNING,
+            ServiceState.RUNNING,
+        ]
+        selected = []
+        old_select = model_manager.select_replica
+
+        def select_replica(service_id):
+            selected.append(old_select(service_id))
+            return selected[-1]
+
+        model_manager.select_replica = select_replica
+        request = json.dumps(
+            {
+                "id": 0,
+                "method": "get_prompt_template",
+                "params": [],
+                "jsonrpc": "2.0",
+            }
+        )
+        await asyncio.gather(
+            *[model_manager.handle_request(service, request) for _ in range(4)]
+        )
+        assert sorted(selected) == [0, 0, 1, 1]
+
+        orphaned = asyncio.get_event_loop().create_future()
+        replicas[1]["pending"][b"orphaned"] = orphaned
+        replicas[1]["process"].kill()
+        replicas[1]["process"].join()
+        assert model_manager.get_service_status(service) == ServiceState.RUNNING
+        assert model_manager.get_service_status(service, per_replica=True) == [
+            ServiceState.RUNNING,
+            ServiceState.ERROR,
+        ]
+        with pytest.raises(ValueError, match="process died"):
+            await orphaned
+        assert len(replicas[1]["pending"]) == 0
+        await model_manager.handle_request(service, request)
+        assert selected[-1] == 0
+
+        model_manager.start_service(service)
+        assert replicas[0]["state"] == ServiceState.RUNNING
+        while replicas[1]["dispatch_coroutine"] is None:
+            await asyncio.sleep(0.1)
+        assert model_manager.get_service_status(service, per_replica=True) == [
+            ServiceState.RUNNING,
+            ServiceState.RUNNING,
+        ]
+        with pytest.raises(ValueError, match="already running"):
+            model_manager.start_service(service)
+        model_manager.stop_service(service)
+        self.metadata.services[service] = old_descriptor
+        npc_engine.server.control_service.service_process = old_sp
+
     @pytest.mark.asyncio
     async def test_service_manager_handle_request_error(self):
         """Test if models are printed without error."""
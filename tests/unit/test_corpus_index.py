@@ -0,0 +1,89 @@
+"""Corpus index tests."""
+import os
+import numpy as np
+import pytest
+from npc_engine.services.similarity import TransformerSemanticSimilarity
+from npc_engine.services.similarity.corpus_index import (
+    ExactCorpusIndex,
+    IVFCorpusIndex,
+    load_corpus_index,
+)
+
+
+def score(query, embeddings):
+    return embeddings @ query[0]
+
+
+def random_embeddings(size, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(20, 16)
+    embeddings = centers[rng.randint(0, 20, size)] + 0.3 * rng.randn(size, 16)
+    return embeddings.astype(np.float32)
+
+
+def test_exact_index():
+    index = ExactCorpusIndex(score)
+    assert len(index) == 0
+    assert index.search(np.ones([1, 2]), 3)[0].tolist() == []
+    index.add(np.asarray([[1, 0], [0, 1]], dtype=np.float32))
+    index.add(np.asarray([[2, 0]], dtype=np.float32))
+    indices, scores = index.search(np.asarray([[1, 0.5]]), 2)
+    assert indices.tolist() == [2, 0]
+    assert scores.tolist() == [2.0, 1.0]
+
+
+def test_ivf_index():
+    embeddings = random_embeddings(2000)
+    queries = random_embeddings(20, seed=1)
+    exact = ExactCorpusIndex(score)
+    exact.add(embeddings)
+    index = IVFCorpusIndex(score, nlist=20, nprobe=20, min_size=1000)
+    index.add(embeddings[:500])
+    assert index.centroids is None
+    index.add(embeddings[500:1500])
+    assert index.trained_size == 1500
+    index.add(embeddings[1500:])
+    assert index.trained_size == 1500
+    assert len(index.order) == 2000
+    for query in queries:
+        assert (
+            index.search(query[None], 5)[0].tolist()
+            == exact.search(query[None], 5)[0].tolist()
+        )
+    index.nprobe = 2
+    indices, scores = index.search(queries[:1], 5)
+    assert len(indices) == 5
+    assert scores.tolist() == sorted(scores.tolist(), reverse=True)
+
+
+@pytest.mark.parametrize("metric", ["dot", "cosine"])
+def test_ivf_index_recall(metric):
+    """Check IVF recall with the scores of the similarity service"""
+    model = TransformerSemanticSimilarity.__new__(TransformerSemanticSimilarity)
+    model.metric_type = metric
+    embeddings = model.prepare_corpus(random_embeddings(2000))
+    queries = model.prepare_corpus(random_embeddings(50, seed=1))
+    index = IVFCorpusIndex(model.corpus_scores, nlist=20, nprobe=8, min_size=1000)
+    index.add(embeddings)
+    found = 0
+    for query in queries:
+        expected = set(np.argsort(-(embeddings @ query))[:10].tolist())
+        found += len(expected & set(index.search(query[None], 10)[0].tolist()))
+    assert found / (10 * len(queries)) > 0.9
+
+
+def test_corpus_index_save_load(tmp_path):
+    path = os.path.join(str(tmp_path), "corpus.npz")
+    index = IVFCorpusIndex(score, nlist=10, nprobe=3, min_size=100)
+    index.add(random_embeddings(300))
+    index.save(path, name="corpus")
+    loaded, metadata = load_corpus_index(path, "ivf", score, nprobe=3)
+    assert metadata == {"name": "corpus"}
+    assert np.array_equal(loaded.centroids, index.centroids)
+    query = random_embeddings(1, seed=2)
+    assert np.array_equal(loaded.search(query, 5)[0], index.search(query, 5)[0])
+
+    exact, _ = load_corpus_index(path, "exact", score)
+    assert len(exact) == 300
+    ExactCorpusIndex(score).save(path)
+    assert len(load_corpus_index(path, "ivf", score)[0]) == 0
@@ -0,0 +1,109 @@
+"""LRU cache tests."""
+import numpy as np
+import pytest
+from npc_engine.services.utils.lru_cache import (
+    MemoryLRUCache,
+    NumpyLRUCache,
+    TokenPrefixLRUCache,
+    TTLLRUCache,
+)
+
+
+def test_numpy_lru_cache():
+    computed = []
+
+    def embed(keys):
+        computed.extend(keys)
+        return np.asarray([[key, -key] for key in keys], dtype=np.float32)
+
+    cache = NumpyLRUCache(3)
+    result = cache.cache_compute([1, 2, 1], embed)
+    assert result.tolist() == [[1, -1], [2, -2], [1, -1]]
+    assert computed == [1, 2]
+    result = cache.cache_compute([3, 2, 4], embed)
+    assert result.dtype == np.float32
+    assert result.tolist() == [[3, -3], [2, -2], [4, -4]]
+    assert computed == [1, 2, 3, 4]
+    assert list(cache.lru_cache) == [2, 3, 4]
+    assert cache.cache_compute([4, 2], embed).tolist() == [[4, -4], [2, -2]]
+    assert cache.cache_compute([1], embed).tolist() == [[1, -1]]
+    assert list(cache.lru_cache) == [4, 2, 1]
+    assert cache.cache_compute([], embed).shape == (0,)
+
+
+def test_numpy_lru_cache_disabled():
+    cache = NumpyLRUCache(0)
+    assert cache.cache_compute(["a"], lambda keys: np.ones([1, 2])).shape == (1, 2)
+    assert cache.cache_compute(["a"], lambda keys: np.ones([1, 2])).shape == (1, 2)
+    assert len(cache.lru_cache) == 0
+
+
+def test_numpy_lru_cache_batch_bigger_than_cache():
+    cache = NumpyLRUCache(2)
+    result = cache.cache_compute([1, 2, 3], lambda keys: np.asarray(keys)[:, None])
+    assert result.tolist() == [[1], [2], [3]]
+    assert list(cache.lru_cache) == [2, 3]
+    with pytest.raises(ValueError):
+        cache.put_batch([4], np.zeros([1, 2]))
+
+
+def test_memory_lru_cache():
+    cache = MemoryLRUCache(3 * 80)
+    for key in range(3):
+        cache.put(key, np.zeros([10]))
+    assert cache.get(0) is not None
+    cache.put(3, {"a": np.zeros([5]), "b": np.zeros([5])})
+    assert 1 not in cache
+    assert cache.keys() == [2, 0, 3]
+    assert cache.total_bytes == 3 * 80
+    assert cache.get(1) is None
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_rate() == 0.5
+
+
+def test_memory_lru_cache_too_big_value():
+    cache = MemoryLRUCache(80)
+    cache.put(0, np.zeros([10]))
+    cache.put(1, np.zeros([11]))
+    assert cache.keys() == [0]
+    cache.put(0, np.zeros([11]))
+    assert len(cache) == 0
+    assert cache.total_bytes == 0
+
+
+def test_token_prefix_lru_cache():
+    cache = TokenPrefixLRUCache(16)
+    cache.put([1, 2], np.zeros([1]))
+    cache.put([1, 2, 3, 4], np.ones([1]))
+    length, value = cache.get_longest_prefix([1, 2, 3, 4, 5])
+    assert length == 4 and value.tolist() == [1]
+    length, value = cache.get_longest_prefix([1, 2, 3, 5])
+    assert length == 2 and value.tolist() == [0]
+    assert cache.get_longest_prefix([2, 1]) == (0, None)
+    assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3}
+    cache.put([7], np.zeros([1]))
+    assert cache.get_longest_prefix([1, 2, 3, 4]) == (2, cache.get((1, 2)))
+    cache.put([8], np.zeros([1]))
+    assert cache.get_longest_prefix([7]) == (0, None)
+    assert cache.trie == {1: {2: {None: True}}, 8: {None: True}}
+
+
+def test_ttl_lru_cache():
+    cache = TTLLRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.hit_rate() == 0.5
+    assert len(TTLLRUCache(0)) == 0
+
+
+def test_ttl_lru_cache_expiration():
+    cache = TTLLRUCache(2, ttl=-1)
+    cache.put("a", 1)
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert len(cache) == 0
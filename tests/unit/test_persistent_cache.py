@@ -0,0 +1,106 @@
+"""Persistent cache tests."""
+import multiprocessing
+import os
+import numpy as np
+from npc_engine.services.utils.persistent_cache import (
+    PersistentNumpyCache,
+    file_fingerprint,
+)
+
+
+def embed(keys):
+    return np.asarray([[len(key), 1] for key in keys], dtype=np.float32)
+
+
+def test_persistent_cache(tmp_path):
+    cache = PersistentNumpyCache(str(tmp_path), "model")
+    assert cache.cache_compute(["a", "bb", "a"], embed).tolist() == [
+        [1, 1],
+        [2, 1],
+        [1, 1],
+    ]
+    cache.cache_compute(["bb", "ccc"], embed)
+    assert len(cache) == 3
+
+    cache = PersistentNumpyCache(str(tmp_path), "model")
+    assert len(cache) == 3
+    result = cache.cache_compute(["ccc", "a"], lambda keys: 1 / 0)
+    assert result.dtype == np.float32
+    assert result.tolist() == [[3, 1], [1, 1]]
+
+    cache = PersistentNumpyCache(str(tmp_path), "other model")
+    assert len(cache) == 0
+    assert not os.path.exists(os.path.join(str(tmp_path), cache.ROWS_FILE))
+
+
+def test_persistent_cache_partial_write(tmp_path):
+    cache = PersistentNumpyCache(str(tmp_path), "model")
+    cache.cache_compute(["a", "bb"], embed)
+    with open(os.path.join(str(tmp_path), cache.ROWS_FILE), "ab") as f:
+        f.write(b"\0" * 5)
+    with open(os.path.join(str(tmp_path), cache.KEYS_FILE), "a") as f:
+        f.write('"cc')
+
+    cache = PersistentNumpyCache(str(tmp_path), "model")
+    assert len(cache) == 2
+    cache.cache_compute(["dddd"], embed)
+    cache = PersistentNumpyCache(str(tmp_path), "model")
+    assert cache.cache_compute(["a", "dddd"], lambda keys: 1 / 0).tolist() == [
+        [1, 1],
+        [4, 1],
+    ]
+
+
+def test_persistent_cache_two_writers(tmp_path):
+    first = PersistentNumpyCache(str(tmp_path), "model")
+    second = PersistentNumpyCache(str(tmp_path), "model")
+    first.cache_compute(["a", "bb"], embed)
+    second.cache_compute(["ccc", "a"], embed)
+    first.cache_compute(["dddd", "ccc"], embed)
+    assert len(first) == 4
+    assert second.cache_compute(["dddd", "bb"], embed).tolist() == [[4, 1], [2, 1]]
+
+    cache = PersistentNumpyCache(str(tmp_path), "model")
+    assert len(cache) == 4
+    keys = ["a", "bb", "ccc", "dddd"]
+    assert cache.cache_compute(keys, lambda keys: 1 / 0).tolist() == embed(
+        keys
+    ).tolist()
+
+
+def append_keys(path, worker):
+    cache = PersistentNumpyCache(path, "model")
+    for start in range(0, 40, 4):
+        cache.cache_compute(
+            ["k" * (length + 1) for length in range(start, start + 4 + worker)], embed
+        )
+
+
+def test_persistent_cache_two_processes(tmp_path):
+    PersistentNumpyCache(str(tmp_path), "model")
+    processes = [
+        multiprocessing.Process(target=append_keys, args=(str(tmp_path), worker))
+        for worker in range(2)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    cache = PersistentNumpyCache(str(tmp_path), "model")
+    keys = ["k" * length for length in range(1, 42)]
+    assert len(cache) == len(keys)
+    assert cache.cache_compute(keys, lambda keys: 1 / 0).tolist() == embed(
+        keys
+    ).tolist()
+
+
+def test_file_fingerprint(tmp_path):
+    path = os.path.join(str(tmp_path), "model.onnx")
+    with open(path, "wb") as f:
+        f.write(b"weights")
+    fingerprint = file_fingerprint(path)
+    with open(path, "wb") as f:
+        f.write(b"new weights")
+    assert file_fingerprint(path) != fingerprint
@@ -18,3 +18,27 @@ def test_schema_to_json():
         "b": "",
         "c": "",
     }
+
+
+def test_encode_response_binary():
+    """Test if numpy arrays are moved to binary buffers and back."""
+    import json
+    import numpy as np
+    from npc_engine.server.utils import encode_response, decode_binary
+
+    audio = np.arange(6, dtype=np.float32).reshape([2, 3])
+    response = {"jsonrpc": "2.0", "id": 0, "result": {"audio": audio, "n": 1}}
+    message, buffers = encode_response(response, binary=True)
+    assert len(buffers) == 1
+    assert json.loads(message)["result"]["audio"] == {
+        "__binary__": 0,
+        "dtype": "<f4",
+        "shape": [2, 3],
+    }
+    result = decode_binary(json.loads(message)["result"], [bytes(buffers[0])])
+    assert np.array_equal(result["audio"], audio)
+    assert result["n"] == 1
+
+    message, buffers = encode_response(response)
+    assert len(buffers) == 0
+    assert json.loads(message)["result"]["audio"] == audio.tolist()
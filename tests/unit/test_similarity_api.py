@@ -1,6 +1,8 @@
 """Similarity test."""
+import json
 import numpy as np
-from npc_engine.services.similarity import SimilarityAPI
+import pytest
+from npc_engine.services.similarity import SimilarityAPI, TransformerSemanticSimilarity
 import inspect
 import os
 import sys
@@ -24,7 +26,9 @@ class MockSimilarityModel(SimilarityAPI):
     def compute_embedding_batch(self, lines):
         global num_calls
         num_calls += 1
-        return np.asarray([num_calls]).reshape([1, 1])
+        return np.asarray(
+            [[123] if line == "Can I have a beer" else [num_calls] for line in lines]
+        )
 
     def metric(self, embedding_a, embedding_b):
         assert embedding_a == np.asarray([123]).reshape(1, 1)
@@ -39,3 +43,178 @@ def test_similarity_api():
 
     test_result = semantic_tests.cache(["Give me a beer"])
     test_result = semantic_tests.compare("Can I have a beer", ["Give me a beer"])
+
+
+class MockBatchedSimilarityModel(SimilarityAPI):
+    def __init__(self) -> None:
+        super().__init__(
+            10,
+            service_id="test",
+            context=zmq.Context(),
+            uri="inproc://test",
+            max_batch_size=4,
+        )
+        self.batch_calls = 0
+
+    def compute_embedding(self, line):
+        return self.compute_embedding_batch([line])
+
+    def compute_embedding_batch(self, lines):
+        self.batch_calls += 1
+        return np.asarray([[len(line)] for line in lines], dtype=np.float32)
+
+    def metric(self, embedding_a, embedding_b):
+        return (embedding_a * embedding_b).squeeze(1)
+
+
+def test_similarity_api_single_model_call():
+    """Check that query and context misses are embedded in one call"""
+    model = MockBatchedSimilarityModel()
+    assert model.compare("aa", ["b", "aa", "bbb"]) == [2.0, 4.0, 6.0]
+    assert model.batch_calls == 1
+    assert model.compare("aa", ["bbb", "cccc"]) == [6.0, 8.0]
+    assert model.batch_calls == 2
+    assert model.compare("bbb", ["aa"]) == [6.0]
+    assert model.batch_calls == 2
+
+
+def test_similarity_api_batched_requests():
+    """Check that concurrent compare requests are batched"""
+    from jsonrpc import Dispatcher
+
+    model = MockBatchedSimilarityModel()
+    dispatcher = Dispatcher()
+    dispatcher.update(model.build_api_dict())
+    requests = [
+        json.dumps(
+            {"jsonrpc": "2.0", "id": 1, "method": "compare", "params": ["a", ["bb"]]}
+        ),
+        json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "id": 2,
+                "method": "compare",
+                "params": {"query": "aa", "context": ["b", "bbb"]},
+            }
+        ),
+        json.dumps({"jsonrpc": "2.0", "id": 3, "method": "cache", "params": [["c"]]}),
+    ]
+    responses = model.handle_requests(requests, dispatcher)
+    assert model.batch_calls == 2
+    assert responses[0] == {"jsonrpc": "2.0", "id": 1, "result": [2.0]}
+    assert responses[1] == {"jsonrpc": "2.0", "id": 2, "result": [2.0, 6.0]}
+    assert responses[2]["id"] == 3
+
+
+def test_similarity_api_persistent_cache(tmp_path):
+    """Check that context embeddings are reused after restart and queries are not stored"""
+    with open(os.path.join(str(tmp_path), "model.onnx"), "wb") as f:
+        f.write(b"weights")
+    model = MockBatchedSimilarityModel()
+    model.use_persistent_cache = True
+    model.open_persistent_cache(str(tmp_path))
+    assert model.compare("aa", ["b", "bbb"]) == [2.0, 6.0]
+    assert model.batch_calls == 1
+    assert model.compare_batch(
+        [{"query": "cc", "context": ["b"]}, {"query": "d", "context": ["cc"]}]
+    ) == [[2.0], [2.0]]
+    assert model.batch_calls == 2
+    model.add_corpus("lines", ["b", "bbbb"])
+    assert model.search_corpus("lines", "eeeee", top_k=1)["indices"] == [1]
+    assert model.batch_calls == 4
+    assert sorted(model.persistent_cache.index) == ["b", "bbb", "bbbb", "cc"]
+
+    model = MockBatchedSimilarityModel()
+    model.use_persistent_cache = True
+    model.open_persistent_cache(str(tmp_path))
+    assert model.compare("bbb", ["bbb", "b"]) == [9.0, 3.0]
+    assert model.batch_calls == 0
+    assert model.compare("aa", ["bbb", "b"]) == [6.0, 2.0]
+    assert model.batch_calls == 1
+    assert len(model.persistent_cache) == 4
+
+
+def test_similarity_api_corpus():
+    """Check named corpus search"""
+    model = MockBatchedSimilarityModel()
+    assert model.add_corpus("lines", ["b", "bbbb"]) == 2
+    assert model.extend_corpus("lines", ["bbb", "bb"]) == 4
+    assert model.extend_corpus("lines", []) == 4
+    assert model.search_corpus("lines", "a", top_k=2) == {
+        "indices": [1, 2],
+        "scores": [4.0, 3.0],
+    }
+    assert model.search_corpus("lines", "a", top_k=None, threshold=1.5) == {
+        "indices": [1, 2, 3],
+        "scores": [4.0, 3.0, 2.0],
+    }
+    assert model.add_corpus("empty", []) == 0
+    assert model.search_corpus("empty", "a") == {"indices": [], "scores": []}
+    assert model.extend_corpus("empty", ["bb"]) == 1
+    with pytest.raises(ValueError):
+        model.search_corpus("missing", "a")
+
+
+class MockTransformerSimilarityModel(TransformerSemanticSimilarity):
+    """Transformer similarity with a lookup table instead of the ONNX model."""
+
+    def __init__(self, metric, embeddings, **kwargs) -> None:
+        SimilarityAPI.__init__(
+            self,
+            10,
+            service_id="test",
+            context=zmq.Context(),
+            uri="inproc://test",
+            **kwargs,
+        )
+        self.metric_type = metric
+        self.embeddings = embeddings
+
+    def compute_embedding_batch(self, lines):
+        return np.asarray([self.embeddings[line] for line in lines], dtype=np.float32)
+
+
+@pytest.mark.parametrize("metric", ["dot", "cosine"])
+def test_transformers_similarity_corpus_metric(metric):
+    """Check that corpus search returns the most similar lines first"""
+    model = MockTransformerSimilarityModel(
+        metric,
+        {"a": [1, 0], "b": [0, 1], "c": [0.9, 0.1], "query": [1, 0]},
+    )
+    model.add_corpus("lines", ["a", "b", "c"])
+    result = model.search_corpus("lines", "query", top_k=1)
+    assert result["indices"] == [0]
+    assert result["scores"] == pytest.approx([1.0])
+    result = model.search_corpus("lines", "query", top_k=None, threshold=0.5)
+    assert result["indices"] == [0, 2]
+    if metric == "cosine":
+        expected = model.compare("query", ["a", "c"])
+    else:
+        expected = [-score for score in model.compare("query", ["a", "c"])]
+    assert result["scores"] == pytest.approx(expected)
+
+
+def test_similarity_api_persistent_corpora(tmp_path):
+    """Check that corpora are saved and loaded for the same model"""
+    with open(os.path.join(str(tmp_path), "model.onnx"), "wb") as f:
+        f.write(b"weights")
+    model = MockBatchedSimilarityModel()
+    model.persistent_corpora = True
+    model.open_persistent_cache(str(tmp_path))
+    model.add_corpus("lines", ["b", "bbbb"])
+    model.extend_corpus("lines", ["bbb"])
+
+    model = MockBatchedSimilarityModel()
+    model.persistent_corpora = True
+    model.open_persistent_cache(str(tmp_path))
+    assert model.search_corpus("lines", "a", top_k=2) == {
+        "indices": [1, 2],
+        "scores": [4.0, 3.0],
+    }
+
+    with open(os.path.join(str(tmp_path), "model.onnx"), "wb") as f:
+        f.write(b"new weights")
+    model = MockBatchedSimilarityModel()
+    model.persistent_corpora = True
+    model.open_persistent_cache(str(tmp_path))
+    assert model.corpora == {}
@@ -5,6 +5,7 @@ from npc_engine.services.tts import TextToSpeechAPI
 import inspect
 import os
 import sys
+import time
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 sys.path.insert(0, currentdir)
@@ -33,3 +34,33 @@ def test_tts_api():
     test_result = tts.tts_get_results()
     assert np.asarray([123]).reshape(1, 1) == test_result
     assert ["1"] == tts.get_speaker_ids()
+
+
+def test_tts_api_concurrent_streams():
+    tts = MockTTSModel()
+    first = tts.tts_start("0", "test", 10)
+    second = tts.tts_start("1", "test", 10)
+    assert first != second
+    assert tts.tts_get_results(first) == np.asarray([123]).reshape(1, 1)
+    assert tts.tts_get_results(second) == np.asarray([123]).reshape(1, 1)
+    with pytest.raises(StopIteration):
+        tts.tts_get_results(first)
+    with pytest.raises(ValueError):
+        tts.tts_get_results(first)
+
+
+def test_tts_api_stream_eviction():
+    tts = MockTTSModel()
+    tts.streams.max_streams = 2
+    first = tts.tts_start("0", "test", 10)
+    tts.tts_start("0", "test", 10)
+    third = tts.tts_start("0", "test", 10)
+    assert len(tts.streams) == 2
+    with pytest.raises(ValueError):
+        tts.tts_get_results(first)
+
+    tts.streams.idle_timeout = 0
+    time.sleep(0.01)
+    with pytest.raises(ValueError):
+        tts.tts_get_results(third)
+    assert len(tts.streams) == 0